@@ -0,0 +1,345 @@
+'''
+
+################################################################################
+########################## BATCH ANALYSIS SCRIPT ###############################
+
+# This script runs the same analysis as the ColorMapper tabs but without any of
+# the user interface, so a whole directory of QA images can be analysed
+# unattended.
+
+# Usage:
+#   python batch_analysis.py IMAGES [IMAGES ...] --definitions FILE
+#       --output results.csv [--workers N] [--width W] [--cache]
+#       [--dark DARK] [--flat FLAT] [--filter median] [--background local]
+
+# IMAGES can be directories (every .tif/.tiff/.bmp/.raw file in them is used)
+# or glob patterns (e.g. "Z:\\Logos\\2020-08-03\\*.tif").
+
+# The definitions file gives the line profiles (and ROIs) to work out for every
+# image. It can either be a JSON file:
+#   {"profiles": [{"name": "diag", "x_start": 0, "x_end": 100,
+#                  "y_start": 0, "y_end": 100}],
+#    "rois": [{"name": "centre", "x_start": 40, "x_end": 60,
+#              "y_start": 40, "y_end": 60}]}
+# or a CSV file with the columns name, type (profile or roi), x_start, x_end,
+# y_start and y_end, or a session saved from the ColorMapper tab (.npz, see
+# scripts/sessions.py).
+
+# The results are written to <output>_profiles, <output>_metrics (the FWHM,
+# penumbra etc. of each profile, see scripts/profile_metrics.py) and
+# <output>_rois, as CSV or Parquet depending on the extension of the output
+# file.
+
+################################################################################
+################################################################################
+
+'''
+
+
+
+################################################################################
+####################### IMPORT LIBRARIES AND SCRIPTS ###########################
+
+import argparse
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from scripts.image_data import create_dict_image
+from scripts.profiles import get_profs, PROF_WEIGHTINGS
+from scripts.profile_metrics import create_prof_metrics, PROF_METRICS
+from scripts.roi_stats import create_roi_stats
+from scripts.image_cache import (set_disk_cache_dir, DISK_CACHE_DIR,
+    DEFAULT_DISK_CACHE_DIR)
+from scripts.sessions import read_session
+from scripts.preprocessing import (add_preprocessing_arguments,
+    preprocessing_from_args, set_preprocessing)
+
+# File types picked up when a directory is given
+IMAGE_EXTENSIONS = ('.tif', '.tiff', '.bmp', '.raw')
+
+################################################################################
+
+
+
+
+################################################################################
+############################ READ THE INPUTS ###################################
+
+# Turn the directories/glob patterns into a sorted list of image files.
+def find_images(patterns):
+
+    filelocations = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for filename in os.listdir(pattern):
+                if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                    filelocations.append(os.path.join(pattern, filename))
+        else:
+            filelocations.extend(glob.glob(pattern))
+
+    return sorted(set(filelocations))
+
+
+# Read the profile/ROI definitions. Returns two dataframes (profiles and rois),
+# each with the columns name, x_start, x_end, y_start and y_end.
+def read_definitions(filelocation):
+
+    columns = ['name', 'x_start', 'x_end', 'y_start', 'y_end']
+    ext = os.path.splitext(filelocation)[1].lower()
+
+    if ext == '.npz':
+        session = read_session(filelocation)
+        df_profiles = pd.DataFrame({col: session['prof_' + col]
+            for col in columns})
+        df_rois = pd.DataFrame({col: session['roi_' + col] for col in columns})
+    elif ext == '.json':
+        with open(filelocation) as f:
+            definitions = json.load(f)
+        df_profiles = pd.DataFrame(definitions.get('profiles', []),
+            columns=columns)
+        df_rois = pd.DataFrame(definitions.get('rois', []), columns=columns)
+    else:
+        df_definitions = pd.read_csv(filelocation)
+        if 'type' not in df_definitions:
+            df_definitions['type'] = 'profile'
+        df_type = df_definitions['type'].str.lower()
+        df_profiles = df_definitions.loc[df_type == 'profile', columns].copy()
+        df_rois = df_definitions.loc[df_type == 'roi', columns].copy()
+
+    # Give anything without a name a number
+    for df in (df_profiles, df_rois):
+        df['name'] = [str(name) if pd.notna(name) else str(i)
+            for i, name in enumerate(df['name'])]
+
+    return df_profiles.reset_index(drop=True), df_rois.reset_index(drop=True)
+
+
+# Plain dictionaries of arrays are quicker to send to the workers than
+# dataframes.
+def definitions_to_arrays(df):
+
+    return {col: df[col].to_numpy(dtype=np.float64)
+        for col in ['x_start', 'x_end', 'y_start', 'y_end']}
+
+################################################################################
+
+
+
+
+################################################################################
+########################## ANALYSE ONE IMAGE ###################################
+
+# This is run in the worker processes. It loads the image, works out every
+# profile in one go and the statistics inside each ROI. If the disk cache is
+# used (--cache, see scripts/image_cache.py) the profiles are kept in it so
+# running the same definitions over the same images again is quick.
+# prof_options are passed on to create_profs (order, spacing, normalise, width
+# and weighting).
+def analyse_image(filelocation, profiles, rois, prof_options):
+
+    dict_image = create_dict_image(filelocation)
+    arr1 = dict_image['image'][0]
+
+    result = {'file': filelocation}
+
+    if len(profiles['x_start']):
+        profs, n_samples = get_profs(arr1, profiles['x_start'],
+            profiles['x_end'], profiles['y_start'], profiles['y_end'],
+            **prof_options)
+        result['profs'] = profs.astype(np.float32)
+        result['n_samples'] = n_samples
+        # The metrics of every profile at once
+        lengths = np.hypot(profiles['x_end'] - profiles['x_start'],
+            profiles['y_end'] - profiles['y_start'])
+        result['prof_metrics'] = create_prof_metrics(profs, n_samples,
+            lengths/(n_samples - 1))
+
+    # Every ROI at once from the summed-area tables (see roi_stats.py)
+    if len(rois['x_start']):
+        result['roi_stats'] = create_roi_stats(dict_image, rois['x_start'],
+            rois['x_end'], rois['y_start'], rois['y_end'])
+
+    return result
+
+################################################################################
+
+
+
+
+################################################################################
+########################## COLLECT THE RESULTS #################################
+
+# Turn the results from every image into one long dataframe of profile
+# samples and one of ROI statistics.
+def results_to_dataframes(results, df_profiles, df_rois):
+
+    dfs_prof = []
+    dfs_roi = []
+    lengths = np.hypot(df_profiles['x_end'] - df_profiles['x_start'],
+        df_profiles['y_end'] - df_profiles['y_start']).to_numpy()
+
+    for result in results:
+        if 'profs' in result:
+            profs = result['profs']
+            n_samples = result['n_samples']
+            mask = np.arange(profs.shape[1]) < n_samples[:, None]
+            (i_prof, i_sample) = np.nonzero(mask)
+            dfs_prof.append(pd.DataFrame({
+                'file': result['file'],
+                'profile': df_profiles['name'].to_numpy()[i_prof],
+                'sample': i_sample,
+                'position': i_sample*(lengths/(n_samples - 1))[i_prof],
+                'value': profs[mask],
+                }))
+        if 'roi_stats' in result:
+            dfs_roi.append(pd.DataFrame(dict({'file': result['file'],
+                'roi': df_rois['name'].to_numpy()}, **result['roi_stats'])))
+
+    if dfs_prof:
+        df_prof = pd.concat(dfs_prof, ignore_index=True)
+    else:
+        df_prof = pd.DataFrame(columns=['file', 'profile', 'sample',
+            'position', 'value'])
+    if dfs_roi:
+        df_roi = pd.concat(dfs_roi, ignore_index=True)
+    else:
+        df_roi = pd.DataFrame(columns=['file', 'roi', 'mean', 'std', 'min',
+            'max', 'integral', 'pixels'])
+
+    return df_prof, df_roi
+
+
+# One row for each profile in each image with its metrics
+def results_to_metrics(results, df_profiles):
+
+    dfs_metrics = [pd.DataFrame(dict({'file': result['file'],
+        'profile': df_profiles['name'].to_numpy()}, **result['prof_metrics']))
+        for result in results if 'prof_metrics' in result]
+
+    if dfs_metrics:
+        return pd.concat(dfs_metrics, ignore_index=True)
+
+    return pd.DataFrame(columns=['file', 'profile'] + list(PROF_METRICS))
+
+
+def write_dataframe(df, filelocation):
+
+    if os.path.splitext(filelocation)[1].lower() == '.parquet':
+        df.to_parquet(filelocation, index=False)
+    else:
+        df.to_csv(filelocation, index=False)
+
+    return
+
+################################################################################
+
+
+
+
+################################################################################
+######################### DEFINE MAIN FUNCTION #################################
+
+# Set up this process (or a worker process) with the preprocessing and disk
+# cache to use
+def init_worker(preprocessing, disk_cache_dir):
+
+    set_preprocessing(preprocessing)
+    set_disk_cache_dir(disk_cache_dir)
+
+    return
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Analyse a batch of Logos '
+        'images without the user interface.')
+    parser.add_argument('images', nargs='+',
+        help='directories or glob patterns of images to analyse')
+    parser.add_argument('--definitions', required=True,
+        help='JSON, CSV or session file defining the profiles and ROIs')
+    parser.add_argument('--output', required=True,
+        help='output file name (.csv or .parquet)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+        help='number of worker processes (default: number of cores)')
+    parser.add_argument('--order', type=int, default=3,
+        help='spline interpolation order for the profiles (default: 3)')
+    parser.add_argument('--spacing', type=float, default=0.1,
+        help='profile sample spacing in pixels (default: 0.1)')
+    parser.add_argument('--raw', action='store_true',
+        help="don't normalise the profiles to their max value")
+    parser.add_argument('--width', type=float, default=0,
+        help='profile width in pixels to average across (default: 0)')
+    parser.add_argument('--weighting', choices=PROF_WEIGHTINGS,
+        default='mean', help='how to combine across the width (default: '
+        'mean)')
+    # The disk cache (see scripts/image_cache.py) is only worth it if the same
+    # images are analysed again, so it's off unless asked for
+    parser.add_argument('--cache', action='store_true',
+        help='keep the decoded images and profiles in the disk cache')
+    parser.add_argument('--cache-dir',
+        help='where to keep the disk cache (implies --cache)')
+    # Dark/flat correction, filtering and background subtraction applied to
+    # every image first (see scripts/preprocessing.py)
+    add_preprocessing_arguments(parser)
+    args = parser.parse_args(argv)
+
+    start = time.time()
+
+    filelocations = find_images(args.images)
+    df_profiles, df_rois = read_definitions(args.definitions)
+    print('\nAnalysing ' + str(len(filelocations)) + ' images with '
+        + str(len(df_profiles)) + ' profiles and ' + str(len(df_rois))
+        + ' ROIs')
+
+    profiles = definitions_to_arrays(df_profiles)
+    rois = definitions_to_arrays(df_rois)
+    prof_options = {'order': args.order, 'spacing': args.spacing,
+        'normalise': not args.raw, 'width': args.width,
+        'weighting': args.weighting}
+    n = len(filelocations)
+    preprocessing = preprocessing_from_args(args)
+    # (--cache still uses the usual place if the disk cache has been switched
+    # off for the server with IMAGE_ANALYSIS_CACHE)
+    disk_cache_dir = args.cache_dir
+    if disk_cache_dir is None and args.cache:
+        disk_cache_dir = DISK_CACHE_DIR or DEFAULT_DISK_CACHE_DIR
+    init_worker(preprocessing, disk_cache_dir)
+
+    if args.workers > 1 and n > 1:
+        # (The workers are each given the settings as they start)
+        with ProcessPoolExecutor(max_workers=args.workers,
+            initializer=init_worker,
+            initargs=(preprocessing, disk_cache_dir)) as executor:
+            results = list(executor.map(analyse_image, filelocations,
+                [profiles]*n, [rois]*n, [prof_options]*n,
+                chunksize=max(1, n//(4*args.workers))))
+    else:
+        results = [analyse_image(filelocation, profiles, rois, prof_options)
+            for filelocation in filelocations]
+
+    df_prof, df_roi = results_to_dataframes(results, df_profiles, df_rois)
+
+    (stem, ext) = os.path.splitext(args.output)
+    if len(df_profiles):
+        write_dataframe(df_prof, stem + '_profiles' + ext)
+        write_dataframe(results_to_metrics(results, df_profiles),
+            stem + '_metrics' + ext)
+    if len(df_rois):
+        write_dataframe(df_roi, stem + '_rois' + ext)
+
+    print('\nFinished in: ' + str(time.time() - start) + 'sec')
+
+    return
+
+
+################################################################################
+############################### RUN MAIN #######################################
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,460 @@
+'''
+
+################################################################################
+############################ BENCHMARK SCRIPT ##################################
+
+# Times the image pipeline and the ColorMapper callbacks on synthetic spot-grid
+# images so that changes which slow down the hot paths can be spotted. No
+# browser is needed: the callbacks are triggered by changing the Bokeh models
+# directly, the same as a browser would.
+
+# Usage:
+#   python benchmark.py [--sizes 1024 2048 4096]
+#       [--dtypes uint8 uint16 float32] [--repeat 5] [--output results.json]
+#       [--compare previous_results.json]
+#       [--sessions 20 --workers 1 2 4]
+
+# Each result records the best and median time of the repeats and the peak
+# memory allocated during one extra run (measured separately with tracemalloc
+# as it slows things down).
+
+# With --sessions, main.py is also started as a real server (once for each
+# number of workers) and that many browser sessions are opened on it at once.
+# This records how long they all take to open and how much memory the server
+# processes use between them (PSS, so memory shared between the workers is
+# only counted once).
+
+################################################################################
+################################################################################
+
+'''
+
+
+
+################################################################################
+####################### IMPORT LIBRARIES AND SCRIPTS ###########################
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+
+import numpy as np
+from PIL import Image
+from scipy.ndimage import gaussian_filter
+
+from bokeh.client import pull_session
+from bokeh.document import Document
+
+from scripts.image_analysis import create_dict_image, create_prof, ColorMapper
+from scripts.image_cache import clear_cache, set_disk_cache_dir
+from scripts.profiles import prefilter_image
+from scripts.preprocessing import preprocess_image
+
+################################################################################
+
+
+
+
+################################################################################
+########################## CREATE TEST IMAGES ##################################
+
+# Spots on a regular grid (roughly what the Logos images look like) plus a
+# little noise.
+def create_spot_grid(size, dtype, spacing=64, sigma=4.0, seed=0):
+
+    rng = np.random.default_rng(seed)
+    arr1 = np.zeros((size, size), dtype=np.float32)
+    arr1[spacing//2::spacing, spacing//2::spacing] = 2*np.pi*sigma**2
+    arr1 = gaussian_filter(arr1, sigma)
+    arr1 += rng.normal(0.02, 0.005, arr1.shape).astype(np.float32)
+    arr1 = np.clip(arr1/arr1.max(), 0, 1)
+
+    if dtype == 'uint8':
+        return (arr1*250).astype(np.uint8)
+    if dtype == 'uint16':
+        return (arr1*60000).astype(np.uint16)
+
+    return (arr1*1000).astype(np.float32)
+
+
+def write_image(arr1, directory, name):
+
+    filelocation = os.path.join(directory, name + '.tif')
+    Image.fromarray(arr1).save(filelocation)
+
+    return filelocation
+
+################################################################################
+
+
+
+
+################################################################################
+############################### TIMING #########################################
+
+# Time func (called with no arguments) repeat times. setup is called before
+# each repeat and isn't timed. The peak memory comes from one more run with
+# tracemalloc switched on.
+def time_it(func, repeat, setup=None):
+
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    func()
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'best_s': min(times), 'median_s': statistics.median(times),
+        'repeat': repeat, 'peak_bytes': peak}
+
+################################################################################
+
+
+
+
+################################################################################
+############################# BENCHMARKS #######################################
+
+def benchmark_pipeline(filelocation, size, repeat):
+
+    results = {}
+
+    results['create_dict_image cold'] = time_it(
+        lambda: create_dict_image(filelocation), repeat, setup=clear_cache)
+    results['create_dict_image warm'] = time_it(
+        lambda: create_dict_image(filelocation), repeat)
+
+    dict_image = create_dict_image(filelocation)
+    arr1 = dict_image['image'][0]
+
+    # Working out the spline coefficients is a one-off per image, so time it
+    # on its own (on a copy so it's never already cached).
+    results['prefilter order 3'] = time_it(
+        lambda: prefilter_image(np.array(arr1), 3), repeat)
+
+    # The preprocessing (see scripts/preprocessing.py), which is also a one-off
+    # per image
+    for name, settings in (('median 3', {'filter': 'median'}),
+        ('gaussian 2', {'filter': 'gaussian', 'filter_size': 2}),
+        ('local background', {'background': 'local'})):
+        results['preprocess ' + name] = time_it(
+            lambda: preprocess_image(arr1, settings), repeat)
+
+    # Profiles of a few lengths, all through the middle of the image
+    centre = size/2
+    for length in (64, 512, int(size*0.9)):
+        for order in (0, 1, 3):
+            half = length/2/np.sqrt(2)
+            line = (centre - half, centre + half, centre - half,
+                centre + half)
+            create_prof(dict_image, *line, order=order)
+            results['create_prof length ' + str(length) + ' order '
+                + str(order)] = time_it(
+                lambda: create_prof(dict_image, *line, order=order), repeat)
+
+    return results
+
+
+# Build a ColorMapper tab in a document (with no server, so the callbacks run
+# straight away instead of being debounced) and time each of its callbacks.
+def benchmark_callbacks(filelocation, size, repeat):
+
+    results = {}
+
+    def build():
+        doc = Document()
+        doc.add_root(ColorMapper(filelocation, debounce_ms=0))
+        return doc
+
+    results['ColorMapper'] = time_it(build, repeat)
+
+    doc = build()
+    src_prof_points = doc.get_model_by_name('src_prof_points')
+    p_zoom = doc.get_model_by_name('p_zoom')
+    file_input = doc.get_model_by_name('file_input')
+
+    # Move the end of the profile about like someone dragging it
+    drag = [0]
+
+    def callback_prof():
+        drag[0] += 1
+        offset = (drag[0] % 50)*size/200
+        src_prof_points.data = {'x': [size*0.1, size*0.5 + offset],
+            'y': [size*0.1, size*0.5]}
+
+    results['callback_prof'] = time_it(callback_prof, repeat)
+
+    # Pan the zoomed in view across the image
+    pan = [0]
+
+    def callback_range():
+        pan[0] += 1
+        start = (pan[0] % 20)*size/25
+        p_zoom.x_range.update(start=start, end=start + size/8)
+        p_zoom.y_range.update(start=start, end=start + size/8)
+
+    results['callback_range'] = time_it(callback_range, repeat)
+
+    # Upload the same image again
+    with open(filelocation, 'rb') as f:
+        value = base64.b64encode(f.read()).decode('ascii')
+
+    def callback_file_input():
+        file_input.value = ''
+        file_input.value = value
+
+    results['callback_file_input'] = time_it(callback_file_input, repeat)
+
+    return results
+
+
+# Time to first render: how long a fresh Python takes to import the tab script
+# and build the ColorMapper document (what happens once the image has been
+# chosen in main.py, if the tab script hasn't been imported in the background
+# yet).
+FIRST_RENDER_CODE = '''
+import time
+start = time.perf_counter()
+from bokeh.document import Document
+from scripts.image_analysis import ColorMapper
+doc = Document()
+doc.add_root(ColorMapper({!r}))
+print(time.perf_counter() - start)
+'''
+
+
+# If a cache_dir is given the disk cache (see scripts/image_cache.py) is
+# filled first, so this is the time to reopen an image seen in an earlier run.
+def benchmark_first_render(filelocation, repeat, cache_dir=None):
+
+    code = FIRST_RENDER_CODE.format(filelocation)
+    directory = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, IMAGE_ANALYSIS_CACHE=cache_dir or '')
+    name = 'first render' if cache_dir is None else 'first render disk cache'
+
+    def run():
+        output = subprocess.run([sys.executable, '-c', code], cwd=directory,
+            env=env, check=True, capture_output=True, text=True).stdout
+        return float(output.split()[-1])
+
+    if cache_dir is not None:
+        run()
+    times = [run() for i in range(repeat)]
+
+    return {name: {'best_s': min(times),
+        'median_s': statistics.median(times), 'repeat': repeat,
+        'peak_bytes': 0}}
+
+################################################################################
+
+
+
+
+# Memory used by a process and its children (Linux only, 0 elsewhere)
+def process_pss(pid):
+
+    pids = [pid]
+    try:
+        with open('/proc/' + str(pid) + '/task/' + str(pid) + '/children') as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        return 0
+
+    pss = 0
+    for pid in pids:
+        try:
+            with open('/proc/' + str(pid) + '/smaps_rollup') as f:
+                for line in f:
+                    if line.startswith('Pss:'):
+                        pss += int(line.split()[1])*1024
+        except OSError:
+            pass
+
+    return pss
+
+
+# Start main.py with the given number of workers and open n_sessions sessions
+# on it at the same time
+def benchmark_sessions(filelocation, workers, n_sessions, repeat, port=5091):
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    url = 'http://localhost:' + str(port) + '/'
+    server = subprocess.Popen([sys.executable, 'main.py', '--workers',
+        str(workers), '--images', filelocation, '--port', str(port),
+        '--no-browser'], cwd=directory, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+
+    try:
+        # Wait for the server to start
+        for i in range(600):
+            try:
+                urllib.request.urlopen(url + 'metrics')
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        def open_session(sessions):
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            sessions.append(pull_session(url=url))
+
+        times = []
+        pss = 0
+        for i in range(repeat):
+            sessions = []
+            threads = [threading.Thread(target=open_session, args=(sessions,))
+                for i_session in range(n_sessions)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            times.append(time.perf_counter() - start)
+            pss = max(pss, process_pss(server.pid))
+            for session in sessions:
+                session.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+    name = (str(n_sessions) + ' sessions, ' + str(workers) + ' worker'
+        + ('s' if workers > 1 else ''))
+
+    return {name: {'best_s': min(times), 'median_s': statistics.median(times),
+        'repeat': repeat, 'peak_bytes': pss}}
+
+################################################################################
+
+
+
+
+################################################################################
+######################### COMPARE WITH OLD RESULTS #############################
+
+# Print how much each benchmark has changed compared with an earlier run.
+# Anything more than threshold slower is flagged.
+def compare(results, filelocation, threshold=0.2):
+
+    with open(filelocation) as f:
+        old_results = json.load(f)['results']
+
+    old = {(r['name'], r['size'], r['dtype']): r for r in old_results}
+    print('\nChange compared with ' + filelocation + ':')
+    for r in results:
+        key = (r['name'], r['size'], r['dtype'])
+        if key not in old:
+            continue
+        ratio = r['best_s']/old[key]['best_s']
+        flag = '  <-- SLOWER' if ratio > 1 + threshold else ''
+        print('  {:<40} {:>5} {:<8} {:6.2f}x{}'.format(r['name'], r['size'],
+            r['dtype'], ratio, flag))
+
+    return
+
+################################################################################
+
+
+
+
+################################################################################
+######################### DEFINE MAIN FUNCTION #################################
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Benchmark the image '
+        'pipeline and the ColorMapper callbacks.')
+    parser.add_argument('--sizes', type=int, nargs='+',
+        default=[1024, 2048, 4096])
+    parser.add_argument('--dtypes', nargs='+',
+        default=['uint8', 'uint16', 'float32'])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare',
+        help='earlier results file to compare against')
+    parser.add_argument('--sessions', type=int, default=0,
+        help='number of sessions to open on a real server (default 0, off)')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1],
+        help='numbers of server workers to try with --sessions')
+    args = parser.parse_args(argv)
+
+    results = []
+
+    # Everything is timed without the disk cache (apart from 'first render
+    # disk cache') so the images are really decoded and analysed each time.
+    # (The server started for --sessions inherits this too.)
+    os.environ['IMAGE_ANALYSIS_CACHE'] = ''
+    set_disk_cache_dir(None)
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        for size in args.sizes:
+            for dtype in args.dtypes:
+                print('\nBenchmarking ' + str(size) + 'x' + str(size) + ' '
+                    + dtype)
+                filelocation = write_image(create_spot_grid(size, dtype),
+                    directory, str(size) + '_' + dtype)
+
+                timings = benchmark_pipeline(filelocation, size, args.repeat)
+                timings.update(benchmark_callbacks(filelocation, size,
+                    args.repeat))
+                timings.update(benchmark_first_render(filelocation,
+                    args.repeat))
+                timings.update(benchmark_first_render(filelocation,
+                    args.repeat, os.path.join(directory, 'cache')))
+                if args.sessions:
+                    for workers in args.workers:
+                        timings.update(benchmark_sessions(filelocation,
+                            workers, args.sessions, args.repeat))
+
+                for name, timing in timings.items():
+                    print('  {:<40} {:10.2f} ms {:10.1f} MB'.format(name,
+                        timing['best_s']*1000, timing['peak_bytes']/1e6))
+                    results.append(dict(name=name, size=size, dtype=dtype,
+                        **timing))
+
+                clear_cache()
+
+    output = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpus': os.cpu_count(),
+            },
+        'results': results,
+        }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=1)
+    print('\nResults written to ' + args.output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+    return
+
+
+################################################################################
+############################### RUN MAIN #######################################
+
+if __name__ == '__main__':
+    main()
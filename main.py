@@ -38,38 +38,49 @@ print('\nImporting libraries...')
 import time
 start = time.time()
 
-# Import some basic tools from easygui to allow for user interface
-from easygui import fileopenbox
-
-# Import pandas, which is used for datamanagement and the creation of
-# dataframes.
-import pandas as pd
-
-# Import os to allow manipluation of filepaths etc ????????????????????????????????????????????????????????????????????????????????????????????????????????????????????????????????????????????
-import os
-
 # Import some basic stuff from bokeh. Just need enough to be able to mainpulate
 # the tabs etc. as most of the creation of the graphs will be done within the
 # individual tab scripts.
-from bokeh.io import curdoc
+from bokeh.models import Panel, Div
 from bokeh.models.widgets import Tabs
 
-# Import the tab scripts. Each script creates exactly one tab. (As mentioned
-# earlier if there are problems importing these scripts then make sure that
-# there is an empty file called __init__.py in the scripts folder).
-from scripts.image_analysis import ColorMapper
-
-# Import pypyodbc as this is how conections to the database can be achieved.
-import pypyodbc
+# The tab scripts (and the heavy libraries they use, e.g. scipy) aren't
+# imported here so that the server can start straight away. They're imported
+# on another thread while the images are being chosen (see import_tabs below).
+# (As mentioned earlier if there are problems importing these scripts then
+# make sure that there is an empty file called __init__.py in the scripts
+# folder).
+import importlib
+import threading
 
 # Import some other bokeh and tornado libraries that will allow for the creation
 # and running of the server.
 from bokeh.server.server import Server
 from bokeh.application.handlers import FunctionHandler
 from bokeh.application import Application
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
 from functools import partial
 
+# Import argparse so the server options can be given on the command line
+import argparse
+
+# Import the shared image cache used when there are several server workers
+# (and the disk cache which keeps images and results between runs)
+import atexit
+import os
+import shutil
+import signal
+import tempfile
+from tornado.process import task_id
+from scripts.image_cache import set_shared_cache_dir, set_disk_cache_dir
+
+# Import where sessions are saved
+from scripts.sessions import set_session_dir
+
+# Import the timing metrics and the handlers which show them on the server
+from scripts.metrics import (MetricsHandler, ProfileHandler, forget_session,
+    set_gauge, set_worker, write_snapshot)
+
 ###### Start of patch!
 ###### Need a fix for running the Tornado Server in Python 3.8 on Windows. This
 ###### piece of code seems to allow it to run correctly (something about
@@ -91,32 +102,187 @@ print('\nLibraries loaded in: ' + str(endlib - start) + 'sec')
 
 
 
+################################################################################
+############################ IMPORT THE TABS ###################################
+
+# Each tab script creates exactly one tab. These are imported the first time
+# they're needed (or earlier, in the background, by import_tabs).
+TAB_MODULES = ['scripts.image_analysis', 'scripts.image_comparison']
+
+
+def import_tabs():
+
+    for module in TAB_MODULES:
+        importlib.import_module(module)
+
+    return
+
+
+# Create a tab which is only built the first time it's clicked on. Until then
+# it just holds a placeholder. build is called with no arguments and returns
+# the finished Panel.
+def create_deferred_tab(tabs, title, build):
+
+    panel = Panel(child=Div(text='Loading...'), title=title)
+    built = [False]
+
+    def callback_active(attr, old, new):
+
+        if built[0] or tabs.tabs[new] is not panel:
+            return
+        # (Only marked as built once it has been, so a failed build is
+        # tried again next time the tab's clicked on)
+        panel.child = build().child
+        built[0] = True
+
+        return
+
+    tabs.on_change('active', callback_active)
+
+    return panel
+
+################################################################################
+
+
+
+
+################################################################################
+########################## SHARED IMAGE CACHE ##################################
+
+# Where the workers share the decoded images. This is in memory (/dev/shm) where
+# there is one.
+def default_shared_cache_dir():
+
+    if os.path.isdir('/dev/shm'):
+        directory = '/dev/shm'
+    else:
+        directory = tempfile.gettempdir()
+
+    return os.path.join(directory, 'image-analysis-' + str(os.getpid()))
+
+
+# Delete the shared directory when the server stops. (Only from the process
+# that made it, not from the forked workers.)
+def remove_shared_cache_dir(directory, pid):
+
+    if os.getpid() == pid:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return
+
+
+# Watching a folder for new images (see scripts/watch_folder.py). Each new
+# image is shown in every open session. If a definitions file (the same as for
+# batch_analysis.py) is given each image's profiles, ROIs and spots are also
+# added to the end of <output>_profiles.csv, <output>_metrics.csv,
+# <output>_rois.csv and <output>_spots.csv.
+WATCHER = None
+
+
+def create_watch_analysis(definitions, output):
+
+    from batch_analysis import (read_definitions, definitions_to_arrays,
+        analyse_image, results_to_dataframes, results_to_metrics)
+    from scripts.spots import get_spots
+    import pandas as pd
+
+    df_profiles, df_rois = read_definitions(definitions)
+    profiles = definitions_to_arrays(df_profiles)
+    rois = definitions_to_arrays(df_rois)
+    stem = os.path.splitext(output)[0]
+    lock = threading.Lock()
+
+    def append(df, filelocation):
+        df.to_csv(filelocation, mode='a', index=False,
+            header=not os.path.exists(filelocation))
+
+    def analyse(filelocation, dict_image):
+        result = analyse_image(filelocation, profiles, rois, {})
+        df_prof, df_roi = results_to_dataframes([result], df_profiles, df_rois)
+        df_spots = pd.DataFrame(get_spots(dict_image))
+        df_spots.insert(0, 'file', filelocation)
+        df_metrics = results_to_metrics([result], df_profiles)
+        with lock:
+            append(df_prof, stem + '_profiles.csv')
+            append(df_metrics, stem + '_metrics.csv')
+            append(df_roi, stem + '_rois.csv')
+            append(df_spots, stem + '_spots.csv')
+
+    return analyse
+
+
+# Stop a worker once the process that forked it has gone
+def stop_if_orphaned(io_loop, first_pid):
+
+    if os.getppid() != first_pid:
+        io_loop.stop()
+
+    return
+
+################################################################################
+
+
+
+
 ################################################################################
 ################################################################################
 
-def produce_doc(doc):
+# Select the images to be analysed. The first one is shown in the ColorMapper
+# tab. If more than one is chosen they're also all loaded into the comparison
+# tab, with the first one as the baseline.
+def choose_images():
+
+    # easygui is only needed here to choose the images
+    from easygui import fileopenbox
+
+    return fileopenbox(title='Select image(s)',
+        msg='Please select image(s). The first is used as the baseline.',
+        multiple=True)
+
+
+# The images can be chosen up front (every session then shows the same ones)
+# or, if filelocations is None, each new session asks for them. If a folder is
+# being watched new sessions start on the newest image in it. server_render
+# is passed on to the ColorMapper tab (None leaves it to SERVER_RENDER in
+# scripts/image_analysis.py).
+def produce_doc(doc, filelocations=None, server_render=None):
 
     ############################################################################
     ######################## CREATE EACH OF THE TABS ###########################
 
-    # Going to make 3 tabs. These will be identical to start with but I think
-    # by runnning it 3 times it will be possible to assess 3 different images
-    # at the same time.
+    if filelocations is None and WATCHER is not None:
+        latest = WATCHER.latest_image()
+        filelocations = [latest] if latest is not None else None
+    if filelocations is None:
+        filelocations = choose_images()
+    if not filelocations:
+        return doc
+
+    # Time from the images being chosen to the document being ready to send
+    chosen = time.time()
 
-	# Select the image to be analysed
-    filelocation = fileopenbox(title='Select image', msg='Please select image')
+    from scripts.image_analysis import ColorMapper
+    from scripts.image_comparison import ImageComparison
 
-    tab1 = ColorMapper(filelocation)
-    tab2 = ColorMapper(filelocation)
-    tab3 = ColorMapper(filelocation)
-    tabs = Tabs(tabs = [tab1, tab2, tab3])
+    # Only the visible tab is built now, the comparison tab waits until it's
+    # clicked on.
+    tabs = Tabs(tabs = [ColorMapper(filelocations[0],
+        server_render=server_render, watcher=WATCHER, doc=doc)])
+    if len(filelocations) > 1:
+        tabs.tabs.append(create_deferred_tab(tabs, 'Comparison',
+            partial(ImageComparison, filelocations)))
 
     # Put all of the tabs into the doccument
     doc.add_root(tabs)
 
+    # Once the session is closed its timings are added to the 'closed' totals
+    doc.on_session_destroyed(lambda session_context:
+        forget_session(session_context.id))
+
     # With the tabs made run a check to find out how long it took.
     endconn = time.time()
-    print('\nTabs made in: ' + str(endconn - endlib) + 'sec')
+    set_gauge('first_render_seconds', endconn - chosen)
+    print('\nTabs made in: ' + str(endconn - chosen) + 'sec')
 
     return doc
 
@@ -139,6 +305,96 @@ def produce_doc(doc):
 
 def main():
 
+    global WATCHER
+
+    # The preprocessing (dark/flat correction, filtering and background
+    # subtraction) applied to every image. This is imported here rather than
+    # at the top, like the tab scripts, to keep the start up quick.
+    from scripts.preprocessing import (add_preprocessing_arguments,
+        preprocessing_from_args, set_preprocessing)
+
+    # The timings are always available from /metrics. The profiler (which
+    # captures a cProfile of a single callback when armed from /profile) has to
+    # be switched on.
+    parser = argparse.ArgumentParser(description='Run the image analysis '
+        'server.')
+    parser.add_argument('--profiler', action='store_true',
+        help='allow the profiler to be armed from /profile')
+    # Several worker processes can share the port (not on Windows). The images
+    # are then chosen once up front, rather than in each session, and the
+    # decoded images are shared between the workers (see image_cache.py).
+    # Nothing makes a browser stick to one worker: the page and its websocket
+    # can land on different workers, in which case both build the document
+    # (the unused one is thrown away once it expires). Put a sticky proxy in
+    # front of the server if that matters.
+    parser.add_argument('--workers', type=int, default=1,
+        help='number of server processes (default 1). Connections are not '
+        'sticky, so a page can be built by one worker and then served by '
+        'another, building it twice')
+    parser.add_argument('--images', nargs='+',
+        help='images to show (chosen in a dialog if not given)')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--shared-cache', default=default_shared_cache_dir(),
+        help='directory the workers share decoded images through')
+    # Decoded images and the results worked out from them are kept on disk so
+    # opening the same images again is quick (see scripts/image_cache.py)
+    parser.add_argument('--cache-dir',
+        help='where to keep the disk cache (default ~/.cache/image-analysis)')
+    parser.add_argument('--no-cache', action='store_true',
+        help="don't keep anything in the disk cache")
+    parser.add_argument('--no-browser', action='store_true',
+        help="don't open the page in a browser")
+    # Colour the images in on the server (see scripts/colour_mapping.py)
+    parser.add_argument('--server-render', action='store_true',
+        help='colour the images in on the server and send RGBA tiles (for '
+        'thin clients)')
+    # Watch a folder for new images from the detectors
+    parser.add_argument('--watch',
+        help='folder to watch for new images (shown in every session)')
+    parser.add_argument('--definitions',
+        help='profiles/ROIs to work out for each watched image (see '
+        'batch_analysis.py)')
+    parser.add_argument('--watch-output', default='watch_results.csv',
+        help='where to save the results for the watched images')
+    parser.add_argument('--poll', action='store_true',
+        help="check the watched folder every so often rather than using "
+        "inotify (e.g. for network drives)")
+    # Where the 'Save session' button saves the profiles and ROIs (see
+    # scripts/sessions.py)
+    parser.add_argument('--sessions', default='sessions',
+        help='folder to save sessions in (default: sessions)')
+    # Corrections applied to every image when it's opened (see
+    # scripts/preprocessing.py)
+    add_preprocessing_arguments(parser)
+    args = parser.parse_args()
+
+    set_session_dir(args.sessions)
+
+    set_preprocessing(preprocessing_from_args(args))
+
+    if args.no_cache:
+        set_disk_cache_dir(None)
+    elif args.cache_dir is not None:
+        set_disk_cache_dir(args.cache_dir)
+
+    filelocations = args.images
+    if args.workers > 1:
+        if filelocations is None and args.watch is None:
+            filelocations = choose_images()
+            if not filelocations:
+                return
+        # Set up the shared cache and import the tab scripts before the
+        # workers are forked so they all start with them. (If the disk cache
+        # is on most things are shared through that instead, but the shared
+        # directory is still used for the big things it doesn't keep, see
+        # DISK_CACHE_SKIP.)
+        set_shared_cache_dir(args.shared_cache)
+        atexit.register(remove_shared_cache_dir, args.shared_cache,
+            os.getpid())
+        # (atexit doesn't run on SIGTERM unless it's turned into an exit)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        import_tabs()
+
     print('\nPreparing a bokeh application.')
 
     ############################################################################
@@ -148,17 +404,26 @@ def main():
     # the programme without needing to use the bokeh server command line tool.
     # https://docs.bokeh.org/en/latest/docs/reference/application/handlers/function.html
     # Start an Input/Output Loop. (Specifically a Tornado asynchronous I/O Loop)
-    io_loop = IOLoop.current()
+    # (With several workers each one starts its own loop after being forked.)
+    io_loop = IOLoop.current() if args.workers == 1 else None
     # Define port for server
-    port = 5001
+    port = args.port
     # Create kwargs which will be fed into the server function as keyworded
     # arguments.
     kwargs =    {
                 'io_loop': io_loop,
                 'port': port,
+                'num_procs': args.workers,
                 }
+    # Add the pages showing the timings (these only answer local requests)
+    extra_patterns = [(r'/metrics', MetricsHandler)]
+    if args.profiler:
+        extra_patterns.append((r'/profile', ProfileHandler))
+    kwargs['extra_patterns'] = extra_patterns
     # Define the application using the bokeh application function handler.
-    app = Application(FunctionHandler(produce_doc))
+    app = Application(FunctionHandler(partial(produce_doc,
+        filelocations=filelocations,
+        server_render=True if args.server_render else None)))
 
 
     ############################################################################
@@ -166,14 +431,49 @@ def main():
 
     # Define the server
     # http://matthewrocklin.com/blog/work/2017/06/28/simple-bokeh-server
+    # (With several workers they're forked off in here.)
+    first_pid = os.getpid()
     server = Server({'/' : app},  **kwargs)
+    # If the first process is stopped the workers stop too. Each worker also
+    # writes out its timings every few seconds so /metrics can show them all.
+    if args.workers > 1:
+        PeriodicCallback(partial(stop_if_orphaned, server.io_loop, first_pid),
+            1000).start()
+        set_worker(str(task_id()), os.path.join(args.shared_cache, 'metrics'))
+        PeriodicCallback(write_snapshot, 5000).start()
+    # Start watching the folder. With several workers only the first one
+    # watches it (and saves the results), and announces each new image in the
+    # shared directory for the others to pick up and show in their sessions.
+    if args.watch is not None:
+        from scripts.watch_folder import FolderWatcher, WatchFollower
+        announce = None
+        if args.workers > 1:
+            announce = os.path.join(args.shared_cache, 'watched.txt')
+        if args.workers == 1 or task_id() == 0:
+            analyse = None
+            if args.definitions is not None:
+                analyse = create_watch_analysis(args.definitions,
+                    args.watch_output)
+            WATCHER = FolderWatcher(args.watch, analyse=analyse,
+                use_inotify=not args.poll, announce=announce).start()
+            print('\nWatching ' + args.watch + ' for new images')
+        else:
+            WATCHER = WatchFollower(args.watch, announce).start()
     # Start running the server
     server.start()
-    print('\nOpening Bokeh application on http://localhost:5001/')
-    # Display the server
-    server.show('/')
+    set_gauge('startup_seconds', time.time() - start)
+    # Import the tab scripts while the images are being chosen
+    if args.workers == 1:
+        threading.Thread(target=import_tabs, daemon=True).start()
+    url = 'http://localhost:' + str(port) + '/'
+    print('\nOpening Bokeh application on ' + url + ' (pid '
+        + str(os.getpid()) + ')')
+    print('Timings are available on ' + url + 'metrics')
+    # Display the server (only once if there are several workers)
+    if not args.no_browser and (args.workers == 1 or task_id() == 0):
+        server.show('/')
     # Start the Input/Output Loop
-    io_loop.start()
+    server.io_loop.start()
 
 
 
@@ -0,0 +1,83 @@
+################################################################################
+############################## IMPORT LIBRARIES ################################
+
+import numpy as np
+
+################################################################################
+################################################################################
+
+# Server-side colour mapping. Rather than sending the browser the raw numbers
+# and having it colour them in (once for every plot in every session), the
+# palette and window/level are applied here with a look up table (LUT) to give
+# a packed RGBA image which can be shown with image_rgba. Only the tiles each
+# plot is sent get coloured (at the level of the pyramid it's showing), so
+# changing the window only re-runs the LUT over what's on screen.
+
+
+
+
+
+# Turn a palette (list of '#rrggbb' colours) into an (N x 4) uint8 RGBA table
+def create_lut(palette):
+
+	lut = np.zeros((len(palette), 4), dtype=np.uint8)
+	for i, colour in enumerate(palette):
+		colour = colour.lstrip('#')
+		lut[i, 0] = int(colour[0:2], 16)
+		lut[i, 1] = int(colour[2:4], 16)
+		lut[i, 2] = int(colour[4:6], 16)
+		lut[i, 3] = 255
+
+	return lut
+
+
+
+
+
+# Colour an image using the palette. Values from low to high are split evenly
+# across the colours (the same as Bokeh's LinearColorMapper) and anything
+# outside is clipped to the end colours. NaNs come out transparent. Returns a
+# 2D uint32 array of packed RGBA values (what image_rgba wants).
+def apply_lut(arr1, low, high, lut):
+
+	lut32 = np.ascontiguousarray(lut).view(np.uint32).ravel()
+	n_colours = len(lut32)
+	scale = n_colours/(high - low) if high > low else 0.0
+
+	# 8 and 16 bit images can be coloured with a single look up of every
+	# possible value, without any floating point maths per pixel.
+	if arr1.dtype.kind in 'ui' and arr1.dtype.itemsize <= 2:
+		info = np.iinfo(arr1.dtype)
+		values = np.arange(info.min, info.max + 1, dtype=np.float64)
+		index = np.clip(((values - low)*scale).astype(np.int64), 0,
+			n_colours - 1)
+		lut_values = lut32[index]
+		if info.min == 0:
+			return lut_values[np.asarray(arr1)]
+		return lut_values[np.asarray(arr1).astype(np.int32) - info.min]
+
+	arr1 = np.asarray(arr1, dtype=np.float32)
+	index = (arr1 - np.float32(low))*np.float32(scale)
+	np.clip(index, 0, n_colours - 1, out=index)
+	index[np.isnan(index)] = 0
+	rgba = lut32[index.astype(np.intp)]
+	rgba[np.isnan(arr1)] = 0
+
+	return rgba
+
+
+
+
+
+# Return a function which colours in the tiles a plot is about to be sent (see
+# send_tiles in image_pyramid.py) with the palette and window. Only the tiles
+# actually being sent are coloured, so changing the window doesn't colour in
+# the rest of the image or the other levels of its pyramid.
+def create_tile_colouring(low, high, palette):
+
+	lut = create_lut(palette)
+
+	def colour(arr_tiles):
+		return apply_lut(arr_tiles, low, high, lut)
+
+	return colour
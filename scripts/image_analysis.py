@@ -1,42 +1,58 @@
 ################################################################################
 ############################## IMPORT LIBRARIES ################################
 
-# Might want this for line profiles?
-from scipy.ndimage import map_coordinates
-import math
-import random
-
-from easygui import diropenbox, fileopenbox
-
-# pandas and numpy for data manipulation
-import pandas as pd
+# numpy for data manipulation. (The column data sources are fed straight
+# from numpy arrays, which Bokeh sends as binary, rather than going through
+# pandas.)
 import numpy as np
 
-# datetime for setting up DateRangeSlider with generic values
-from datetime import date
-
 # functions from bokeh
 from bokeh.plotting import figure
-from bokeh.models import (CategoricalColorMapper, HoverTool, BoxZoomTool,
-	PanTool, WheelZoomTool, ResetTool, ColumnDataSource, Panel, CrosshairTool,
-	FuncTickFormatter, SingleIntervalTicker, LinearAxis, CustomJS,
-	DatetimeTickFormatter, BasicTickFormatter, NumeralTickFormatter, Arrow,
-	NormalHead, OpenHead, VeeHead, Label, PointDrawTool, Range1d, FileInput)
-from bokeh.models.widgets import (CheckboxGroup, Slider, RangeSlider,
-	Tabs, CheckboxButtonGroup, Dropdown, TableColumn, DataTable, Select,
-	DateRangeSlider)
-from bokeh.layouts import column, row, WidgetBox, layout
-from bokeh.palettes import Category20_16, turbo, Colorblind, Spectral11
-import bokeh.colors
-from bokeh.io import output_file, show
-from bokeh.transform import factor_cmap, factor_mark
-from bokeh.events import Pan, PlotEvent, MouseWheel
+from bokeh.models import (HoverTool, BoxZoomTool, PanTool, WheelZoomTool,
+	ResetTool, ColumnDataSource, Panel, CrosshairTool, PointDrawTool, Range1d,
+	FileInput, LinearColorMapper)
+from bokeh.models.widgets import (RangeSlider, Slider, Select, TableColumn,
+	DataTable, NumberFormatter, Button, Div)
+from bokeh.layouts import column, row
+from bokeh.palettes import Spectral11
 
 import base64
 import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# The image dictionaries (shared with batch_analysis.py)
+from scripts.image_data import create_dict_image, create_dict_upload
+
+# Dark/flat correction, filtering and background subtraction
+
+# Batch line profiles
+from scripts.profiles import (create_profs, get_profs, decimate_prof,
+	PROF_WEIGHTINGS)
+
+# FWHM, penumbra, flatness etc. of the profiles
+from scripts.profile_metrics import create_prof_metrics
+
+# Image pyramid used to only send the plots the part of the image they show
+from scripts.image_pyramid import send_tiles, get_image_range
+
+# Spot detection
+from scripts.spots import get_spots
+
+# Colouring the images in on the server
+from scripts.colour_mapping import create_tile_colouring
+
+# Statistics inside rectangles
+from scripts.roi_stats import create_roi_stats
+
+# Saving and loading the profiles and ROIs
+from scripts.sessions import (create_session, create_session_profiles,
+	create_session_rois, image_reference, read_session, write_session,
+	session_filelocation)
 
-# PIL for importing TIF file
-from PIL import Image
+# Timing and counting bytes sent
+from scripts.metrics import timed, count_bytes
 
 # https://discourse.bokeh.org/t/updating-image-or-figure-with-new-x-y-dw-dh/1971/4
 
@@ -55,77 +71,271 @@ class BoxZoom:
 					'y_range_end,': self.y_range_end}
 
 
-# Create a dictionary containing the image array
-def create_dict_image(filelocation):
+# Uploads are decoded on these threads so that a large image doesn't hold up
+# every other session on the server.
+UPLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+
+
+
+
+# Create the slider used to set the window. (The end has to be bigger than the
+# start or Bokeh complains so flat images get a range of 1.)
+def create_window_slider(image_low, image_high):
+
+	slider_window = RangeSlider(title='Window', start=image_low,
+		end=max(image_high, image_low + 1), value=(image_low, image_high),
+		step=max(image_high - image_low, 1)/1000, width=400)
+
+	return slider_window
+
+
+
+
 
-	# Read in image and turn into an array
-	arr1 = np.array(Image.open(filelocation))
-	# Flip the array because Bokeh reads the array in from the bottom left
-	# corner but the image
-	arr1 = np.flipud(arr1)
-	# Get the width and height of the array. Annoyingly pixels are accessed by
-	# (y,x) coordinates.
-	(dh1, dw1) = arr1.shape
+# Work out where to start the zoom box and the line profile. Both are centred
+# on the top left spot and sized to fit it. If there aren't any spots they
+# start in the bottom left corner.
+def create_starting_values(dict_image, dict_spots):
 
-	# Create a dictionary with this information
-	dict_image = {}
-	dict_image['image'] = [arr1]
-	dict_image['dh1'] = [dh1]
-	dict_image['dw1'] = [dw1]
+	if len(dict_spots['x']) == 0:
+		return BoxZoom(0, 100, 0, 100), 0, 100, 0, 100
 
-	return dict_image
+	(dh1, dw1) = (dict_image['dh1'][0], dict_image['dw1'][0])
+
+	# The top left spot is the one closest to (0, dh1) (remember the image is
+	# flipped).
+	i_spot = np.argmin(dict_spots['x'] + (dh1 - dict_spots['y']))
+	x_spot = dict_spots['x'][i_spot]
+	y_spot = dict_spots['y'][i_spot]
+	fwhm = max(dict_spots['fwhm_x'][i_spot], dict_spots['fwhm_y'][i_spot])
+
+	box_half = max(2*fwhm, 25)
+	box_zoom = BoxZoom(x_spot - box_half, x_spot + box_half,
+		y_spot - box_half, y_spot + box_half)
+
+	prof_half = 1.5*fwhm
+	x_prof_start = float(np.clip(x_spot - prof_half, 0, dw1 - 1))
+	x_prof_end = float(np.clip(x_spot + prof_half, 0, dw1 - 1))
+	y_prof_start = float(np.clip(y_spot - prof_half, 0, dh1 - 1))
+	y_prof_end = float(np.clip(y_spot + prof_half, 0, dh1 - 1))
+
+	return box_zoom, x_prof_start, x_prof_end, y_prof_start, y_prof_end
 
 
 
 
 
 # Create a profile
-def create_prof(dict_image, x_prof_start, x_prof_end, y_prof_start, y_prof_end):
-	# Calculate how long the line is (hypotenuse eqn.)
-	prof_length = math.sqrt((x_prof_start-x_prof_end)**2
-		+ (y_prof_start-y_prof_end)**2)
-	# Sample roughly every 0.1 pixels which should be plenty.
-	prof_sample = int(prof_length/0.1)
-	# Create a list of evenly spaced coordinates
-	x_prof_sample = np.linspace(x_prof_start, x_prof_end, prof_sample)
-	y_prof_sample = np.linspace(y_prof_start, y_prof_end, prof_sample)
-	# Create a list of pixel values at these coordinates (interpolating where
-	# needed). map_coordinates an interpolation thing. Come back to this later?
-	z_prof_sample = map_coordinates(dict_image['image'][0],
-		np.vstack((y_prof_sample, x_prof_sample)))
-	# Normalise to the max value in the profile
-	z_prof_sample = z_prof_sample*(100/(max(z_prof_sample)))
-	# Make it into a dictionary where 'x' is the 'length' dimension and 'y' is
-	# the pixel value.
-	dict_prof = {'x': list(range(0, len(z_prof_sample))), 'y': z_prof_sample}
-	# Turn it into a dataframe and return
-	df_prof = pd.DataFrame(dict_prof)
+@timed('create_prof')
+def create_prof(dict_image, x_prof_start, x_prof_end, y_prof_start, y_prof_end,
+	order=3, spacing=0.1, width=0, weighting='mean'):
+	# Sample roughly every 'spacing' pixels. The pixel values at these
+	# coordinates are interpolated (cubic spline by default) and
+	# normalised to the max value in the profile. This is just the batch
+	# version in profiles.py with a single line. If a width is given the
+	# profile is averaged across that many pixels either side of the line.
+	# (This is the profile the tab starts with, which is kept in the disk
+	# cache so it's there straight away next time.)
+	profs, n_samples = get_profs(dict_image['image'][0], x_prof_start,
+		x_prof_end, y_prof_start, y_prof_end, order=order, spacing=spacing,
+		width=width, weighting=weighting)
+	z_prof_sample = profs[0, :n_samples[0]]
+	# Make it into a dictionary where 'x' is the distance along the line (in
+	# pixels) and 'y' is the pixel value.
+	prof_length = np.hypot(x_prof_end - x_prof_start, y_prof_end - y_prof_start)
+	dict_prof = {'x': np.linspace(0, prof_length, len(z_prof_sample)),
+		'y': z_prof_sample}
 
-	# Also make a dataframe for the profile points
-	df_prof_points = pd.DataFrame({	'x': [x_prof_start, x_prof_end],
-									'y': [y_prof_start, y_prof_end]})
+	# Also make a dictionary for the profile points
+	dict_prof_points = {'x': np.array([x_prof_start, x_prof_end], dtype=float),
+		'y': np.array([y_prof_start, y_prof_end], dtype=float)}
 
-	return df_prof, df_prof_points
+	return dict_prof, dict_prof_points
 
 
 
 
 
-def ColorMapper(filelocation):
+# The corners of the zoom box (going round and back to the start) to draw on
+# the main plot
+def create_dict_zoombox(box_zoom):
 
-	############################################################################
-	############################## CHARMANDER ##################################
+	dict_zoombox = {}
+	dict_zoombox['x'] = np.array([box_zoom.x_range_start, box_zoom.x_range_end,
+		box_zoom.x_range_end, box_zoom.x_range_start, box_zoom.x_range_start],
+		dtype=float)
+	dict_zoombox['y'] = np.array([box_zoom.y_range_start,
+		box_zoom.y_range_start, box_zoom.y_range_end, box_zoom.y_range_end,
+		box_zoom.y_range_start], dtype=float)
+
+	return dict_zoombox
+
+
+
+
+
+# The statistics inside the zoom box, as a one row dictionary for the stats
+# table
+def create_dict_zoom_stats(dict_image, box_zoom):
+
+	dict_stats = create_roi_stats(dict_image, box_zoom.x_range_start,
+		box_zoom.x_range_end, box_zoom.y_range_start, box_zoom.y_range_end)
+
+	return dict_stats
+
+
+
+
+
+# The measurements (FWHM, penumbra etc., see profile_metrics.py) of a profile,
+# as a one row dictionary for the metrics table. The distances are in pixels.
+def create_dict_prof_metrics(z_prof_sample, x_prof_start, x_prof_end,
+	y_prof_start, y_prof_end):
+
+	n_samples = len(z_prof_sample)
+	step = np.hypot(x_prof_end - x_prof_start, y_prof_end - y_prof_start)/max(
+		n_samples - 1, 1)
+
+	return create_prof_metrics(z_prof_sample[None, :], [n_samples], step)
 
-	# Quick plot of charmander image to check file orientations are done
-	# correctly. Also later for fun.
-	file_charmander = 'O:\\protons\\Work in Progress\\Christian\\Python\\Graphing Code\\CB Version\\New Ideas\\Charmander.png'
-	arr_charmander=np.array(Image.open(file_charmander))
+
+# Columns for a table of profile metrics
+def create_columns_prof_metrics():
+
+	return [TableColumn(field='peak', title='Peak',
+			formatter=NumberFormatter(format='0.00')),
+		TableColumn(field='peak_position', title='Peak at',
+			formatter=NumberFormatter(format='0.00')),
+		TableColumn(field='fwhm', title='FWHM',
+			formatter=NumberFormatter(format='0.00')),
+		TableColumn(field='centre', title='Centre',
+			formatter=NumberFormatter(format='0.00')),
+		TableColumn(field='penumbra_left', title='Penumbra L',
+			formatter=NumberFormatter(format='0.00')),
+		TableColumn(field='penumbra_right', title='Penumbra R',
+			formatter=NumberFormatter(format='0.00')),
+		TableColumn(field='flatness', title='Flatness %',
+			formatter=NumberFormatter(format='0.00')),
+		TableColumn(field='symmetry', title='Symmetry %',
+			formatter=NumberFormatter(format='0.00'))]
+
+
+
+
+
+# How finely the profile in the ColorMapper is sampled (samples per pixel
+# along the line). 1 is the image's own resolution, which is plenty for the
+# metrics. However many samples there are the plot is only sent about two
+# points per pixel of its width (see decimate_prof), and the full resolution
+# only once it's zoomed in far enough to show them.
+PROF_SAMPLES_PER_PIXEL = ('1', '2', '5', '10')
+
+
+
+
+
+# How long (in ms) to wait to gather up point drag events before updating the
+# profile. About 2 frames at 60 Hz.
+PROF_DEBOUNCE_MS = 30
+
+
+
+
+
+# Create a callback which calls func at most once every debounce_ms. Dragging
+# the points fires a callback for every little movement. Rather than doing the
+# work every time, the first change schedules a call for debounce_ms later and
+# any changes before then are just picked up by that call (so the last
+# position is always the one used). Outside of a server (e.g. benchmarking)
+# there's nothing to schedule on so func is called straight away. model is any
+# model in the document.
+def debounced(model, func, debounce_ms=PROF_DEBOUNCE_MS):
+
+	scheduled = [False]
+
+	def run():
+
+		scheduled[0] = False
+		func()
+
+		return
+
+	def callback(attr, old, new):
+
+		doc = model.document
+		if debounce_ms <= 0 or doc is None or doc.session_context is None:
+			func()
+			return
+
+		if not scheduled[0]:
+			scheduled[0] = True
+			doc.add_timeout_callback(run, debounce_ms)
+
+		return
+
+	return callback
+
+
+
+
+
+# Charmander image used to check file orientations are done correctly. It's
+# only shown if SHOW_CHARMANDER is set (and the file can be found).
+FILE_CHARMANDER = 'O:\\protons\\Work in Progress\\Christian\\Python\\Graphing Code\\CB Version\\New Ideas\\Charmander.png'
+SHOW_CHARMANDER = False
+
+# Set this to True (or the IMAGE_ANALYSIS_SERVER_RENDER environment variable
+# to 1, or start main.py with --server-render) to colour the images in on the
+# server (see colour_mapping.py) rather than in the browser. The browser then
+# gets sent small RGBA images which is easier on thin clients.
+SERVER_RENDER = os.environ.get('IMAGE_ANALYSIS_SERVER_RENDER', '0') == '1'
+
+
+
+
+
+# Quick plot of charmander image to check file orientations are done
+# correctly. Also later for fun. Returns None if the image isn't there.
+def create_charmander_plot(filelocation=None):
+
+	if filelocation is None:
+		filelocation = FILE_CHARMANDER
+	if not os.path.isfile(filelocation):
+		return None
+
+	# PIL is only needed for this so it's imported here
+	from PIL import Image
+
+	arr_charmander=np.array(Image.open(filelocation).convert('RGBA'))
 	arr_charmander=np.flipud(arr_charmander)
 	p_charmander = figure()
 	p_charmander.plot_height = 400
 	p_charmander.plot_width = 400
 	p_charmander.image_rgba(image=[arr_charmander], x=[0], y=[0], dw=[1], dh=[1])
 
+	return p_charmander
+
+
+
+
+
+# If a watcher (see watch_folder.py) is given, each new image in the watched
+# folder is shown as soon as it's been analysed. The document the tab is going
+# into should be given as well so it stops watching when the session closes.
+def ColorMapper(filelocation, debounce_ms=PROF_DEBOUNCE_MS,
+	server_render=None, show_charmander=SHOW_CHARMANDER, watcher=None,
+	doc=None):
+
+	# (SERVER_RENDER unless it's given)
+	if server_render is None:
+		server_render = SERVER_RENDER
+
+	############################################################################
+	############################## CHARMANDER ##################################
+
+	p_charmander = create_charmander_plot() if show_charmander else None
+
 	############################################################################
 	############################################################################
 
@@ -140,8 +350,34 @@ def ColorMapper(filelocation):
 	# includes the image array
 	dict_image = create_dict_image(filelocation)
 
-	# Create the column data source
-	src_image = ColumnDataSource(dict_image)
+	# The full resolution image stays on the server (it's what the profiles
+	# are worked out from). The plots are only sent the tiles of the image
+	# pyramid they need for their current ranges (see image_pyramid.py), one
+	# column data source for each plot.
+	src_image = ColumnDataSource({'image': [], 'x': [], 'y': [], 'dw': [],
+		'dh': []}, name='src_image')
+	src_image_zoom = ColumnDataSource({'image': [], 'x': [], 'y': [], 'dw': [],
+		'dh': []}, name='src_image_zoom')
+
+	# Remember which tiles each plot has so they're only sent again when they
+	# change.
+	tile_keys = {}
+
+	# The window used to colour the images in. This starts as the full range of
+	# the image and is shared by both plots.
+	(image_low, image_high) = get_image_range(dict_image)
+	color_mapper = LinearColorMapper(palette=Spectral11, low=image_low,
+		high=image_high)
+
+	def update_tiles(fig, src):
+
+		if server_render:
+			send_tiles(fig, src, dict_image, tile_keys, create_tile_colouring(
+				color_mapper.low, color_mapper.high, Spectral11))
+		else:
+			send_tiles(fig, src, dict_image, tile_keys)
+
+		return
 
 
 	############################################################################
@@ -154,14 +390,15 @@ def ColorMapper(filelocation):
 	############################################################################
 	######################## SET SOME STARTING VALUES ##########################
 
+	# Find the spots in the image (see spots.py)
+	dict_spots = get_spots(dict_image)
+
 	# Set some values for the start and end x and y for the line profile we'll
  	# make later. (For simplicity we're going to plot a +ve diagonal over the
-	# topleft (tl) spot)
-	x_range_start = 0
-	x_range_end = 100
-	y_range_start = 0
-	y_range_end = 100
-	box_zoom = BoxZoom(x_range_start, x_range_end, y_range_start, y_range_end)
+	# topleft (tl) spot). If no spots could be found just use the bottom left
+	# corner.
+	(box_zoom, x_prof_start, x_prof_end, y_prof_start,
+		y_prof_end) = create_starting_values(dict_image, dict_spots)
 
 	############################################################################
 	############################################################################
@@ -177,20 +414,23 @@ def ColorMapper(filelocation):
 	# NB: It does some sort of interpolation between pixels that should probably
 	# be looked at in some more detail.
 
-	x_prof_start = 0
-	x_prof_end = 100
-	y_prof_start = 0
-	y_prof_end = 100
+	dict_prof, dict_prof_points = create_prof(dict_image, x_prof_start,
+		x_prof_end, y_prof_start, y_prof_end,
+		spacing=1/int(PROF_SAMPLES_PER_PIXEL[0]))
+	src_prof = ColumnDataSource({'x': [], 'y': []}, name='src_prof')
+	src_prof_points = ColumnDataSource(dict_prof_points,
+		name='src_prof_points')
 
-	df_prof, df_prof_points = create_prof(dict_image, x_prof_start, x_prof_end,
-		y_prof_start, y_prof_end)
-	src_prof = ColumnDataSource(df_prof.to_dict(orient='list'))
-	src_prof_points = ColumnDataSource(df_prof_points.to_dict(orient='list'))
+	# The whole profile is kept here on the server and the plot is only sent
+	# the part of it in view, cut down to the width of the plot
+	prof_full = dict(dict_prof)
+	prof_sent = [None]
 
-	# Create the profile plot
-	p_prof = figure()
+	# Create the profile plot (x is the distance along the line in pixels)
+	p_prof = figure(x_range=Range1d(0, max(prof_full['x'][-1], 1)))
 	p_prof.plot_height = 300
 	p_prof.plot_width = 800
+	p_prof.xaxis.axis_label = 'Distance along line (pixels)'
 	p_prof.line(source=src_prof, x='x', y='y')
 	# Add a couple of tools
 	p_prof.add_tools(CrosshairTool(), HoverTool(tooltips=[('X-Axis', '@x'),
@@ -204,6 +444,40 @@ def ColorMapper(filelocation):
 		columns=columns_prof_points, width=600, height=100, editable=True,
 		selectable='checkbox')
 
+	# Send the profile plot the part of the profile in view (and the same
+	# again either side so it can be panned a bit), with no more than about
+	# two points per pixel of the plot's width. Nothing is sent if it already
+	# has it.
+	def send_prof_plot():
+
+		(x_low, x_high) = (p_prof.x_range.start, p_prof.x_range.end)
+		if (prof_sent[0] is not None and prof_sent[0][0] is prof_full['y']
+			and prof_sent[0][1:] == (x_low, x_high)):
+			return
+		prof_sent[0] = (prof_full['y'], x_low, x_high)
+
+		span = max(x_high - x_low, 1e-9)
+		x_min = max(x_low - span, 0)
+		x_max = min(x_high + span, prof_full['x'][-1])
+		(x_plot, z_plot) = decimate_prof(prof_full['x'], prof_full['y'], x_min,
+			x_max, int(p_prof.plot_width*(x_max - x_min)/span) + 1)
+		dict_prof = {'x': x_plot, 'y': z_plot}
+		src_prof.data = dict_prof
+		count_bytes('src_prof', dict_prof)
+
+		return
+
+	send_prof_plot()
+
+	# The FWHM, penumbra etc. of the profile (distances in pixels along the
+	# line from the first point), kept up to date as it's moved
+	src_prof_metrics = ColumnDataSource(create_dict_prof_metrics(
+		dict_prof['y'], x_prof_start, x_prof_end, y_prof_start, y_prof_end),
+		name='src_prof_metrics')
+	datatable_prof_metrics = DataTable(source=src_prof_metrics,
+		columns=create_columns_prof_metrics(), width=800, height=60,
+		index_position=None)
+
 	############################################################################
 	############################################################################
 
@@ -220,11 +494,18 @@ def ColorMapper(filelocation):
 	# painted in.
 	p_main = figure(tools=[PanTool(), WheelZoomTool(),
 		BoxZoomTool(match_aspect=True), ResetTool()],
-		tooltips=[('x', '$x'), ('y', '$y'), ('value', '@image')],)
+		tooltips=[('x', '$x'), ('y', '$y'), ('value', '@image')],
+		x_range=Range1d(0, dict_image['dw1'][0]),
+		y_range=Range1d(0, dict_image['dh1'][0]), name='p_main')
 	p_main.plot_height = round(dict_image['dh1'][0]/2)
 	p_main.plot_width = round(dict_image['dw1'][0]/2)
-	p_main.image(source=src_image, image='image', x=0, y=0, dw='dw1', dh='dh1',
-		palette="Spectral11", level="image")
+	update_tiles(p_main, src_image)
+	if server_render:
+		p_main.image_rgba(source=src_image, image='image', x='x', y='y',
+			dw='dw', dh='dh', level="image")
+	else:
+		p_main.image(source=src_image, image='image', x='x', y='y', dw='dw',
+			dh='dh', color_mapper=color_mapper, level="image")
 
 	##### 2)
 	# Add the parts needed to make the line profile work (i.e. the line, some
@@ -239,17 +520,31 @@ def ColorMapper(filelocation):
 	##### 3)                                                                        Need to come back to this when decide how to draw the boxes
 	# Add the box on the main image that show the viewing ranges of the
 	# smaller one
-	dict_zoombox = {}
-	dict_zoombox['x'] = [box_zoom.x_range_start, box_zoom.x_range_end,
-		box_zoom.x_range_end, box_zoom.x_range_start, box_zoom.x_range_start]
-	dict_zoombox['y'] = [box_zoom.y_range_start, box_zoom.y_range_start,
-		box_zoom.y_range_end, box_zoom.y_range_end, box_zoom.y_range_start]
-
-	df_zoom = pd.DataFrame(dict_zoombox)
-	src_zoom = ColumnDataSource(df_zoom.to_dict(orient='list'))
+	src_zoom = ColumnDataSource(create_dict_zoombox(box_zoom))
 
 	p_main.line(source=src_zoom, x='x', y='y', line_width=2, color='firebrick')
 
+	##### 4)
+	# Mark the centre of each spot that was found and list their metrics in a
+	# table underneath.
+	src_spots = ColumnDataSource(dict_spots)
+	p_main.cross(source=src_spots, x='x', y='y', size=10, color='black')
+
+	columns_spots = [TableColumn(field='x', title='x-centroid',
+			formatter=NumberFormatter(format='0.00')),
+		TableColumn(field='y', title='y-centroid',
+			formatter=NumberFormatter(format='0.00')),
+		TableColumn(field='fwhm_x', title='FWHM x',
+			formatter=NumberFormatter(format='0.00')),
+		TableColumn(field='fwhm_y', title='FWHM y',
+			formatter=NumberFormatter(format='0.00')),
+		TableColumn(field='rotation', title='Rotation (deg)',
+			formatter=NumberFormatter(format='0.0')),
+		TableColumn(field='integral', title='Integral',
+			formatter=NumberFormatter(format='0,0'))]
+	datatable_spots = DataTable(source=src_spots, columns=columns_spots,
+		width=600, height=200)
+
 
 
 	############################################################################
@@ -258,7 +553,7 @@ def ColorMapper(filelocation):
 	# Initialise all the figures and put in a list to iterate over. Lock the
 	# aspect ratio of the box tool so it doesn't end up stretching the images.
 	p_zoom = figure(tools=[PanTool(), WheelZoomTool(),
-		BoxZoomTool(match_aspect=True), ResetTool()])
+		BoxZoomTool(match_aspect=True), ResetTool()], name='p_zoom')
 
 	# Set plot parameters and add glyphs and image
 	p_zoom.plot_height = round(400)
@@ -268,18 +563,63 @@ def ColorMapper(filelocation):
 	p_zoom.y_range.start = box_zoom.y_range_start
 	p_zoom.y_range.end = box_zoom.y_range_end
 
-	p_zoom.image(image='image', source=src_image, x=0, y=0, dw='dw1', dh='dh1',
-		palette='Spectral11', level='image')
+	update_tiles(p_zoom, src_image_zoom)
+	if server_render:
+		p_zoom.image_rgba(image='image', source=src_image_zoom, x='x', y='y',
+			dw='dw', dh='dh', level='image')
+	else:
+		p_zoom.image(image='image', source=src_image_zoom, x='x', y='y',
+			dw='dw', dh='dh', color_mapper=color_mapper, level='image')
 	p_zoom.line(source=src_prof_points, x='x', y='y', line_width=2,
 		color='black')
 	c1 = p_zoom.circle(source=src_prof_points, x='x', y='y', color='black',
 		fill_alpha=0.5, size=12)
 	p_zoom.add_tools(PointDrawTool(renderers=[c1], num_objects=2))
 
+	# Table of the statistics inside the zoomed in view, kept up to date as
+	# it's panned and zoomed
+	src_zoom_stats = ColumnDataSource(create_dict_zoom_stats(dict_image,
+		box_zoom), name='src_zoom_stats')
+	columns_zoom_stats = [TableColumn(field='mean', title='Mean',
+			formatter=NumberFormatter(format='0.00')),
+		TableColumn(field='std', title='Std',
+			formatter=NumberFormatter(format='0.00')),
+		TableColumn(field='min', title='Min',
+			formatter=NumberFormatter(format='0.00')),
+		TableColumn(field='max', title='Max',
+			formatter=NumberFormatter(format='0.00')),
+		TableColumn(field='integral', title='Integral',
+			formatter=NumberFormatter(format='0,0')),
+		TableColumn(field='pixels', title='Pixels')]
+	datatable_zoom_stats = DataTable(source=src_zoom_stats,
+		columns=columns_zoom_stats, width=600, height=60, index_position=None)
+
+
+
+
+	file_input = FileInput(accept='.bmp,.tif,.tiff', name='file_input')
 
+	# Saving the profile and the zoom box (and what's been worked out from
+	# them) to a session file on the server, and loading them back in from
+	# one (see sessions.py)
+	button_save = Button(label='Save session', width=150, name='button_save')
+	session_input = FileInput(accept='.npz', name='session_input')
+	div_session = Div(text='', width=600, name='div_session')
 
+	# Slider to set the window (the values the palette is spread over)
+	slider_window = create_window_slider(image_low, image_high)
 
-	file_input = FileInput(accept='.bmp')
+	# Width of the line profile (it's averaged across this many pixels) and
+	# how it's averaged
+	slider_width = Slider(title='Profile width (pixels)', start=0, end=20,
+		value=0, step=1, width=400, name='slider_width')
+	select_weighting = Select(title='Average across width',
+		value=PROF_WEIGHTINGS[0], options=list(PROF_WEIGHTINGS), width=200,
+		name='select_weighting')
+	# How finely the profile is sampled
+	select_samples = Select(title='Samples per pixel',
+		value=PROF_SAMPLES_PER_PIXEL[0], options=list(PROF_SAMPLES_PER_PIXEL),
+		width=150, name='select_samples')
 
 
 
@@ -288,8 +628,16 @@ def ColorMapper(filelocation):
 	############################################################################
 	############################## SET THE LAYOUT ##############################
 
-	column1 = column(row(p_charmander, p_zoom), p_prof, datatable_prof_points)
-	column2 = column(p_main, file_input)
+	if p_charmander is not None:
+		column1 = column(row(p_charmander, p_zoom), datatable_zoom_stats,
+			p_prof, row(slider_width, select_weighting, select_samples),
+			datatable_prof_metrics, datatable_prof_points)
+	else:
+		column1 = column(p_zoom, datatable_zoom_stats, p_prof,
+			row(slider_width, select_weighting, select_samples),
+			datatable_prof_metrics, datatable_prof_points)
+	column2 = column(p_main, slider_window, file_input,
+		row(button_save, session_input), div_session, datatable_spots)
 	layout = row(column1, column2)
 
 
@@ -301,19 +649,22 @@ def ColorMapper(filelocation):
 	# Might be that actually it's the rewritting of the display which is the
 	# rate determining step. So by keeping the loop to just rewriting the
 	# dictionary this might keep it quick enough?
+	@timed('callback_range')
 	def callback_range(attr, old, new):
 
 		box_zoom = BoxZoom(p_zoom.x_range.start, p_zoom.x_range.end,
 			p_zoom.y_range.start, p_zoom.y_range.end)
 
-		dict_zoombox['x'] = [box_zoom.x_range_start, box_zoom.x_range_end,
-			box_zoom.x_range_end, box_zoom.x_range_start, box_zoom.x_range_start]
-		dict_zoombox['y'] = [box_zoom.y_range_start, box_zoom.y_range_start,
-			box_zoom.y_range_end, box_zoom.y_range_end, box_zoom.y_range_start]
+		dict_zoombox = create_dict_zoombox(box_zoom)
+		src_zoom.data = dict_zoombox
+		count_bytes('src_zoom', dict_zoombox)
 
+		dict_zoom_stats = create_dict_zoom_stats(dict_image, box_zoom)
+		src_zoom_stats.data = dict_zoom_stats
+		count_bytes('src_zoom_stats', dict_zoom_stats)
 
-		df_zoom = pd.DataFrame(dict_zoombox)
-		src_zoom.data = df_zoom.to_dict(orient='list')
+		# Send the zoomed in view any new tiles it needs
+		update_tiles(p_zoom, src_image_zoom)
 
 		return
 
@@ -324,11 +675,32 @@ def ColorMapper(filelocation):
 	p_zoom.y_range.on_change('end', callback_range)
 
 
-	def callback_prof (attr, old, new):
+	# The main plot can be panned and zoomed too so it needs its tiles updating
+	# as well.
+	@timed('callback_range_main')
+	def callback_range_main(attr, old, new):
+
+		update_tiles(p_main, src_image)
+
+		return
+
+
+	p_main.x_range.on_change('start', callback_range_main)
+	p_main.x_range.on_change('end', callback_range_main)
+	p_main.y_range.on_change('start', callback_range_main)
+	p_main.y_range.on_change('end', callback_range_main)
+
+
+	# Work out the profile for wherever the points currently are and send it
+	# to the profile plot. The image comes from the dictionary held on the
+	# server, not back out of a column data source.
+	@timed('callback_prof')
+	def update_prof():
 
 		# I think src_prof.data already is a dictionary but just to make sure
 		dict_prof_points = src_prof_points.data
-		dict_image = src_image.data
+		if len(dict_prof_points['x']) != 2:
+			return
 
 		x_prof_start, x_prof_end = dict_prof_points['x']
 		y_prof_start, y_prof_end = dict_prof_points['y']
@@ -337,49 +709,273 @@ def ColorMapper(filelocation):
 		y_prof_start = float(y_prof_start)
 		y_prof_end = float(y_prof_end)
 
-		df_prof, df_prof_points = create_prof(dict_image, x_prof_start,
-			x_prof_end, y_prof_start, y_prof_end)
-
-		src_prof.data = df_prof.to_dict(orient='list')
+		profs, n_samples = create_profs(dict_image['image'][0], x_prof_start,
+			x_prof_end, y_prof_start, y_prof_end,
+			spacing=1/int(select_samples.value), width=slider_width.value,
+			weighting=select_weighting.value)
+		z_prof_sample = profs[0, :n_samples[0]]
+		prof_length = np.hypot(x_prof_end - x_prof_start,
+			y_prof_end - y_prof_start)
+		prof_full['x'] = np.linspace(0, prof_length, n_samples[0])
+		prof_full['y'] = z_prof_sample
+
+		# Show the whole of the new profile. However long the line is the
+		# plot is only sent about two points per pixel of its width.
+		p_prof.x_range.update(start=0, end=max(prof_length, 1), reset_start=0,
+			reset_end=max(prof_length, 1))
+		send_prof_plot()
+
+		dict_prof_metrics = create_dict_prof_metrics(z_prof_sample,
+			x_prof_start, x_prof_end, y_prof_start, y_prof_end)
+		src_prof_metrics.data = dict_prof_metrics
+		count_bytes('src_prof_metrics', dict_prof_metrics)
 
 		return
 
+
+	# Dragging the points fires this for every little movement so the updates
+	# are gathered up (see debounced above).
+	callback_prof = debounced(p_prof, update_prof, debounce_ms)
+
 	src_prof_points.on_change('data', callback_prof)
 	datatable_prof_points.on_change('source', callback_prof)
+	slider_width.on_change('value', callback_prof)
+	select_weighting.on_change('value', callback_prof)
+	select_samples.on_change('value', callback_prof)
+
+
+	# Zooming in (or panning) on the profile plot sends it the samples it now
+	# shows, at full resolution once there are few enough of them
+	@timed('callback_prof_range')
+	def update_prof_range():
+
+		send_prof_plot()
+
+		return
+
+
+	callback_prof_range = debounced(p_prof, update_prof_range, debounce_ms)
+
+	p_prof.x_range.on_change('start', callback_prof_range)
+	p_prof.x_range.on_change('end', callback_prof_range)
+
+
+
+	# Changing the window just moves the colour mapper's low and high (or, if
+	# the images are coloured in on the server, re-runs the look up table and
+	# sends the new tiles).
+	@timed('callback_window')
+	def update_window():
+
+		(low, high) = slider_window.value
+		if (low, high) == (color_mapper.low, color_mapper.high):
+			return
+		color_mapper.update(low=low, high=high)
 
+		if server_render:
+			tile_keys.clear()
+			update_tiles(p_main, src_image)
+			update_tiles(p_zoom, src_image_zoom)
 
+		return
+
+	slider_window.on_change('value', debounced(p_main, update_window,
+		debounce_ms))
+
+
+
+	# Swap a new image into the dictionary held on the server and send the
+	# plots their tiles of it.
+	@timed('callback_file_input')
+	def set_image(dict_image_new):
+
+		(dh_old, dw_old) = (dict_image['dh1'][0], dict_image['dw1'][0])
+		dict_image.update(dict_image_new)
+
+		# The main plot shows the whole image so if it's a different size it
+		# needs new ranges (including what the reset tool goes back to) and a
+		# new size
+		(dh1, dw1) = (dict_image['dh1'][0], dict_image['dw1'][0])
+		if (dh1, dw1) != (dh_old, dw_old):
+			p_main.x_range.update(start=0, end=dw1, reset_start=0,
+				reset_end=dw1)
+			p_main.y_range.update(start=0, end=dh1, reset_start=0,
+				reset_end=dh1)
+			p_main.update(plot_width=round(dw1/2), plot_height=round(dh1/2))
+
+		# Reset the window to the full range of the new image
+		(image_low, image_high) = get_image_range(dict_image)
+		color_mapper.update(low=image_low, high=image_high)
+		slider_window.update(start=image_low,
+			end=max(image_high, image_low + 1), value=(image_low, image_high))
+
+		tile_keys.clear()
+		update_tiles(p_main, src_image)
+		update_tiles(p_zoom, src_image_zoom)
+
+		src_spots.data = get_spots(dict_image)
+		count_bytes('src_spots', src_spots.data)
+
+		src_zoom_stats.data = create_dict_zoom_stats(dict_image, BoxZoom(
+			p_zoom.x_range.start, p_zoom.x_range.end, p_zoom.y_range.start,
+			p_zoom.y_range.end))
+
+		update_prof()
 
+		return
+
+	def set_image_from_future(future):
+
+		# This raises any error from decoding the image here, in the
+		# document's callback, so it shows up in the server log.
+		set_image(future.result())
+
+		return
+
+	# The upload is decoded on another thread and the plots are updated on the
+	# next tick of the IO loop once it's ready. Outside of a server there's no
+	# IO loop so it's all just done straight away.
 	def callback_file_input (attr, old, new):
 
-		decoded_image = base64.b64decode(file_input.value)
-		arr1 = np.array(Image.open(io.BytesIO(decoded_image)))
-		arr1 = np.flipud(arr1)
-		(dh1, dw1) = arr1.shape
+		# Nothing to do if the input has just been cleared
+		if not file_input.value:
+			return
 
-		dict_image = {}
-		dict_image['image'] = [arr1]
-		dict_image['dh1'] = [dh1]
-		dict_image['dw1'] = [dw1]
+		doc = file_input.document
+		if doc is None or doc.session_context is None:
+			set_image(create_dict_upload(file_input.value))
+			return
+
+		future = UPLOAD_EXECUTOR.submit(create_dict_upload, file_input.value)
+		future.add_done_callback(lambda future: doc.add_next_tick_callback(
+			partial(set_image_from_future, future)))
+
+		return
+
+	file_input.on_change('value', callback_file_input)
 
-		src_image.data = dict_image
+
+
+	# The profile (with its width, weighting and sampling) and the zoom box as
+	# they are now, with their results, as a session
+	def create_current_session(name):
 
 		dict_prof_points = src_prof_points.data
+		if len(dict_prof_points['x']) == 2:
+			(x_prof_start, x_prof_end) = dict_prof_points['x']
+			(y_prof_start, y_prof_end) = dict_prof_points['y']
+			profiles = create_session_profiles(x_prof_start, x_prof_end,
+				y_prof_start, y_prof_end, name=['profile'],
+				width=slider_width.value, weighting=select_weighting.value,
+				spacing=1/int(select_samples.value))
+		else:
+			profiles = create_session_profiles([], [], [], [])
+		rois = create_session_rois(p_zoom.x_range.start, p_zoom.x_range.end,
+			p_zoom.y_range.start, p_zoom.y_range.end, name=['zoom'])
+
+		return create_session(dict_image, profiles, rois, name)
+
+	@timed('callback_save_session')
+	def callback_save_session():
+
+		(content, image_name) = image_reference(dict_image)
+		filelocation = session_filelocation(image_name)
+		name = os.path.splitext(os.path.basename(filelocation))[0]
+		try:
+			write_session(filelocation, create_current_session(name))
+		except OSError as error:
+			div_session.text = 'Could not save the session: ' + str(error)
+			return
+		div_session.text = 'Saved the session to ' + filelocation
+
+		return
+
+	button_save.on_click(callback_save_session)
+
+	# Loading a session moves the profile and the zoom box back to where they
+	# were (and sets the width etc. of the profile), which then updates
+	# everything else as if they'd been moved by hand. If the file has more
+	# than one session in it the first is used.
+	def callback_session_input(attr, old, new):
+
+		if not session_input.value:
+			return
+
+		try:
+			session = read_session(io.BytesIO(base64.b64decode(
+				session_input.value)))
+		except Exception as error:
+			div_session.text = 'Could not load the session: ' + str(error)
+			return
+
+		i_prof = np.flatnonzero(session['prof_session'] == 0)
+		if len(i_prof):
+			i = i_prof[0]
+			slider_width.value = float(session['prof_width'][i])
+			select_weighting.value = str(session['prof_weighting'][i])
+			samples = str(int(round(1/session['prof_spacing'][i])))
+			if samples in PROF_SAMPLES_PER_PIXEL:
+				select_samples.value = samples
+			src_prof_points.data = {
+				'x': np.array([session['prof_x_start'][i],
+					session['prof_x_end'][i]], dtype=float),
+				'y': np.array([session['prof_y_start'][i],
+					session['prof_y_end'][i]], dtype=float)}
+
+		i_zoom = np.flatnonzero((session['roi_session'] == 0)
+			& (session['roi_name'] == 'zoom'))
+		if len(i_zoom):
+			i = i_zoom[0]
+			p_zoom.x_range.update(start=float(session['roi_x_start'][i]),
+				end=float(session['roi_x_end'][i]))
+			p_zoom.y_range.update(start=float(session['roi_y_start'][i]),
+				end=float(session['roi_y_end'][i]))
+
+		(content, image_name) = image_reference(dict_image)
+		div_session.text = ('Loaded the session saved from '
+			+ (str(session['image_name'][0]) or 'an upload'))
+		if str(session['image'][0]) != content:
+			div_session.text += ' (a different image to this one)'
+
+		return
+
+	session_input.on_change('value', callback_session_input)
 
-		x_prof_start, x_prof_end = dict_prof_points['x']
-		y_prof_start, y_prof_end = dict_prof_points['y']
-		x_prof_start = float(x_prof_start)
-		x_prof_end = float(x_prof_end)
-		y_prof_start = float(y_prof_start)
-		y_prof_end = float(y_prof_end)
 
-		df_prof, df_prof_points = create_prof(dict_image, x_prof_start,
-			x_prof_end, y_prof_start, y_prof_end)
 
-		src_prof.data = df_prof.to_dict(orient='list')
+	# New images from the watched folder have already been decoded and
+	# analysed on the watcher's threads so they're just swapped in on the
+	# next tick of the IO loop.
+	def show_watched_image(filelocation, dict_image_new):
+
+		set_image(dict_image_new)
+		p_main.title.text = os.path.basename(filelocation)
 
 		return
 
-	file_input.on_change('value', callback_file_input)
+	attached = [False]
+
+	def callback_watch(filelocation, dict_image_new):
+
+		document = p_main.document
+		if document is None or document.session_context is None:
+			# Either the session hasn't started yet or it's been closed (in
+			# which case stop watching)
+			return not attached[0]
+		attached[0] = True
+
+		document.add_next_tick_callback(partial(show_watched_image,
+			filelocation, dict_image_new))
+
+		return
+
+	if watcher is not None:
+		watcher.subscribe(callback_watch)
+		# Otherwise a session closed before any new image came in would never
+		# be let go of
+		if doc is not None:
+			doc.on_session_destroyed(lambda session_context:
+				watcher.unsubscribe(callback_watch))
 
 
 
@@ -0,0 +1,715 @@
+################################################################################
+############################## IMPORT LIBRARIES ################################
+
+import hashlib
+import mmap
+import os
+import re
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+# Memory-mapped loader for the images
+from scripts.image_loader import load_image
+
+################################################################################
+################################################################################
+
+# This is a process-wide cache of decoded images. Every ColorMapper tab (and
+# every browser session) that opens the same file gets handed the same array
+# so the image is only decoded and held in memory once. The arrays handed out
+# are read-only so one tab can't accidentally change the image for the others.
+
+# Maximum number of bytes of decoded images to keep. When this is exceeded the
+# least recently used images are dropped. (1 GB is plenty for a few dozen of
+# the Logos 4000 frames.) Only memory actually held by the cache counts, so
+# memory-mapped images (whose pages the OS can drop and read back whenever it
+# likes) count as nothing.
+CACHE_MAX_BYTES = 1024**3
+
+# Maximum number of images to keep, whatever their size. Every memory-mapped
+# image keeps its file open.
+CACHE_MAX_IMAGES = 256
+
+_cache = OrderedDict()
+# Bytes each cached image is charged (see resident_bytes). This includes
+# everything worked out from it (see get_derived).
+_cache_costs = {}
+# The buffers (see _buffer) already charged to each cached image, so a view of
+# something that's already been counted isn't counted again
+_cache_buffers = {}
+_cache_bytes = 0
+_cache_lock = threading.Lock()
+# One lock per file currently being decoded so two sessions opening the same
+# file at the same time don't both decode it.
+_loading_locks = {}
+
+# When the server runs several worker processes (see main.py) each one has its
+# own copy of the cache above. So that they don't each hold their own copy of
+# every image, decoded images and the big things worked out from them
+# (pyramids, spline coefficients) are also written once into a shared
+# directory (ideally in memory, e.g. /dev/shm) as .npy files which every
+# worker memory-maps. The OS then only keeps one copy. This is off (None)
+# unless set with set_shared_cache_dir or the IMAGE_ANALYSIS_SHARED_CACHE
+# environment variable.
+SHARED_CACHE_DIR = os.environ.get('IMAGE_ANALYSIS_SHARED_CACHE') or None
+
+# Maximum size of the shared directory. The oldest files are deleted when it's
+# exceeded (workers which already have them mapped can carry on using them).
+SHARED_CACHE_MAX_BYTES = 4*1024**3
+
+# Everything that goes into the shared directory (apart from DISK_CACHE_SKIP)
+# can also be kept on disk between runs, so that opening an image again (e.g.
+# yesterday's baseline) just maps the decoded image, pyramid, spots etc.
+# straight back in rather than working them out again. Files are named after a
+# hash of the image's contents, so it doesn't matter if the image has been
+# copied or renamed. This is on by default for the server (batch_analysis.py
+# only uses it if asked), and can be moved (or switched off with an empty
+# value) with set_disk_cache_dir or the IMAGE_ANALYSIS_CACHE environment
+# variable. When it's on it is also used as the shared directory.
+DEFAULT_DISK_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+	'image-analysis')
+DISK_CACHE_DIR = os.environ.get('IMAGE_ANALYSIS_CACHE',
+	DEFAULT_DISK_CACHE_DIR) or None
+
+# Maximum size of the disk cache. The least recently used files are deleted
+# when it's exceeded.
+DISK_CACHE_MAX_BYTES = 4*1024**3
+
+# Things (by the start of their name) which are never kept in the disk cache,
+# only in the shared directory if there is one. The summed-area tables and
+# spline coefficients are several times the size of the image (so would fill
+# the cache with a few images) but take well under a second to work out again.
+DISK_CACHE_SKIP = ('sat', 'spline')
+
+# Version of each thing that's cached (by the start of its name). Bump the
+# number when the code working one of them out changes, so that the old files
+# are no longer used (they're then deleted as the least recently used).
+# (image and stack: image_loader.py, level: image_pyramid.py, spline and prof:
+# profiles.py, sat: roi_stats.py, spots: spots.py, pre: preprocessing.py)
+CACHE_VERSIONS = {'image': 1, 'stack': 1, 'level': 1, 'spline': 1, 'sat': 1,
+	'spots': 1, 'prof': 1, 'pre': 1}
+
+# id of each cached image -> name used for it in the shared directory
+_shared_names = {}
+# image_key -> hash of the contents of the file
+_content_names = {}
+
+
+
+
+
+# The key is the full path plus the modification time and size so that if the
+# file is overwritten on disk it gets decoded again.
+def image_key(filelocation):
+
+	stat = os.stat(filelocation)
+
+	return (os.path.abspath(filelocation), stat.st_mtime_ns, stat.st_size)
+
+
+
+
+
+# Read in the image, turn it into an array and flip it because Bokeh reads the
+# array in from the bottom left corner. Uncompressed images are memory-mapped
+# rather than decoded (see image_loader.py). Compressed images are decoded
+# into the shared directory or disk cache (if there is one) so other workers,
+# and later runs, can map them. memory_map is passed on to load_image.
+def decode_image(filelocation, key=None, memory_map=None):
+
+	if cache_dir() is None:
+		return load_image(filelocation, memory_map)
+
+	if key is None:
+		key = image_key(filelocation)
+
+	def create():
+		arr1 = load_image(filelocation, memory_map)
+		# Uncompressed images are already mapped straight from the file (which
+		# the OS shares between processes) so there's no need for another copy
+		return None if is_file_backed(arr1) else arr1
+
+	arr1 = _shared_array(content_name(filelocation, key), 'image', create)
+	if arr1 is None:
+		arr1 = load_image(filelocation, memory_map)
+
+	return arr1
+
+
+
+
+
+# Return the decoded (and flipped) image, decoding it only if it isn't already
+# in the cache. memory_map says whether the file can be memory-mapped (see
+# image_loader.py) if it has to be read in. (An image already in the cache is
+# returned however it was read.)
+def get_image(filelocation, memory_map=None):
+
+	key = image_key(filelocation)
+
+	with _cache_lock:
+		arr1 = _lookup(key)
+		if arr1 is not None:
+			return arr1
+		loading_lock = _loading_locks.setdefault(key, threading.Lock())
+
+	with loading_lock:
+		# Someone else might have finished decoding it while we were waiting
+		with _cache_lock:
+			arr1 = _lookup(key)
+		if arr1 is None:
+			arr1 = decode_image(filelocation, key, memory_map)
+			arr1.setflags(write=False)
+			image_name = (content_name(filelocation, key)
+				if cache_dir() is not None else None)
+			with _cache_lock:
+				evicted = _store(key, arr1)
+				_register_shared(arr1, image_name)
+			# (The evicted images are only let go of once the lock has been
+			# released, see get_derived)
+			evicted.clear()
+
+	with _cache_lock:
+		_loading_locks.pop(key, None)
+
+	return arr1
+
+
+
+
+
+# Return the images stacked into one (N x H x W) array. The stack is kept in
+# the cache like a single image so it's only built once. All the images have
+# to be the same size.
+def get_stack(filelocations):
+
+	key = ('stack',) + tuple(image_key(f) for f in filelocations)
+
+	with _cache_lock:
+		stack = _lookup(key)
+	if stack is not None:
+		return stack
+
+	arrs = [get_image(f) for f in filelocations]
+	if len(set(arr1.shape for arr1 in arrs)) != 1:
+		raise ValueError('Images to compare must all be the same size: '
+			+ ', '.join(str(arr1.shape) for arr1 in arrs))
+	if cache_dir() is None:
+		stack = np.stack(arrs)
+		stack_name = None
+	else:
+		stack_name = shared_name(tuple(content_name(f) for f in
+			filelocations))
+		stack = _shared_array(stack_name, 'stack', lambda: np.stack(arrs))
+	stack.setflags(write=False)
+
+	with _cache_lock:
+		evicted = _store(key, stack)
+		_register_shared(stack, stack_name)
+	evicted.clear()
+
+	return stack
+
+
+
+
+
+# Empty the cache (mostly useful for testing or freeing memory)
+def clear_cache():
+
+	global _cache_bytes
+
+	with _cache_lock:
+		cleared = list(_cache.values())
+		_cache.clear()
+		_cache_costs.clear()
+		_cache_buffers.clear()
+		_cache_bytes = 0
+	cleared.clear()
+
+	return
+
+
+
+
+
+# Return the number of images and bytes currently held
+def cache_info():
+
+	with _cache_lock:
+		return {'images': len(_cache), 'bytes': _cache_bytes,
+			'max_bytes': CACHE_MAX_BYTES}
+
+
+
+
+
+# These two expect _cache_lock to already be held.
+def _lookup(key):
+
+	arr1 = _cache.get(key)
+	if arr1 is not None:
+		_cache.move_to_end(key)
+
+	return arr1
+
+
+# _store returns the images it evicts so the caller can drop them after
+# releasing the lock.
+def _store(key, arr1):
+
+	_cache[key] = arr1
+	_cache_costs[key] = 0
+	_cache_buffers[key] = set()
+	_register_root(arr1, (key, id(arr1)))
+	_charge(key, arr1)
+
+	return _evict()
+
+
+# Add the memory held by value (an array, or a list or dictionary of them) to
+# what a cached image is charged
+def _charge(key, value):
+
+	global _cache_bytes
+
+	for arr1 in _arrays_in(value):
+		buffer = _buffer(arr1)
+		if id(buffer) not in _cache_buffers[key]:
+			_cache_buffers[key].add(id(buffer))
+			cost = resident_bytes(arr1)
+			_cache_costs[key] += cost
+			_cache_bytes += cost
+
+	return
+
+
+# Evict the least recently used images (but never the most recently used one)
+# until the cache is back within its limits
+def _evict():
+
+	global _cache_bytes
+
+	evicted = []
+	while ((_cache_bytes > CACHE_MAX_BYTES or len(_cache) > CACHE_MAX_IMAGES)
+		and len(_cache) > 1):
+		old_key, old_arr = _cache.popitem(last=False)
+		_cache_bytes -= _cache_costs.pop(old_key)
+		del _cache_buffers[old_key]
+		evicted.append(old_arr)
+
+	return evicted
+
+
+
+
+
+# Whether an array is (ultimately) a view of a memory-mapped file
+def is_file_backed(arr1):
+
+	base = arr1
+	while base is not None:
+		if isinstance(base, mmap.mmap):
+			return True
+		base = getattr(base, 'base', None)
+
+	return False
+
+
+# Bytes of memory an array actually keeps hold of. For a view that's the whole
+# of what it's a view of.
+def resident_bytes(arr1):
+
+	if is_file_backed(arr1):
+		return 0
+
+	buffer = _buffer(arr1)
+
+	return buffer.nbytes if isinstance(buffer, np.ndarray) else len(buffer)
+
+
+# The array (or bytes) which actually holds an array's memory
+def _buffer(arr1):
+
+	while isinstance(arr1.base, np.ndarray):
+		arr1 = arr1.base
+
+	return arr1 if arr1.base is None else arr1.base
+
+
+# Every array in value (an array, or a list, tuple or dictionary of them)
+def _arrays_in(value):
+
+	if isinstance(value, np.ndarray):
+		return [value]
+	if isinstance(value, dict):
+		value = list(value.values())
+	if isinstance(value, (list, tuple)):
+		return [arr1 for item in value for arr1 in _arrays_in(item)]
+
+	return []
+
+
+
+
+
+# Things worked out from an image (pyramids, spline coefficients etc.) are
+# stored against the array they came from so every tab and session using that
+# array shares them. They're forgotten automatically when the array is.
+# Nothing stored here may hold on to the array itself (or it would never be
+# forgotten). If the array is (or was worked out from) a cached image, the
+# memory they hold is counted against that image, so CACHE_MAX_BYTES bounds
+# them too and they go when it's evicted.
+
+# The array can be let go of anywhere, including by a thread which already
+# holds _cache_lock (or at exit), so _forget_derived doesn't take the lock.
+# (A single dict.pop is atomic anyway.) Arrays evicted from the cache are
+# still only dropped after the lock is released.
+_derived = {}
+
+# id of each cached image, and of each array worked out from one -> key and id
+# of that cached image
+_roots = {}
+
+
+def get_derived(arr1, name, create):
+
+	key = (id(arr1), name)
+
+	with _cache_lock:
+		value = _derived.get(key)
+	if value is not None:
+		return value
+
+	value = create(arr1)
+
+	evicted = []
+	with _cache_lock:
+		if key not in _derived:
+			_derived[key] = value
+			weakref.finalize(arr1, _forget_derived, key)
+			evicted = _charge_derived(arr1, value)
+		value = _derived[key]
+	evicted.clear()
+
+	return value
+
+
+def _forget_derived(key):
+
+	_derived.pop(key, None)
+
+	return
+
+
+# These two expect _cache_lock to already be held. _charge_derived returns the
+# images it evicts, like _store.
+def _charge_derived(arr1, value):
+
+	root = _roots.get(id(arr1))
+	# (The image might have been evicted, or even replaced by a newer one)
+	if root is None or id(_cache.get(root[0])) != root[1]:
+		return []
+
+	for arr_value in _arrays_in(value):
+		_register_root(arr_value, root)
+	_charge(root[0], value)
+	_cache.move_to_end(root[0])
+
+	return _evict()
+
+
+def _register_root(arr1, root):
+
+	if id(arr1) not in _roots:
+		_roots[id(arr1)] = root
+		weakref.finalize(arr1, _roots.pop, id(arr1), None)
+
+	return
+
+
+
+
+
+################################################################################
+############################ SHARED DIRECTORY ##################################
+
+# Use (or stop using, with None) a shared directory for the decoded images
+def set_shared_cache_dir(directory):
+
+	global SHARED_CACHE_DIR
+
+	if directory is not None:
+		os.makedirs(directory, exist_ok=True)
+	SHARED_CACHE_DIR = directory
+	clear_cache()
+
+	return
+
+
+# Move (or stop using, with None) the disk cache
+def set_disk_cache_dir(directory):
+
+	global DISK_CACHE_DIR
+
+	DISK_CACHE_DIR = directory
+	clear_cache()
+
+	return
+
+
+
+
+
+# The directory things are shared through: the disk cache if it's on,
+# otherwise the shared directory (or None if neither is in use)
+def cache_dir():
+
+	return DISK_CACHE_DIR if DISK_CACHE_DIR is not None else SHARED_CACHE_DIR
+
+
+# The directory something (by name) is kept in, which is only ever the shared
+# directory for the things in DISK_CACHE_SKIP
+def _cache_dir_for(name):
+
+	if re.match('[a-z]*', name).group() in DISK_CACHE_SKIP:
+		return SHARED_CACHE_DIR
+
+	return cache_dir()
+
+
+
+
+
+# A hash of a key (e.g. the settings something was worked out with), the same
+# in every worker and every run
+def shared_name(key):
+
+	return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+
+
+
+# Name of an image in the shared directory. This is a hash of the contents of
+# the file. Working that out means reading the whole file so it's remembered
+# (in an index in the directory) against the file's path, modification time
+# and size. Saved sessions refer to their image by this too (see sessions.py).
+def content_name(filelocation, key=None):
+
+	if key is None:
+		key = image_key(filelocation)
+
+	with _cache_lock:
+		image_name = _content_names.get(key)
+	if image_name is not None:
+		return image_name
+
+	# (Without a cache directory it's only remembered in memory)
+	index = None
+	if cache_dir() is not None:
+		index = os.path.join(cache_dir(), 'index', shared_name(key))
+		try:
+			with open(index) as f:
+				image_name = f.read().strip()
+		except OSError:
+			pass
+
+	if not image_name:
+		digest = hashlib.sha1()
+		with open(filelocation, 'rb') as f:
+			for block in iter(lambda: f.read(1024**2), b''):
+				digest.update(block)
+		image_name = digest.hexdigest()
+		if index is not None:
+			_write_atomic(index, lambda f: f.write(image_name.encode()))
+
+	with _cache_lock:
+		_content_names[key] = image_name
+
+	return image_name
+
+
+
+
+
+# Return something worked out from a cached image (e.g. a pyramid level) from
+# the shared directory, working it out and writing it there first if no worker
+# (or earlier run) has yet. create is called with the image. Without a shared
+# directory (or for arrays which didn't come from the cache) this just calls
+# create.
+def get_shared(arr1, name, create):
+
+	with _cache_lock:
+		image_name = _shared_names.get(id(arr1))
+	if _cache_dir_for(name) is None or image_name is None:
+		return create(arr1)
+
+	return _shared_array(image_name, name, lambda: create(arr1))
+
+
+
+
+
+# The same as get_shared for things which are a dictionary of (small) arrays,
+# e.g. the spots or some profiles. These are read back in whole rather than
+# memory-mapped.
+def get_shared_dict(arr1, name, create):
+
+	with _cache_lock:
+		image_name = _shared_names.get(id(arr1))
+	if _cache_dir_for(name) is None or image_name is None:
+		return create(arr1)
+
+	filelocation = _cache_file(image_name, name, '.npz')
+	try:
+		with np.load(filelocation) as npz:
+			value = {key: npz[key] for key in npz.files}
+		_touch(filelocation)
+		return value
+	except (OSError, ValueError):
+		pass
+
+	value = create(arr1)
+	_write_atomic(filelocation, lambda f: np.savez(f, **value))
+	_trim_shared_dir(os.path.dirname(filelocation))
+
+	return value
+
+
+
+
+
+# Share the things worked out from an array which was itself worked out from a
+# cached image (e.g. the image after dark and flat correction) in the same way
+# as for the image. It's named after the image it came from plus name (and
+# its version, so bumping that means everything worked out from it is done
+# again too).
+def share_derived(arr_new, arr1, name):
+
+	with _cache_lock:
+		image_name = _shared_names.get(id(arr1))
+		if image_name is not None:
+			_register_shared(arr_new, image_name + '_' + _versioned(name))
+
+	return
+
+
+
+
+
+def _register_shared(arr1, image_name):
+
+	if image_name is not None and id(arr1) not in _shared_names:
+		_shared_names[id(arr1)] = image_name
+		weakref.finalize(arr1, _shared_names.pop, id(arr1), None)
+
+	return
+
+
+
+
+
+# Load an array from the shared directory or, if it's not there, create it
+# (create is called with no arguments and can return None to not share it),
+# write it there and load it back memory-mapped.
+def _shared_array(image_name, name, create):
+
+	filelocation = _cache_file(image_name, name, '.npy')
+
+	try:
+		arr1 = np.load(filelocation, mmap_mode='r')
+		_touch(filelocation)
+		return arr1
+	except (FileNotFoundError, ValueError):
+		pass
+
+	arr1 = create()
+	if arr1 is None:
+		return None
+
+	_write_atomic(filelocation, lambda f: np.save(f,
+		np.ascontiguousarray(arr1)))
+	_trim_shared_dir(os.path.dirname(filelocation))
+
+	return np.load(filelocation, mmap_mode='r')
+
+
+
+
+
+# Where something worked out from an image is kept. The version of the code
+# that worked it out is part of the name.
+def _cache_file(image_name, name, extension):
+
+	return os.path.join(_cache_dir_for(name), image_name + '_'
+		+ _versioned(name) + extension)
+
+
+def _versioned(name):
+
+	version = CACHE_VERSIONS.get(re.match('[a-z]*', name).group(), 1)
+
+	return name + '_v' + str(version)
+
+
+
+
+
+# Write a file under a temporary name and then rename it so other workers
+# never see half a file. If two workers write it at the same time the last one
+# to finish wins, which is fine as they're the same. write is called with the
+# open file.
+def _write_atomic(filelocation, write):
+
+	os.makedirs(os.path.dirname(filelocation), exist_ok=True)
+	temp = filelocation + '.' + str(os.getpid()) + '.' + str(
+		threading.get_ident()) + '.tmp'
+	with open(temp, 'wb') as f:
+		write(f)
+	os.replace(temp, filelocation)
+
+	return
+
+
+
+
+
+# Mark a file as just used so it's the last to be deleted
+def _touch(filelocation):
+
+	try:
+		os.utime(filelocation)
+	except OSError:
+		pass
+
+	return
+
+
+
+
+
+# Delete the least recently used files once the shared directory (or disk
+# cache) is too big
+def _trim_shared_dir(directory):
+
+	max_bytes = (DISK_CACHE_MAX_BYTES if directory == DISK_CACHE_DIR
+		else SHARED_CACHE_MAX_BYTES)
+
+	entries = [entry for entry in os.scandir(directory)
+		if entry.name.endswith(('.npy', '.npz'))]
+	entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+	# (The newest file is always kept, it's the one that was just written)
+	total = entries[0].stat().st_size if entries else 0
+	for entry in entries[1:]:
+		total += entry.stat().st_size
+		if total > max_bytes:
+			try:
+				os.remove(entry.path)
+			except OSError:
+				pass
+
+	return
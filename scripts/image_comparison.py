@@ -0,0 +1,296 @@
+################################################################################
+############################## IMPORT LIBRARIES ################################
+
+import os
+import weakref
+
+import numpy as np
+
+# functions from bokeh
+from bokeh.plotting import figure
+from bokeh.models import (HoverTool, BoxZoomTool, PanTool, WheelZoomTool,
+	ResetTool, ColumnDataSource, Panel, CrosshairTool, PointDrawTool, Range1d,
+	LinearColorMapper)
+from bokeh.models.widgets import TableColumn, DataTable, Select, Slider
+from bokeh.layouts import column, row
+from bokeh.palettes import Category10_10, Spectral11
+
+from scripts.image_cache import get_stack, get_derived
+from scripts.preprocessing import get_preprocessed
+from scripts.image_pyramid import send_tiles, get_image_range
+from scripts.profiles import create_stack_profs, PROF_WEIGHTINGS
+from scripts.spots import get_spots
+from scripts.profile_metrics import create_prof_metrics
+from scripts.metrics import timed, count_bytes
+from scripts.image_analysis import (create_starting_values, debounced,
+	create_columns_prof_metrics, PROF_DEBOUNCE_MS)
+
+################################################################################
+################################################################################
+
+# Tab for comparing several images (e.g. a daily image against a baseline).
+# The images are loaded once into a single (N x H x W) stack and everything
+# shown is worked out from that: each image, the difference and ratio of each
+# image to the first one (the baseline) and a line profile through all of the
+# images at once.
+
+
+
+
+
+# The images of each stack handed out by create_dict_view. These are views of
+# the stack so they can't be kept with it (see get_derived in image_cache.py,
+# the stack would never be let go of) and are only kept while something is
+# using them.
+_stack_views = weakref.WeakValueDictionary()
+
+
+# Create a dictionary (in the same form as create_dict_image) for one of the
+# views of the stack. Views 0 to N-1 are the images themselves, then the
+# differences to the baseline, then the ratios. Each view is only worked out
+# once per stack and shared.
+def create_dict_view(stack, i_view):
+
+	n_images = stack.shape[0]
+
+	if i_view < n_images:
+		key = (id(stack), i_view)
+		arr1 = _stack_views.get(key)
+		if arr1 is None:
+			arr1 = stack[i_view]
+			_stack_views[key] = arr1
+		return create_dict_view_image(arr1)
+	elif i_view < 2*n_images - 1:
+		i_image = i_view - n_images + 1
+		def create(stack):
+			return np.subtract(stack[i_image], stack[0], dtype=np.float32)
+	else:
+		i_image = i_view - 2*n_images + 2
+		def create(stack):
+			with np.errstate(divide='ignore', invalid='ignore'):
+				arr_ratio = np.divide(stack[i_image], stack[0],
+					dtype=np.float32)
+			arr_ratio[~np.isfinite(arr_ratio)] = np.nan
+			return arr_ratio
+
+	return create_dict_view_image(get_derived(stack, 'view' + str(i_view),
+		create))
+
+
+# The dictionary for one view
+def create_dict_view_image(arr1):
+
+	(dh1, dw1) = arr1.shape
+
+	dict_image = {}
+	dict_image['image'] = [arr1]
+	dict_image['dh1'] = [dh1]
+	dict_image['dw1'] = [dw1]
+
+	return dict_image
+
+
+
+
+
+def ImageComparison(filelocations, debounce_ms=PROF_DEBOUNCE_MS):
+
+	############################################################################
+	######################### START CREATING DATASETS ##########################
+
+	# Load all the images into one stack (this is cached so it's only done
+	# once however many sessions are comparing the same images), with any
+	# preprocessing applied to all of them at once
+	stack = get_preprocessed(get_stack(filelocations))
+	n_images = stack.shape[0]
+	names = [os.path.basename(filelocation) for filelocation in filelocations]
+
+	view_names = list(names)
+	view_names += ['Difference: ' + name + ' - ' + names[0]
+		for name in names[1:]]
+	view_names += ['Ratio: ' + name + ' / ' + names[0] for name in names[1:]]
+
+	dict_image = create_dict_view(stack, 0)
+
+	# The plot is only sent the tiles of the image pyramid it needs
+	src_image = ColumnDataSource({'image': [], 'x': [], 'y': [], 'dw': [],
+		'dh': []}, name='src_comparison_image')
+	tile_keys = {}
+
+	# Colour each view over its full range (the tiles are sent separately so
+	# the browser can't work this out itself)
+	(image_low, image_high) = get_image_range(dict_image)
+	color_mapper = LinearColorMapper(palette=Spectral11, low=image_low,
+		high=image_high)
+
+	############################################################################
+	############################################################################
+
+
+
+
+
+	############################################################################
+	######################### WORK OUT THE PROFILES ############################
+
+	# Start on the top left spot of the baseline image
+	(box_zoom, x_prof_start, x_prof_end, y_prof_start,
+		y_prof_end) = create_starting_values(dict_image, get_spots(dict_image))
+
+	src_prof_points = ColumnDataSource({'x': [x_prof_start, x_prof_end],
+		'y': [y_prof_start, y_prof_end]})
+	src_prof = ColumnDataSource({'x': []})
+
+	# Create the profile plot with one line for each image
+	p_prof = figure()
+	p_prof.plot_height = 300
+	p_prof.plot_width = 800
+	for i_image, name in enumerate(names):
+		p_prof.line(source=src_prof, x='x', y='y' + str(i_image),
+			color=Category10_10[i_image % 10], legend_label=name)
+	p_prof.add_tools(CrosshairTool(), HoverTool(tooltips=[('X-Axis', '@x'),
+		('Y-Axis', '$y')], mode='hline', line_policy='nearest'))
+
+	columns_prof_points = [TableColumn(field='x', title='x-position', width = 100),
+		TableColumn(field='y', title='y-position', width = 100)]
+	datatable_prof_points = DataTable(source=src_prof_points,
+		columns=columns_prof_points, width=600, height=100, editable=True,
+		selectable='checkbox')
+
+	# Width of the line profile and how it's averaged, as in the ColorMapper
+	# tab
+	slider_width = Slider(title='Profile width (pixels)', start=0, end=20,
+		value=0, step=1, width=400, name='slider_comparison_width')
+	select_weighting = Select(title='Average across width',
+		value=PROF_WEIGHTINGS[0], options=list(PROF_WEIGHTINGS), width=200,
+		name='select_comparison_weighting')
+
+	# The FWHM, penumbra etc. of the profile through each image
+	src_prof_metrics = ColumnDataSource({'image': []},
+		name='src_comparison_prof_metrics')
+	datatable_prof_metrics = DataTable(source=src_prof_metrics,
+		columns=[TableColumn(field='image', title='Image')]
+		+ create_columns_prof_metrics(), width=800,
+		height=30 + 25*n_images, index_position=None)
+
+	############################################################################
+	############################################################################
+
+
+
+
+
+	############################################################################
+	########################### CREATE THE MAIN PLOT ###########################
+
+	p_main = figure(tools=[PanTool(), WheelZoomTool(),
+		BoxZoomTool(match_aspect=True), ResetTool()],
+		tooltips=[('x', '$x'), ('y', '$y'), ('value', '@image')],
+		x_range=Range1d(0, dict_image['dw1'][0]),
+		y_range=Range1d(0, dict_image['dh1'][0]))
+	p_main.plot_height = round(dict_image['dh1'][0]/2)
+	p_main.plot_width = round(dict_image['dw1'][0]/2)
+	send_tiles(p_main, src_image, dict_image, tile_keys)
+	p_main.image(source=src_image, image='image', x='x', y='y', dw='dw',
+		dh='dh', color_mapper=color_mapper, level="image")
+
+	p_main.line(source=src_prof_points, x='x', y='y', line_width=2,
+		color='black')
+	c1 = p_main.circle(source=src_prof_points, x='x', y='y', color='black',
+		fill_alpha=0.5, size=12)
+	p_main.add_tools(PointDrawTool(renderers=[c1], num_objects=2))
+
+	# Choose which image (or difference/ratio) to show
+	select_view = Select(title='Show', value=view_names[0],
+		options=view_names)
+
+	############################################################################
+	############################## SET THE LAYOUT ##############################
+
+	column1 = column(p_prof, row(slider_width, select_weighting),
+		datatable_prof_metrics, datatable_prof_points)
+	column2 = column(select_view, p_main)
+	layout = row(column1, column2)
+
+	############################################################################
+	############################################################################
+
+
+
+	# Work out the profile through every image in one go
+	@timed('callback_comparison_prof')
+	def update_prof():
+
+		dict_prof_points = src_prof_points.data
+		if len(dict_prof_points['x']) != 2:
+			return
+
+		x_prof_start, x_prof_end = dict_prof_points['x']
+		y_prof_start, y_prof_end = dict_prof_points['y']
+
+		profs, n_samples = create_stack_profs(stack, float(x_prof_start),
+			float(x_prof_end), float(y_prof_start), float(y_prof_end),
+			width=slider_width.value, weighting=select_weighting.value)
+
+		# The x axis is the distance along the line (in pixels), the same as
+		# batch_analysis.py
+		prof_length = np.hypot(float(x_prof_end) - float(x_prof_start),
+			float(y_prof_end) - float(y_prof_start))
+		dict_prof = {'x': np.linspace(0, prof_length, n_samples[0])}
+		for i_image in range(n_images):
+			dict_prof['y' + str(i_image)] = profs[i_image, 0, :n_samples[0]]
+		src_prof.data = dict_prof
+		count_bytes('src_comparison_prof', dict_prof)
+
+		# All the images' profiles at once
+		step = np.hypot(float(x_prof_end) - float(x_prof_start),
+			float(y_prof_end) - float(y_prof_start))/max(n_samples[0] - 1, 1)
+		dict_prof_metrics = create_prof_metrics(profs[:, 0, :n_samples[0]],
+			np.full(n_images, n_samples[0]), step)
+		dict_prof_metrics['image'] = names
+		src_prof_metrics.data = dict_prof_metrics
+		count_bytes('src_comparison_prof_metrics', dict_prof_metrics)
+
+		return
+
+	update_prof()
+
+	callback_prof = debounced(p_prof, update_prof, debounce_ms)
+	src_prof_points.on_change('data', callback_prof)
+	slider_width.on_change('value', callback_prof)
+	select_weighting.on_change('value', callback_prof)
+
+
+
+	@timed('callback_comparison_range')
+	def callback_range(attr, old, new):
+
+		send_tiles(p_main, src_image, dict_image, tile_keys)
+
+		return
+
+	p_main.x_range.on_change('start', callback_range)
+	p_main.x_range.on_change('end', callback_range)
+	p_main.y_range.on_change('start', callback_range)
+	p_main.y_range.on_change('end', callback_range)
+
+
+
+	@timed('callback_comparison_view')
+	def callback_view(attr, old, new):
+
+		dict_image.update(create_dict_view(stack,
+			view_names.index(select_view.value)))
+		(image_low, image_high) = get_image_range(dict_image)
+		color_mapper.update(low=image_low, high=image_high)
+		send_tiles(p_main, src_image, dict_image, tile_keys)
+
+		return
+
+	select_view.on_change('value', callback_view)
+
+
+
+	# Return the panel
+
+	return Panel(child = layout, title = 'Comparison')
@@ -0,0 +1,88 @@
+################################################################################
+############################## IMPORT LIBRARIES ################################
+
+import base64
+import hashlib
+
+# Process-wide cache of decoded images
+from scripts.image_cache import get_image
+from scripts.image_loader import load_image_bytes
+
+# Dark/flat correction, filtering and background subtraction
+from scripts.preprocessing import get_preprocessed
+
+# Things worked out from each image
+from scripts.image_pyramid import get_pyramid
+from scripts.profiles import prefilter_image
+from scripts.spots import get_spots
+
+# Timing
+from scripts.metrics import timed
+
+################################################################################
+################################################################################
+
+# The image dictionaries the tabs and the batch analysis work from. These
+# don't need Bokeh, so batch_analysis.py (and anything else without a user
+# interface) imports them from here rather than from the tab scripts.
+
+
+
+
+
+# Create a dictionary containing the image array. memory_map is passed on to
+# get_image (e.g. the folder watcher reads the detectors' images straight in
+# rather than mapping them, see watch_folder.py).
+@timed('create_dict_image')
+def create_dict_image(filelocation, memory_map=None):
+
+	# Get the image array from the cache (this reads it in, turns it into an
+	# array and flips it the first time because Bokeh reads the array in from
+	# the bottom left corner). Every tab and session opening the same file
+	# shares this one read-only array. Any preprocessing (see
+	# preprocessing.py) is also only done once and shared.
+	arr1 = get_preprocessed(get_image(filelocation, memory_map))
+	# Get the width and height of the array. Annoyingly pixels are accessed by
+	# (y,x) coordinates.
+	(dh1, dw1) = arr1.shape
+
+	# Create a dictionary with this information
+	dict_image = {}
+	dict_image['image'] = [arr1]
+	dict_image['dh1'] = [dh1]
+	dict_image['dw1'] = [dw1]
+	# Where it came from (the hash of the contents is only worked out if the
+	# session is saved, see sessions.py)
+	dict_image['file'] = [filelocation]
+	dict_image['content'] = [None]
+
+	return dict_image
+
+
+
+
+
+# Create a dictionary containing the image array from a FileInput upload (which
+# is base64 encoded). The array points straight at the decoded bytes where
+# possible. Everything that's worked out from the image (pyramid, spots, spline
+# coefficients) is done here as well so none of it has to happen on the IO
+# loop.
+@timed('decode_upload')
+def create_dict_upload(value):
+
+	data = base64.b64decode(value)
+	arr1 = get_preprocessed(load_image_bytes(data))
+	(dh1, dw1) = arr1.shape
+
+	dict_image = {}
+	dict_image['image'] = [arr1]
+	dict_image['dh1'] = [dh1]
+	dict_image['dw1'] = [dw1]
+	dict_image['file'] = [None]
+	dict_image['content'] = [hashlib.sha1(data).hexdigest()]
+
+	get_pyramid(dict_image)
+	get_spots(dict_image)
+	prefilter_image(arr1)
+
+	return dict_image
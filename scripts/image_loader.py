@@ -0,0 +1,200 @@
+################################################################################
+############################## IMPORT LIBRARIES ################################
+
+import io
+import os
+import sys
+
+import numpy as np
+
+# PIL for importing TIF file
+from PIL import Image
+
+################################################################################
+################################################################################
+
+# Loader for the Logos images which avoids decoding the whole frame where it
+# can. Uncompressed TIFF, BMP and raw scintillator frames just store the pixel
+# values one row after another, so rather than decoding them with PIL (and then
+# copying them again when flipping) the file is memory-mapped and turned into a
+# numpy array that points straight at it. Only the pages that a plot or profile
+# actually reads ever get loaded into memory.
+
+# On Windows a file can't be overwritten or deleted while it's memory-mapped,
+# and the image cache keeps the arrays (and so the maps) open, which would stop
+# the detector software writing the next frame over the old one. So there the
+# pixels are read into memory in one go instead (still without decoding them
+# with PIL). Set IMAGE_ANALYSIS_MMAP to 1 or 0 to choose either way.
+MEMORY_MAP = os.environ.get('IMAGE_ANALYSIS_MMAP',
+	'0' if sys.platform == 'win32' else '1') == '1'
+
+# PIL raw modes which map directly onto a numpy data type. Anything else (RGB,
+# compressed, 1 bit etc.) goes through the normal PIL decode.
+RAWMODE_DTYPES = {
+	'L': 'u1',
+	'P': 'u1',
+	'I;8': 'u1',
+	'I;16': '<u2',
+	'I;16L': '<u2',
+	'I;16B': '>u2',
+	'I;16N': '=u2',
+	'I;16S': '<i2',
+	'I;16BS': '>i2',
+	'I;32': '<u4',
+	'I;32S': '<i4',
+	'I;32BS': '>i4',
+	'I': '=i4',
+	'F;32F': '<f4',
+	'F;32BF': '>f4',
+	'F': '=f4',
+	'F;64F': '<f8',
+	'F;64BF': '>f8',
+}
+
+# Data type of headerless .raw frames (the scintillator frames are 16 bit)
+RAW_DTYPE = '<u2'
+
+
+
+
+
+# Work out where the pixel data sits in an uncompressed image. Returns the
+# offset, row stride (in bytes), dtype, shape and whether the rows are stored
+# bottom-up, or None if the image can't be mapped directly.
+def raw_layout(img):
+
+	tiles = img.tile
+	if not tiles:
+		return None
+
+	# Every tile (strip) has to be raw, full width and one after another in the
+	# file. Pillow reports tiles as (decoder, extents, offset, args).
+	decoder, extents, offset, args = tiles[0]
+	if decoder != 'raw' or not isinstance(args, tuple) or len(args) < 3:
+		return None
+	rawmode, stride, orientation = args[:3]
+	if rawmode not in RAWMODE_DTYPES:
+		return None
+
+	dtype = np.dtype(RAWMODE_DTYPES[rawmode])
+	(width, height) = img.size
+	if stride == 0:
+		stride = width*dtype.itemsize
+
+	next_offset = offset
+	for (tile_decoder, tile_extents, tile_offset, tile_args) in tiles:
+		(x0, y0, x1, y1) = tile_extents
+		if (tile_decoder != 'raw' or tile_args[:3] != args[:3] or x0 != 0
+			or x1 != width or tile_offset != next_offset):
+			return None
+		next_offset = tile_offset + (y1 - y0)*stride
+
+	if next_offset - offset < height*stride:
+		return None
+
+	return offset, stride, dtype, (height, width), orientation == -1
+
+
+
+
+
+# Build a (flipped) array on top of a buffer (a memmap or bytes) using the
+# layout worked out above. The flip is just a view so nothing is copied.
+def array_from_layout(buffer, layout):
+
+	offset, stride, dtype, (height, width), bottom_up = layout
+
+	arr1 = np.ndarray((height, width), dtype=dtype, buffer=buffer,
+		offset=offset, strides=(stride, dtype.itemsize))
+
+	# If the pixels don't start on a multiple of their size (e.g. some float
+	# TIFFs) scipy would have to copy the whole image every time it reads it,
+	# so just copy it once now.
+	if not arr1.flags.aligned:
+		arr1 = np.array(arr1)
+		arr1.setflags(write=False)
+
+	# Bokeh reads the array in from the bottom left corner. BMPs are already
+	# stored bottom row first so these don't need flipping.
+	if not bottom_up:
+		arr1 = arr1[::-1]
+
+	return arr1
+
+
+
+
+
+# Memory-map (or read, see MEMORY_MAP) a headerless raw frame. If no shape is
+# given the frame is assumed to be square. memory_map overrides MEMORY_MAP if
+# it's given.
+def load_raw(filelocation, shape=None, dtype=RAW_DTYPE, offset=0,
+	memory_map=None):
+
+	dtype = np.dtype(dtype)
+	if shape is None:
+		n_pixels = (os.path.getsize(filelocation) - offset)//dtype.itemsize
+		side = int(round(np.sqrt(n_pixels)))
+		if side*side != n_pixels:
+			raise ValueError('Cannot work out the size of raw frame '
+				+ str(filelocation) + '. Please give the shape.')
+		shape = (side, side)
+
+	if memory_map is None:
+		memory_map = MEMORY_MAP
+
+	if memory_map:
+		arr1 = np.memmap(filelocation, dtype=dtype, mode='r', offset=offset,
+			shape=shape)
+	else:
+		arr1 = np.fromfile(filelocation, dtype=dtype,
+			count=int(np.prod(shape)), offset=offset).reshape(shape)
+		arr1.setflags(write=False)
+
+	return arr1[::-1]
+
+
+
+
+
+# Load an image as a flipped array, memory-mapping it (or reading it straight
+# in, see MEMORY_MAP, which memory_map overrides if it's given) where possible
+# and falling back to decoding it with PIL.
+def load_image(filelocation, memory_map=None):
+
+	if memory_map is None:
+		memory_map = MEMORY_MAP
+
+	if os.path.splitext(filelocation)[1].lower() == '.raw':
+		return load_raw(filelocation, memory_map=memory_map)
+
+	# Opening the image only reads the header, the pixels aren't decoded yet.
+	with Image.open(filelocation) as img:
+		layout = raw_layout(img)
+		if layout is None:
+			arr1 = np.array(img)
+			return np.flipud(arr1)
+
+	if memory_map:
+		buffer = np.memmap(filelocation, dtype=np.uint8, mode='r')
+	else:
+		with open(filelocation, 'rb') as f:
+			buffer = f.read()
+
+	return array_from_layout(buffer, layout)
+
+
+
+
+
+# Load an image that's already in memory (e.g. an upload). Uncompressed images
+# are turned into an array pointing straight at the bytes so no copy is made.
+def load_image_bytes(buffer):
+
+	with Image.open(io.BytesIO(buffer)) as img:
+		layout = raw_layout(img)
+		if layout is None:
+			arr1 = np.array(img)
+			return np.flipud(arr1)
+
+	return array_from_layout(buffer, layout)
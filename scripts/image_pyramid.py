@@ -0,0 +1,174 @@
+################################################################################
+############################## IMPORT LIBRARIES ################################
+
+import math
+
+import numpy as np
+
+# Shared store for things worked out from an image
+from scripts.image_cache import get_derived, get_shared
+from scripts.metrics import count_bytes
+
+################################################################################
+################################################################################
+
+# Multi-resolution (mipmap) pyramid of an image. Level 0 is the image itself
+# and every level after that is half the size of the one before. Rather than
+# sending the whole full resolution image to the browser, the plots are only
+# sent the part of the level that matches how far they are zoomed in, cut on a
+# grid of tiles so small pans don't need anything new sending at all.
+
+TILE_SIZE = 256
+
+
+
+
+
+# Halve the size of an image by averaging each 2x2 block of pixels. An odd last
+# row/column is dropped so every level lines up exactly with level 0.
+def downsample(arr1):
+
+	(dh1, dw1) = arr1.shape[:2]
+	dh2 = dh1//2
+	dw2 = dw1//2
+	arr2 = np.asarray(arr1[:dh2*2, :dw2*2], dtype=np.float32)
+	arr2 = arr2.reshape(dh2, 2, dw2, 2).mean(axis=(1, 3), dtype=np.float32)
+
+	return arr2
+
+
+
+
+
+# Create the list of levels, stopping once a level fits in a single tile. The
+# levels are kept in the shared directory if there is one (see image_cache.py)
+# so several server workers don't each build their own.
+def build_pyramid(arr1):
+
+	levels = [arr1]
+	while (max(levels[-1].shape[:2]) > TILE_SIZE
+		and min(levels[-1].shape[:2]) >= 2):
+		levels.append(get_shared(arr1, 'level' + str(len(levels)),
+			lambda arr1, arr_last=levels[-1]: downsample(arr_last)))
+
+	return levels
+
+
+
+
+
+# The pyramid is only built once per image and shared by every tab/session.
+# (Only the levels after the image itself are kept with it, as keeping the
+# image would mean it's never let go of, see get_derived.)
+def get_pyramid(dict_image):
+
+	arr1 = dict_image['image'][0]
+
+	return [arr1] + get_derived(arr1, 'pyramid', lambda arr1:
+		build_pyramid(arr1)[1:])
+
+
+
+
+
+# The min and max of an image (ignoring NaNs), worked out once per image. The
+# plots colour every tile over this range, so each one isn't coloured in over
+# just its own values.
+def get_image_range(dict_image):
+
+	def create(arr1):
+		arr1 = np.asarray(arr1)
+		if arr1.dtype.kind == 'f':
+			return (float(np.nanmin(arr1)), float(np.nanmax(arr1)))
+		return (float(arr1.min()), float(arr1.max()))
+
+	return get_derived(dict_image['image'][0], 'range', create)
+
+
+
+
+
+# Work out which level to show. This is the coarsest level which still has at
+# least one image pixel for every screen pixel.
+def select_level(pyramid, x_start, x_end, y_start, y_end, plot_width,
+	plot_height):
+
+	ratio = max(abs(x_end - x_start)/max(plot_width, 1),
+		abs(y_end - y_start)/max(plot_height, 1))
+	if ratio <= 1:
+		return 0
+
+	return min(int(math.floor(math.log2(ratio))), len(pyramid) - 1)
+
+
+
+
+
+# Create a dictionary containing the part of the pyramid which is needed to
+# show the given ranges. The ranges are snapped outwards to the tile grid. The
+# key returned with it identifies the tiles so the caller can skip sending the
+# same thing twice.
+def create_dict_tiles(pyramid, x_start, x_end, y_start, y_end, plot_width,
+	plot_height):
+
+	level = select_level(pyramid, x_start, x_end, y_start, y_end, plot_width,
+		plot_height)
+	arr_level = pyramid[level]
+	scale = 2**level
+	(dh_level, dw_level) = arr_level.shape[:2]
+
+	# Convert the ranges into tile numbers on this level
+	tx0 = int(math.floor(min(x_start, x_end)/scale/TILE_SIZE))
+	tx1 = int(math.ceil(max(x_start, x_end)/scale/TILE_SIZE))
+	ty0 = int(math.floor(min(y_start, y_end)/scale/TILE_SIZE))
+	ty1 = int(math.ceil(max(y_start, y_end)/scale/TILE_SIZE))
+	tx0 = min(max(tx0, 0), (dw_level - 1)//TILE_SIZE)
+	ty0 = min(max(ty0, 0), (dh_level - 1)//TILE_SIZE)
+	tx1 = min(max(tx1, tx0 + 1), -(-dw_level//TILE_SIZE))
+	ty1 = min(max(ty1, ty0 + 1), -(-dh_level//TILE_SIZE))
+
+	x0 = tx0*TILE_SIZE
+	y0 = ty0*TILE_SIZE
+	x1 = min(tx1*TILE_SIZE, dw_level)
+	y1 = min(ty1*TILE_SIZE, dh_level)
+
+	arr_tiles = np.ascontiguousarray(arr_level[y0:y1, x0:x1])
+
+	dict_tiles = {}
+	dict_tiles['image'] = [arr_tiles]
+	dict_tiles['x'] = [x0*scale]
+	dict_tiles['y'] = [y0*scale]
+	dict_tiles['dw'] = [(x1 - x0)*scale]
+	dict_tiles['dh'] = [(y1 - y0)*scale]
+
+	key = (id(arr_level), level, tx0, tx1, ty0, ty1)
+
+	return dict_tiles, key
+
+
+
+
+
+# Send a plot the tiles it needs for its current ranges. tile_keys remembers
+# which tiles each column data source already has so nothing is sent if they
+# haven't changed. colour can be a function to colour the tiles in (e.g.
+# create_tile_colouring in colour_mapping.py) just before they're sent.
+def send_tiles(fig, src, dict_image, tile_keys, colour=None):
+
+	if None in (fig.x_range.start, fig.x_range.end, fig.y_range.start,
+		fig.y_range.end):
+		return
+
+	pyramid = get_pyramid(dict_image)
+	dict_tiles, key = create_dict_tiles(pyramid, fig.x_range.start,
+		fig.x_range.end, fig.y_range.start, fig.y_range.end, fig.plot_width,
+		fig.plot_height)
+
+	if tile_keys.get(src.id) != key:
+		tile_keys[src.id] = key
+		if colour is not None:
+			dict_tiles['image'] = [colour(dict_tiles['image'][0])]
+		src.data = dict_tiles
+		count_bytes(src.name or 'image_tiles', dict_tiles)
+
+	return
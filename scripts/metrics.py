@@ -0,0 +1,403 @@
+################################################################################
+############################## IMPORT LIBRARIES ################################
+
+import cProfile
+import glob
+import io
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import ContextDecorator
+
+import numpy as np
+
+from bokeh.io import curdoc
+from tornado.web import RequestHandler
+
+################################################################################
+################################################################################
+
+# Lightweight timing of the hot paths. Spans (e.g. create_prof or one of the
+# ColorMapper callbacks) are timed and added to a histogram for the session
+# they happened in, and the number of bytes pushed to each column data source
+# is counted. These can be read in Prometheus text format from /metrics on the
+# server. The profiler can also be armed (from /profile) to capture a cProfile
+# of the next callback, which is handy for catching a single slow interaction.
+
+# Upper edges of the histogram buckets (in seconds)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+	5.0, 10.0, float('inf'))
+
+# Sessions which have been closed are all lumped together under this name so
+# the totals don't go backwards (and the list of sessions doesn't grow
+# forever).
+CLOSED_SESSION = 'closed'
+
+_lock = threading.Lock()
+# (span, session) -> [counts for each bucket, sum, count]
+_histograms = {}
+# (name, session) -> value
+_counters = {}
+# (name) -> value
+_gauges = {}
+
+# With several server workers (see main.py) each one only knows about its own
+# sessions. Each worker then writes what it has recorded into a shared
+# directory (METRICS_DIR) and /metrics, whichever worker answers it, shows all
+# of them with a worker label. This is off (None) with a single process.
+WORKER = None
+METRICS_DIR = None
+
+# Profiler state
+_profile_armed = False
+_profile_running = False
+_profile_text = 'No profile captured yet. Arm the profiler with /profile?arm=1'
+
+
+
+
+
+# The id of the Bokeh session that's currently running (or '' if this isn't
+# running in a session, e.g. the batch script or an upload thread).
+def current_session():
+
+	context = curdoc().session_context
+
+	return context.id if context is not None else ''
+
+
+
+
+
+# Time a span of code, either as a decorator or with a 'with' block, e.g.
+#   @timed('create_prof')   or   with timed('callback_range'):
+def timed(name):
+
+	return Span(name)
+
+
+class Span(ContextDecorator):
+
+	def __init__(self, name):
+		self.name = name
+
+	def __enter__(self):
+		global _profile_armed, _profile_running
+		self.profile = None
+		# Only callbacks get profiled (and only one at a time)
+		if _profile_armed and self.name.startswith('callback'):
+			with _lock:
+				if _profile_armed and not _profile_running:
+					_profile_armed = False
+					_profile_running = True
+					self.profile = cProfile.Profile()
+		if self.profile is not None:
+			self.profile.enable()
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		global _profile_running, _profile_text
+		elapsed = time.perf_counter() - self.start
+		if self.profile is not None:
+			self.profile.disable()
+			stream = io.StringIO()
+			stream.write('Profile of ' + self.name + ' (' + str(elapsed)
+				+ ' sec)\n\n')
+			pstats.Stats(self.profile, stream=stream).sort_stats(
+				'cumulative').print_stats(40)
+			with _lock:
+				_profile_text = stream.getvalue()
+				_profile_running = False
+		observe(self.name, elapsed)
+		return False
+
+
+
+
+
+# Add a time to a span's histogram
+def observe(name, elapsed, session=None):
+
+	if session is None:
+		session = current_session()
+
+	with _lock:
+		histogram = _histograms.get((name, session))
+		if histogram is None:
+			histogram = [[0]*len(BUCKETS), 0.0, 0]
+			_histograms[(name, session)] = histogram
+		for i, upper in enumerate(BUCKETS):
+			if elapsed <= upper:
+				histogram[0][i] += 1
+				break
+		histogram[1] += elapsed
+		histogram[2] += 1
+
+	return
+
+
+
+
+
+# Add to a counter
+def increment(name, value=1, session=None):
+
+	if session is None:
+		session = current_session()
+
+	with _lock:
+		_counters[(name, session)] = _counters.get((name, session), 0) + value
+
+	return
+
+
+
+
+
+# Set a gauge (a single value which can go up and down, e.g. a start up time)
+def set_gauge(name, value):
+
+	with _lock:
+		_gauges[name] = value
+
+	return
+
+
+
+
+
+# Roughly how many bytes a column data source update will send, and count
+# them against the source.
+def count_bytes(source, data):
+
+	n_bytes = 0
+	for column in data.values():
+		if isinstance(column, np.ndarray):
+			n_bytes += column.nbytes
+		elif isinstance(column, (list, tuple)):
+			for value in column:
+				n_bytes += value.nbytes if isinstance(value, np.ndarray) else 8
+		else:
+			n_bytes += 8
+	increment('pushed_bytes:' + source, n_bytes)
+
+	return n_bytes
+
+
+
+
+
+# Fold everything recorded for a session into the closed sessions. Called
+# when a session is destroyed.
+def forget_session(session):
+
+	with _lock:
+		for (name, old_session) in list(_histograms):
+			if old_session != session:
+				continue
+			counts, total, count = _histograms.pop((name, session))
+			closed = _histograms.setdefault((name, CLOSED_SESSION),
+				[[0]*len(BUCKETS), 0.0, 0])
+			closed[0] = [a + b for a, b in zip(closed[0], counts)]
+			closed[1] += total
+			closed[2] += count
+		for (name, old_session) in list(_counters):
+			if old_session != session:
+				continue
+			value = _counters.pop((name, session))
+			_counters[(name, CLOSED_SESSION)] = (
+				_counters.get((name, CLOSED_SESSION), 0) + value)
+
+	return
+
+
+
+
+
+# Use (or stop using, with None) a directory shared with the other workers,
+# labelling this worker's metrics with its name
+def set_worker(worker, directory):
+
+	global WORKER, METRICS_DIR
+
+	if directory is not None:
+		os.makedirs(directory, exist_ok=True)
+	WORKER = worker
+	METRICS_DIR = directory
+
+	return
+
+
+
+
+
+# Everything recorded so far (by this process)
+def snapshot():
+
+	with _lock:
+		return {'histograms': [[name, session, list(counts), total, count]
+				for (name, session), (counts, total, count)
+				in sorted(_histograms.items())],
+			'counters': [[name, session, value]
+				for (name, session), value in sorted(_counters.items())],
+			'gauges': sorted(_gauges.items())}
+
+
+
+
+
+# Write this worker's snapshot into the shared directory. The file is written
+# under a temporary name and then renamed so the other workers never read half
+# of it.
+def write_snapshot():
+
+	if METRICS_DIR is None:
+		return
+
+	filelocation = os.path.join(METRICS_DIR, 'worker-' + str(WORKER) + '.json')
+	temp = filelocation + '.' + str(os.getpid()) + '.tmp'
+	with open(temp, 'w') as f:
+		json.dump(snapshot(), f)
+	os.replace(temp, filelocation)
+
+	return
+
+
+
+
+
+# The snapshots of every worker, as (worker, snapshot) pairs. Without a shared
+# directory this is just this process (with no worker label).
+def worker_snapshots():
+
+	if METRICS_DIR is None:
+		return [(None, snapshot())]
+
+	# (This worker's is written first so it's always up to date)
+	write_snapshot()
+	snapshots = []
+	for filelocation in sorted(glob.glob(os.path.join(METRICS_DIR,
+		'worker-*.json'))):
+		worker = os.path.basename(filelocation)[len('worker-'):-len('.json')]
+		try:
+			with open(filelocation) as f:
+				snapshots.append((worker, json.load(f)))
+		except (OSError, ValueError):
+			pass
+
+	return snapshots
+
+
+
+
+
+# Write everything out in the Prometheus text format
+def prometheus_text():
+
+	snapshots = worker_snapshots()
+
+	# (Labels added to every line to say which worker it came from)
+	def worker_label(worker):
+		return '' if worker is None else ',worker="' + worker + '"'
+
+	lines = []
+
+	lines.append('# HELP image_analysis_span_seconds Time spent in each span '
+		'of the image analysis code.')
+	lines.append('# TYPE image_analysis_span_seconds histogram')
+	for worker, values in snapshots:
+		for name, session, counts, total, count in values['histograms']:
+			labels = ('span="' + name + '",session="' + session + '"'
+				+ worker_label(worker))
+			cumulative = 0
+			for upper, n in zip(BUCKETS, counts):
+				cumulative += n
+				le = '+Inf' if upper == float('inf') else repr(upper)
+				lines.append('image_analysis_span_seconds_bucket{' + labels
+					+ ',le="' + le + '"} ' + str(cumulative))
+			lines.append('image_analysis_span_seconds_sum{' + labels + '} '
+				+ repr(total))
+			lines.append('image_analysis_span_seconds_count{' + labels + '} '
+				+ str(count))
+
+	lines.append('# HELP image_analysis_pushed_bytes_total Bytes pushed to '
+		'each column data source.')
+	lines.append('# TYPE image_analysis_pushed_bytes_total counter')
+	for worker, values in snapshots:
+		for name, session, value in values['counters']:
+			if not name.startswith('pushed_bytes:'):
+				continue
+			lines.append('image_analysis_pushed_bytes_total{source="'
+				+ name.split(':', 1)[1] + '",session="' + session + '"'
+				+ worker_label(worker) + '} ' + str(value))
+
+	# (Each gauge's TYPE line can only appear once)
+	gauges = {}
+	for worker, values in snapshots:
+		for name, value in values['gauges']:
+			gauges.setdefault(name, []).append((worker, value))
+	for name, values in sorted(gauges.items()):
+		lines.append('# TYPE image_analysis_' + name + ' gauge')
+		for worker, value in values:
+			labels = '' if worker is None else '{worker="' + worker + '"}'
+			lines.append('image_analysis_' + name + labels + ' ' + repr(value))
+
+	return '\n'.join(lines) + '\n'
+
+
+
+
+
+# Arm the profiler so the next callback gets profiled
+def arm_profiler():
+
+	global _profile_armed
+
+	with _lock:
+		_profile_armed = True
+
+	return
+
+
+def profile_text():
+
+	with _lock:
+		return _profile_text
+
+
+
+
+
+################################################################################
+############################## HTTP HANDLERS ###################################
+
+# These are added to the Bokeh server (see main.py). They only answer requests
+# from the same machine.
+
+class LocalHandler(RequestHandler):
+
+	def prepare(self):
+		if self.request.remote_ip not in ('127.0.0.1', '::1'):
+			self.send_error(403)
+
+
+class MetricsHandler(LocalHandler):
+
+	def get(self):
+		self.set_header('Content-Type', 'text/plain; version=0.0.4')
+		self.write(prometheus_text())
+
+
+class ProfileHandler(LocalHandler):
+
+	def get(self):
+		if self.get_argument('arm', None):
+			arm_profiler()
+			self.write('Profiler armed. The next callback will be profiled, '
+				'reload /profile afterwards to see it.\n')
+			return
+		self.set_header('Content-Type', 'text/plain')
+		self.write(profile_text())
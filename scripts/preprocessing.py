@@ -0,0 +1,328 @@
+################################################################################
+############################## IMPORT LIBRARIES ################################
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Shared store for things worked out from an image
+from scripts.image_cache import (get_image, get_derived, get_shared,
+	share_derived, shared_name, image_key)
+from scripts.metrics import timed
+
+################################################################################
+################################################################################
+
+# Corrections applied to the raw scintillator frames before anything else sees
+# them: dark frame subtraction, flat-field correction, noise filtering (median
+# or Gaussian) and background subtraction (a single level, or a smooth local
+# background). These are set once (see set_preprocessing, main.py and
+# batch_analysis.py) and applied to every image as it's opened. The corrected
+# image is worked out once per image and shared by every tab and session (and
+# kept in the disk cache, see image_cache.py).
+
+# The image is split into tiles which are worked on at the same time on a pool
+# of threads (SciPy's filters and NumPy let go of the GIL so they really do
+# run in parallel). Each tile is read with a halo around it wide enough for the
+# filters, so the result is the same as doing the whole image in one go.
+
+# The dark and flat frames are only read in once (they're in the image cache)
+# and the gain worked out from them is kept with the flat frame. They're
+# broadcast over a stack of images.
+
+# The settings, and what they are if not given. filter_size is the size of the
+# median filter or the sigma of the Gaussian (in pixels). background_size is
+# roughly the size (in pixels) of the features the local background ignores,
+# so it should be bigger than the spots.
+PREPROCESS_DEFAULTS = {'dark': None, 'flat': None, 'filter': 'none',
+	'filter_size': 3, 'background': 'none', 'background_size': 64}
+
+# Noise filters
+PREPROCESS_FILTERS = ('none', 'median', 'gaussian')
+
+# Ways of estimating the background to subtract. 'constant' is the median of
+# the image (most of it is background), 'local' is a smoothed grey opening.
+PREPROCESS_BACKGROUNDS = ('none', 'constant', 'local')
+
+# Size of the tiles (in pixels, not counting the halo)
+PREPROCESS_TILE = 512
+
+PREPROCESS_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# The settings currently used for every image (nothing is done by default)
+PREPROCESSING = dict(PREPROCESS_DEFAULTS)
+
+
+
+
+
+# Fill in any missing settings and check they're all known
+def check_preprocessing(settings):
+
+	unknown = set(settings) - set(PREPROCESS_DEFAULTS)
+	if unknown:
+		raise ValueError('Unknown preprocessing settings: '
+			+ ', '.join(sorted(unknown)))
+
+	settings = dict(PREPROCESS_DEFAULTS, **settings)
+	if settings['filter'] not in PREPROCESS_FILTERS:
+		raise ValueError('Unknown filter ' + repr(settings['filter'])
+			+ ', should be one of ' + ', '.join(PREPROCESS_FILTERS))
+	if settings['background'] not in PREPROCESS_BACKGROUNDS:
+		raise ValueError('Unknown background ' + repr(settings['background'])
+			+ ', should be one of ' + ', '.join(PREPROCESS_BACKGROUNDS))
+
+	return settings
+
+
+# Set the preprocessing used for every image from now on. (This is a function
+# of one argument so it can be used to set up worker processes.)
+def set_preprocessing(settings):
+
+	global PREPROCESSING
+
+	PREPROCESSING = check_preprocessing(settings)
+
+	return
+
+
+
+
+
+# Whether the settings do anything at all
+def is_preprocessing(settings):
+
+	return (settings['dark'] is not None or settings['flat'] is not None
+		or settings['filter'] != 'none' or settings['background'] != 'none')
+
+
+
+
+
+# The dark frame and the gain (what to multiply by for the flat-field
+# correction, normalised so the mean is unchanged). Either is None if not
+# used. Pixels with no signal in the flat frame are left as they are.
+def get_calibration(settings, shape):
+
+	dark = None
+	gain = None
+
+	if settings['dark'] is not None:
+		dark = get_image(settings['dark'])
+		if dark.shape != shape:
+			raise ValueError('Dark frame is ' + str(dark.shape)
+				+ ' but the image is ' + str(shape))
+
+	if settings['flat'] is not None:
+		flat = get_image(settings['flat'])
+		if flat.shape != shape:
+			raise ValueError('Flat frame is ' + str(flat.shape)
+				+ ' but the image is ' + str(shape))
+
+		def create(flat):
+			signal = np.subtract(flat, 0 if dark is None else dark,
+				dtype=np.float32)
+			good = signal > 0
+			gain = np.ones(shape, dtype=np.float32)
+			gain[good] = signal[good].mean()/signal[good]
+			gain.setflags(write=False)
+			return gain
+
+		name = 'gain'
+		if dark is not None:
+			name += '_' + shared_name(image_key(settings['dark']))
+		gain = get_derived(flat, name, create)
+
+	return dark, gain
+
+
+
+
+
+# The compare and swaps that find the median of 9 values (from Paeth's
+# "Median finding on a 3x3 grid", Graphics Gems)
+MEDIAN9_NETWORK = ((1, 2), (4, 5), (7, 8), (0, 1), (3, 4), (6, 7), (1, 2),
+	(4, 5), (7, 8), (0, 3), (5, 8), (4, 7), (3, 6), (1, 4), (2, 5), (4, 7),
+	(4, 2), (6, 4), (4, 2))
+
+
+# A 3 x 3 median filter over the last two axes. This is the same as
+# ndimage.median_filter (with its default edges) but a few times quicker, as
+# it's just np.minimum and np.maximum of the 9 shifted copies of the image.
+def median3(arr1):
+
+	(dh1, dw1) = arr1.shape[-2:]
+	padded = np.pad(arr1, [(0, 0)]*(arr1.ndim - 2) + [(1, 1), (1, 1)],
+		mode='symmetric')
+	values = [padded[..., i:i + dh1, j:j + dw1] for i in range(3)
+		for j in range(3)]
+	for (a, b) in MEDIAN9_NETWORK:
+		(values[a], values[b]) = (np.minimum(values[a], values[b]),
+			np.maximum(values[a], values[b]))
+
+	return values[4]
+
+
+
+
+
+# How far (in pixels) the filters reach, i.e. how wide the halo around each
+# tile has to be
+def preprocessing_halo(settings):
+
+	halo = 0
+	if settings['filter'] == 'median':
+		halo += int(settings['filter_size'])//2 + 1
+	elif settings['filter'] == 'gaussian':
+		# (gaussian_filter goes out to 4 sigma)
+		halo += int(4*settings['filter_size'] + 0.5) + 1
+	if settings['background'] == 'local':
+		halo += int(settings['background_size'])*3//2 + 1
+
+	return halo
+
+
+
+
+
+# Correct one tile of the image (or stack), with rows y0:y1 and columns x0:x1,
+# into out
+def preprocess_tile(arr1, out, dark, gain, level, settings, halo, y0, y1, x0,
+	x1):
+
+	# (SciPy is only imported once it's needed so that main.py, which uses
+	# the options below, can start the server without it, see main.py)
+	from scipy import ndimage
+
+	(dh1, dw1) = arr1.shape[-2:]
+	(ya, yb) = (max(y0 - halo, 0), min(y1 + halo, dh1))
+	(xa, xb) = (max(x0 - halo, 0), min(x1 + halo, dw1))
+	# (Only the last two axes of a stack are filtered)
+	extra = (1,)*(arr1.ndim - 2)
+
+	tile = np.array(arr1[..., ya:yb, xa:xb], dtype=np.float32)
+	if dark is not None:
+		tile -= dark[ya:yb, xa:xb]
+	if gain is not None:
+		tile *= gain[ya:yb, xa:xb]
+
+	size = int(settings['filter_size'])
+	if settings['filter'] == 'median' and size == 3:
+		tile = median3(tile)
+	elif settings['filter'] == 'median':
+		tile = ndimage.median_filter(tile, size=extra + (size, size))
+	elif settings['filter'] == 'gaussian':
+		tile = ndimage.gaussian_filter(tile, sigma=(0,)*len(extra)
+			+ (settings['filter_size'],)*2)
+
+	if settings['background'] == 'constant':
+		tile -= level
+	elif settings['background'] == 'local':
+		size = int(settings['background_size'])
+		background = ndimage.grey_opening(tile, size=extra + (size, size))
+		tile -= ndimage.uniform_filter(background,
+			size=extra + (size//2*2 + 1,)*2)
+
+	out[..., y0:y1, x0:x1] = tile[..., y0 - ya:y1 - ya, x0 - xa:x1 - xa]
+
+	return
+
+
+
+
+
+# Apply the preprocessing to an image (H x W) or stack of images (N x H x W).
+# Returns a new float32 array. settings defaults to the current ones.
+@timed('preprocess_image')
+def preprocess_image(arr1, settings=None):
+
+	settings = PREPROCESSING if settings is None else check_preprocessing(
+		settings)
+	(dh1, dw1) = arr1.shape[-2:]
+	(dark, gain) = get_calibration(settings, (dh1, dw1))
+
+	# The constant background is the median of a sample of each corrected
+	# image (as in spots.py)
+	level = None
+	if settings['background'] == 'constant':
+		sample = np.array(arr1[..., ::8, ::8], dtype=np.float32)
+		if dark is not None:
+			sample -= dark[::8, ::8]
+		if gain is not None:
+			sample *= gain[::8, ::8]
+		level = np.median(sample.reshape(sample.shape[:-2] + (-1,)), axis=-1)
+		level = level.astype(np.float32)[..., None, None]
+
+	out = np.empty(arr1.shape, dtype=np.float32)
+	halo = preprocessing_halo(settings)
+	futures = [PREPROCESS_EXECUTOR.submit(preprocess_tile, arr1, out, dark,
+		gain, level, settings, halo, y0, min(y0 + PREPROCESS_TILE, dh1), x0,
+		min(x0 + PREPROCESS_TILE, dw1))
+		for y0 in range(0, dh1, PREPROCESS_TILE)
+		for x0 in range(0, dw1, PREPROCESS_TILE)]
+	for future in futures:
+		future.result()
+
+	return out
+
+
+
+
+
+# Return the image (or stack) with the current preprocessing applied. This is
+# only worked out once per image and shared, and everything worked out from
+# the corrected image (pyramid, spots etc.) is shared in the same way. If
+# there's no preprocessing the image itself is returned.
+def get_preprocessed(arr1, settings=None):
+
+	settings = PREPROCESSING if settings is None else check_preprocessing(
+		settings)
+	if not is_preprocessing(settings):
+		return arr1
+
+	# (The calibration frames are named by their path, modification time and
+	# size so changing them means it's done again)
+	key = sorted(settings.items())
+	for frame in ('dark', 'flat'):
+		if settings[frame] is not None:
+			key.append(image_key(settings[frame]))
+	name = 'pre_' + shared_name(key)
+
+	def create(arr1):
+		arr_pre = get_shared(arr1, name, lambda arr1: preprocess_image(arr1,
+			settings))
+		arr_pre.setflags(write=False)
+		share_derived(arr_pre, arr1, name)
+		return arr_pre
+
+	return get_derived(arr1, name, create)
+
+
+
+
+
+# Command line options for the preprocessing (used by main.py and
+# batch_analysis.py)
+def add_preprocessing_arguments(parser):
+
+	parser.add_argument('--dark', help='dark frame to subtract')
+	parser.add_argument('--flat', help='flat-field frame to correct with')
+	parser.add_argument('--filter', choices=PREPROCESS_FILTERS,
+		default='none', help='noise filter (default: none)')
+	parser.add_argument('--filter-size', type=float, default=3,
+		help='median filter size or Gaussian sigma in pixels (default: 3)')
+	parser.add_argument('--background', choices=PREPROCESS_BACKGROUNDS,
+		default='none', help='background to subtract (default: none)')
+	parser.add_argument('--background-size', type=int, default=64,
+		help='size in pixels of the local background (default: 64)')
+
+	return
+
+
+def preprocessing_from_args(args):
+
+	return check_preprocessing({'dark': args.dark, 'flat': args.flat,
+		'filter': args.filter, 'filter_size': args.filter_size,
+		'background': args.background,
+		'background_size': args.background_size})
@@ -0,0 +1,164 @@
+################################################################################
+############################## IMPORT LIBRARIES ################################
+
+import numpy as np
+
+################################################################################
+################################################################################
+
+# Measurements of line profiles: the peak, the full width at half maximum
+# (FWHM), the 80/20 penumbra on each side, and the flatness and symmetry. They
+# are worked out for N profiles at once, stacked in an (N x longest profile)
+# array padded with NaN (as returned by create_profs), so they're quick enough
+# to redo on every profile update. Edges are found to a fraction of a sample by
+# interpolating linearly between the samples either side.
+
+# Every level is relative to the peak of each profile, and the edges used are
+# the ones either side of the peak (so other spots further along the line are
+# ignored). Distances are in pixels along the line. Anything that can't be
+# worked out (e.g. the profile doesn't drop below half the peak before the end
+# of the line) is NaN.
+
+# The metrics, in the order they're shown
+PROF_METRICS = ('peak', 'peak_position', 'fwhm', 'centre', 'penumbra_left',
+	'penumbra_right', 'flatness', 'symmetry')
+
+# Levels (as a fraction of the peak) the penumbra is measured between
+PENUMBRA_LEVELS = (0.2, 0.8)
+
+# Flatness and symmetry are worked out over this central fraction of the FWHM
+FLAT_REGION = 0.8
+
+# Number of points across that region (odd, so one is in the middle)
+FLAT_SAMPLES = 101
+
+
+
+
+
+# Values of each profile at fractional sample positions (an (N x M) array),
+# interpolated linearly. Positions off the end of a profile give NaN.
+def interp_profs(profs, n_samples, positions):
+
+	rows = np.arange(profs.shape[0])[:, None]
+	i0 = np.clip(np.floor(positions), 0, profs.shape[1] - 1)
+	frac = positions - i0
+	i0 = np.nan_to_num(i0).astype(np.intp)
+	i1 = np.minimum(i0 + 1, profs.shape[1] - 1)
+
+	values = profs[rows, i0]*(1 - frac) + profs[rows, i1]*frac
+	inside = (positions >= 0) & (positions <= (n_samples - 1)[:, None])
+
+	return np.where(inside, values, np.nan)
+
+
+
+
+
+# Where each profile crosses a level on either side of its peak. Returns the
+# (fractional) sample positions of the left and right crossings.
+def find_crossings(profs, n_samples, i_peak, level):
+
+	n_profs = profs.shape[0]
+	rows = np.arange(n_profs)
+	index = np.arange(profs.shape[1])
+
+	below = profs < level[:, None]
+	left = below & (index < i_peak[:, None])
+	right = below & (index > i_peak[:, None]) & (index < n_samples[:, None])
+
+	# The last sample below the level before the peak, and the first after it
+	has_left = left.any(axis=1)
+	has_right = right.any(axis=1)
+	i_left = profs.shape[1] - 1 - np.argmax(left[:, ::-1], axis=1)
+	i_right = np.argmax(right, axis=1)
+	i_left[~has_left] = 0
+	i_right[~has_right] = 1
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		z0 = profs[rows, i_left]
+		z1 = profs[rows, np.minimum(i_left + 1, profs.shape[1] - 1)]
+		x_left = i_left + (level - z0)/(z1 - z0)
+		z0 = profs[rows, i_right - 1]
+		z1 = profs[rows, i_right]
+		x_right = i_right - 1 + (level - z0)/(z1 - z0)
+
+	x_left[~has_left] = np.nan
+	x_right[~has_right] = np.nan
+
+	return x_left, x_right
+
+
+
+
+
+# Work out the metrics for N profiles at once. step is the distance (in
+# pixels) between samples, either one number or one for each profile. Returns
+# a dictionary of (N) arrays, one for each of PROF_METRICS:
+#   peak            the maximum value
+#   peak_position   where the peak is (a parabola through the highest sample
+#                   and the ones either side)
+#   fwhm            the distance between the 50% crossings
+#   centre          half way between the 50% crossings
+#   penumbra_left   distance between the 20% and 80% crossings on each side
+#   penumbra_right
+#   flatness        100 x (max - min)/(max + min) over the central region
+#   symmetry        100 x the largest difference between points mirrored
+#                   about the centre, over the value at the centre
+def create_prof_metrics(profs, n_samples, step=1.0):
+
+	profs = np.atleast_2d(np.asarray(profs, dtype=np.float64))
+	n_samples = np.atleast_1d(np.asarray(n_samples))
+	step = np.broadcast_to(np.asarray(step, dtype=np.float64),
+		n_samples.shape)
+	n_profs = profs.shape[0]
+	rows = np.arange(n_profs)
+
+	# An all NaN profile (e.g. completely off the image) gives NaN for all
+	empty = np.all(np.isnan(profs), axis=1)
+	i_peak = np.argmax(np.nan_to_num(profs, nan=-np.inf), axis=1)
+	peak = profs[rows, i_peak]
+
+	# Fit a parabola through the peak and its neighbours for a smoother
+	# position
+	with np.errstate(divide='ignore', invalid='ignore'):
+		zl = profs[rows, np.maximum(i_peak - 1, 0)]
+		zr = profs[rows, np.minimum(i_peak + 1, profs.shape[1] - 1)]
+		shift = 0.5*(zl - zr)/(zl - 2*peak + zr)
+	shift = np.where(np.isfinite(shift) & (np.abs(shift) <= 0.5), shift, 0)
+	peak_position = i_peak + shift
+
+	(x_left50, x_right50) = find_crossings(profs, n_samples, i_peak, 0.5*peak)
+	(x_left_low, x_right_low) = find_crossings(profs, n_samples, i_peak,
+		PENUMBRA_LEVELS[0]*peak)
+	(x_left_high, x_right_high) = find_crossings(profs, n_samples, i_peak,
+		PENUMBRA_LEVELS[1]*peak)
+
+	# Sample the central region at points mirrored about the centre
+	centre = (x_left50 + x_right50)/2
+	half_width = FLAT_REGION*(x_right50 - x_left50)/2
+	u = np.linspace(-1, 1, FLAT_SAMPLES)
+	region = interp_profs(profs, n_samples, centre[:, None]
+		+ u[None, :]*half_width[:, None])
+	with np.errstate(divide='ignore', invalid='ignore'):
+		region_max = np.max(region, axis=1)
+		region_min = np.min(region, axis=1)
+		flatness = 100*(region_max - region_min)/(region_max + region_min)
+		symmetry = 100*np.max(np.abs(region - region[:, ::-1]), axis=1
+			)/region[:, FLAT_SAMPLES//2]
+
+	dict_metrics = {
+		'peak': peak,
+		'peak_position': peak_position*step,
+		'fwhm': (x_right50 - x_left50)*step,
+		'centre': centre*step,
+		'penumbra_left': (x_left_high - x_left_low)*step,
+		'penumbra_right': (x_right_low - x_right_high)*step,
+		'flatness': flatness,
+		'symmetry': symmetry,
+		}
+
+	for values in dict_metrics.values():
+		values[empty] = np.nan
+
+	return dict_metrics
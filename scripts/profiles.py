@@ -0,0 +1,292 @@
+################################################################################
+############################## IMPORT LIBRARIES ################################
+
+from scipy.ndimage import map_coordinates, spline_filter
+import numpy as np
+
+# Shared store for things worked out from an image
+from scripts.image_cache import (get_derived, get_shared, get_shared_dict,
+	shared_name)
+from scripts.metrics import timed
+
+################################################################################
+################################################################################
+
+# Line profiles worked out for lots of lines at once. All the lines are sampled
+# in one go with a single map_coordinates call and the spline coefficients of
+# the image (which map_coordinates would otherwise work out again for the whole
+# image on every call) are only calculated once per image.
+
+# Profiles can also be given a width, in which case each one is the average
+# (or median, or Gaussian weighted average) of several parallel lines spread
+# across the width. The parallel lines are sampled in the same single
+# map_coordinates call.
+
+# Long profiles are cut down (see decimate_prof) before being plotted, as
+# there's no point sending the browser more points than the plot is wide.
+
+# The parallel lines of a wide profile are at most this far apart (in pixels)
+PROF_WIDTH_SPACING = 0.5
+
+# Ways the parallel lines can be combined
+PROF_WEIGHTINGS = ('mean', 'median', 'gaussian')
+
+
+
+
+
+# Work out the spline coefficients for the image. This is only done once for
+# each image and interpolation order and is then shared. Orders 0 and 1 don't
+# need prefiltering so the image itself is used.
+def prefilter_image(arr1, order=3):
+
+	if order <= 1:
+		return arr1
+
+	def create_coeffs(arr1):
+		return spline_filter(np.asarray(arr1), order=order, output=np.float32,
+			mode='constant')
+
+	# (The coefficients are as big as the image so are shared between server
+	# workers, see image_cache.py)
+	def create(arr1):
+		coeffs = get_shared(arr1, 'spline' + str(order), create_coeffs)
+		coeffs.setflags(write=False)
+		return coeffs
+
+	return get_derived(arr1, 'spline' + str(order), create)
+
+
+
+
+
+# Work out the sample coordinates for each line. Each line is sampled roughly
+# every 'spacing' pixels (with at least 2 samples so both ends are included).
+# Returns the number of samples in each line plus the flattened x and y
+# coordinates of all the samples one line after another.
+def create_prof_coords(x_start, x_end, y_start, y_end, spacing=0.1):
+
+	x_start = np.atleast_1d(np.asarray(x_start, dtype=np.float64))
+	x_end = np.atleast_1d(np.asarray(x_end, dtype=np.float64))
+	y_start = np.atleast_1d(np.asarray(y_start, dtype=np.float64))
+	y_end = np.atleast_1d(np.asarray(y_end, dtype=np.float64))
+
+	# Calculate how long each line is (hypotenuse eqn.)
+	prof_length = np.hypot(x_end - x_start, y_end - y_start)
+	n_samples = np.maximum((prof_length/spacing).astype(np.int64), 2)
+
+	# Which line each sample belongs to and how far along it it is (the same as
+	# doing np.linspace for each line)
+	line = np.repeat(np.arange(len(n_samples)), n_samples)
+	first = np.cumsum(n_samples) - n_samples
+	step = np.arange(len(line)) - first[line]
+	frac = step/(n_samples[line] - 1)
+
+	x_sample = x_start[line] + frac*(x_end - x_start)[line]
+	y_sample = y_start[line] + frac*(y_end - y_start)[line]
+
+	return n_samples, x_sample, y_sample
+
+
+
+
+
+# The offsets (in pixels, perpendicular to the line) of the parallel lines
+# making up a profile of the given width. A width of 0 is just the line itself.
+def create_prof_offsets(width=0):
+
+	if width <= 0:
+		return np.zeros(1)
+
+	n_offsets = int(np.ceil(width/PROF_WIDTH_SPACING)) + 1
+
+	return np.linspace(-width/2, width/2, n_offsets)
+
+
+
+
+
+# Add the parallel lines to the sample coordinates. Returns (M x samples)
+# arrays of x and y coordinates, one row for each offset.
+def offset_prof_coords(n_samples, x_sample, y_sample, x_start, x_end, y_start,
+	y_end, offsets):
+
+	if len(offsets) == 1 and offsets[0] == 0:
+		return x_sample[None, :], y_sample[None, :]
+
+	# Unit vector at right angles to each line (zero for a line of no length)
+	dx = np.atleast_1d(np.asarray(x_end, dtype=np.float64) - x_start)
+	dy = np.atleast_1d(np.asarray(y_end, dtype=np.float64) - y_start)
+	length = np.hypot(dx, dy)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		x_normal = np.where(length > 0, -dy/length, 0)
+		y_normal = np.where(length > 0, dx/length, 0)
+	x_normal = np.repeat(x_normal, n_samples)
+	y_normal = np.repeat(y_normal, n_samples)
+
+	x_offset = x_sample[None, :] + offsets[:, None]*x_normal[None, :]
+	y_offset = y_sample[None, :] + offsets[:, None]*y_normal[None, :]
+
+	return x_offset, y_offset
+
+
+
+
+
+# Combine the samples of the parallel lines (the first axis) into one
+def combine_offsets(z_offset, offsets, weighting='mean'):
+
+	if z_offset.shape[0] == 1:
+		return z_offset[0]
+
+	if weighting == 'median':
+		return np.median(z_offset, axis=0)
+	if weighting == 'gaussian':
+		# The edges of the width are 2 sigma from the centre
+		sigma = max(abs(offsets[-1])/2, 1e-9)
+		weights = np.exp(-0.5*(offsets/sigma)**2)
+		return np.tensordot(weights/weights.sum(), z_offset, axes=1)
+	if weighting == 'mean':
+		return z_offset.mean(axis=0)
+
+	raise ValueError('Unknown profile weighting ' + repr(weighting)
+		+ ', should be one of ' + ', '.join(PROF_WEIGHTINGS))
+
+
+
+
+
+# Create profiles along N lines at once. The start and end points are arrays
+# (or single numbers) and the profiles are returned stacked in an
+# (N x longest profile) array padded with NaN, along with the number of samples
+# in each one. The profiles are normalised to their max value unless asked not
+# to be. If a width is given each profile is the combination (see
+# combine_offsets) of parallel lines across that width.
+@timed('create_profs')
+def create_profs(arr1, x_start, x_end, y_start, y_end, order=3, spacing=0.1,
+	normalise=True, width=0, weighting='mean'):
+
+	n_samples, x_sample, y_sample = create_prof_coords(x_start, x_end,
+		y_start, y_end, spacing)
+	offsets = create_prof_offsets(width)
+	x_offset, y_offset = offset_prof_coords(n_samples, x_sample, y_sample,
+		x_start, x_end, y_start, y_end, offsets)
+
+	# Interpolate every sample from every line (and every parallel line) in
+	# one go. Remember pixels are accessed by (y,x) coordinates.
+	coeffs = prefilter_image(arr1, order)
+	z_offset = map_coordinates(coeffs, np.vstack((y_offset.ravel(),
+		x_offset.ravel())), output=np.float64, order=order, mode='constant',
+		prefilter=False).reshape(x_offset.shape)
+	z_sample = combine_offsets(z_offset, offsets, weighting)
+
+	# Put each line onto its own row
+	profs = np.full((len(n_samples), n_samples.max()), np.nan)
+	mask = np.arange(n_samples.max()) < n_samples[:, None]
+	profs[mask] = z_sample
+
+	if normalise:
+		with np.errstate(divide='ignore', invalid='ignore'):
+			profs *= 100/np.nanmax(profs, axis=1, keepdims=True)
+
+	return profs, n_samples
+
+
+
+
+
+# Create profiles along N lines through every image in a stack (K x H x W) at
+# once. All K x N profiles are interpolated in a single map_coordinates call.
+# The spline coefficients are worked out over the whole stack so that at whole
+# numbered image indices the interpolation is exactly the same as doing each
+# image on its own. Returns a (K x N x longest profile) array padded with NaN
+# and the number of samples in each line. The width works the same as in
+# create_profs.
+def create_stack_profs(stack, x_start, x_end, y_start, y_end, order=3,
+	spacing=0.1, normalise=True, width=0, weighting='mean'):
+
+	n_samples, x_sample, y_sample = create_prof_coords(x_start, x_end,
+		y_start, y_end, spacing)
+	offsets = create_prof_offsets(width)
+	x_offset, y_offset = offset_prof_coords(n_samples, x_sample, y_sample,
+		x_start, x_end, y_start, y_end, offsets)
+	n_images = stack.shape[0]
+
+	# The same samples for every image
+	k_sample = np.repeat(np.arange(n_images, dtype=np.float64), x_offset.size)
+	coords = np.vstack((k_sample, np.tile(y_offset.ravel(), n_images),
+		np.tile(x_offset.ravel(), n_images)))
+
+	coeffs = prefilter_image(stack, order)
+	z_offset = map_coordinates(coeffs, coords, output=np.float64, order=order,
+		mode='constant', prefilter=False).reshape((n_images,)
+		+ x_offset.shape)
+	z_sample = combine_offsets(np.moveaxis(z_offset, 1, 0), offsets, weighting)
+
+	profs = np.full((n_images, len(n_samples), n_samples.max()), np.nan)
+	mask = np.arange(n_samples.max()) < n_samples[:, None]
+	profs[:, mask] = z_sample.reshape(n_images, -1)
+
+	if normalise:
+		with np.errstate(divide='ignore', invalid='ignore'):
+			profs *= 100/np.nanmax(profs, axis=2, keepdims=True)
+
+	return profs, n_samples
+
+
+
+
+
+# The same as create_profs but the profiles are kept (in the disk cache, see
+# image_cache.py) against the image and the lines and settings, so the same
+# profiles through the same image aren't worked out again. This is for
+# profiles which are set up in advance (e.g. the ones in a batch definitions
+# file), not ones being dragged around.
+def get_profs(arr1, x_start, x_end, y_start, y_end, **options):
+
+	lines = np.vstack(np.broadcast_arrays(*(np.atleast_1d(np.asarray(coord,
+		dtype=np.float64)) for coord in (x_start, x_end, y_start, y_end))))
+	name = 'prof_' + shared_name((lines.tobytes(), sorted(options.items())))
+
+	def create(arr1):
+		profs, n_samples = create_profs(arr1, *lines, **options)
+		return {'profs': profs, 'n_samples': n_samples}
+
+	value = get_shared_dict(arr1, name, create)
+
+	return value['profs'], value['n_samples']
+
+
+
+
+
+# Cut a profile (sampled at positions x, in order) down for plotting. Only the
+# samples between x_low and x_high are used. If there are more than
+# 2 x n_points of them they're split into n_points buckets and just the min
+# and max of each bucket are kept (in the order they come), so peaks and dips
+# still show however long the line is. Returns the x and z of the samples kept.
+def decimate_prof(x, z, x_low, x_high, n_points):
+
+	i0 = max(np.searchsorted(x, x_low, side='right') - 1, 0)
+	i1 = min(np.searchsorted(x, x_high, side='left') + 1, len(x))
+	(x, z) = (x[i0:i1], z[i0:i1])
+	if len(z) <= 2*n_points:
+		return x, z
+
+	# Pad to a whole number of buckets (the padding is never picked)
+	size = -(-len(z)//n_points)
+	n_buckets = -(-len(z)//size)
+	z_buckets = np.full(n_buckets*size, np.nan)
+	z_buckets[:len(z)] = z
+	z_buckets = z_buckets.reshape(n_buckets, size)
+	i_min = np.argmin(np.where(np.isnan(z_buckets), np.inf, z_buckets), axis=1)
+	i_max = np.argmax(np.where(np.isnan(z_buckets), -np.inf, z_buckets),
+		axis=1)
+
+	start = np.arange(n_buckets)*size
+	index = np.sort(np.stack((start + i_min, start + i_max), axis=1),
+		axis=1).ravel()
+	index = np.minimum(index, len(z) - 1)
+
+	return x[index], z[index]
+
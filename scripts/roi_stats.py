@@ -0,0 +1,164 @@
+################################################################################
+############################## IMPORT LIBRARIES ################################
+
+import numpy as np
+
+# Shared store for things worked out from an image
+from scripts.image_cache import get_derived, get_shared
+
+################################################################################
+################################################################################
+
+# Statistics (mean, standard deviation, min, max and integral) inside
+# rectangular regions of interest (ROIs). Summed-area tables of the image and
+# of its square are worked out the first time they're needed for an image,
+# after which the sum (and so the mean and standard deviation) inside any
+# rectangle only needs the four corners of the tables, however big it is. The
+# min and max of every ROI are found at once by cutting the image up along
+# the edges of all of the ROIs (see roi_extremes).
+
+# ROIs are given in plot coordinates (as used by the plots and profiles) and
+# cover the pixels from round(x_start) to round(x_end) and round(y_start) to
+# round(y_end), clipped to the image.
+
+
+
+
+
+# Create the summed-area tables. Each is one bigger than the image in both
+# directions with a row and column of zeros at the start, so the sum over rows
+# y0:y1 and columns x0:x1 is sat[y1,x1] - sat[y0,x1] - sat[y1,x0] + sat[y0,x0].
+# Integer images are summed as integers so the sums are exact (even the
+# squares of a 4000 x 4000 16 bit image fit in an int64). The squares of 32
+# bit (and bigger) images don't, so those are summed as floats.
+def create_sat(arr1, power=1):
+
+	arr1 = np.asarray(arr1)
+	if arr1.dtype.kind in 'uib' and arr1.dtype.itemsize*power <= 4:
+		dtype = np.int64
+	else:
+		dtype = np.float64
+
+	(dh1, dw1) = arr1.shape
+	sat = np.zeros((dh1 + 1, dw1 + 1), dtype=dtype)
+	if power == 2:
+		values = arr1.astype(dtype)
+		values *= values
+	else:
+		values = arr1
+	# Along each row, then add each row onto the next (which is a lot quicker
+	# than np.cumsum down the columns)
+	np.cumsum(values, axis=1, dtype=dtype, out=sat[1:, 1:])
+	for i in range(2, dh1 + 1):
+		np.add(sat[i], sat[i - 1], out=sat[i])
+
+	return sat
+
+
+
+
+
+# The tables are worked out the first time they're asked for and then kept
+# with the image (and shared between server workers, see image_cache.py).
+# Returns the sum table and the sum of squares table.
+def get_sat(dict_image):
+
+	def create(arr1):
+		sat = get_shared(arr1, 'sat', create_sat)
+		sat2 = get_shared(arr1, 'sat2', lambda arr1: create_sat(arr1, 2))
+		return sat, sat2
+
+	return get_derived(dict_image['image'][0], 'sat', create)
+
+
+
+
+
+# Turn ROIs in plot coordinates into the (clipped) rows and columns they cover
+def roi_bounds(shape, x_start, x_end, y_start, y_end):
+
+	(dh1, dw1) = shape
+
+	x_start = np.rint(np.atleast_1d(np.asarray(x_start, dtype=np.float64)))
+	x_end = np.rint(np.atleast_1d(np.asarray(x_end, dtype=np.float64)))
+	y_start = np.rint(np.atleast_1d(np.asarray(y_start, dtype=np.float64)))
+	y_end = np.rint(np.atleast_1d(np.asarray(y_end, dtype=np.float64)))
+
+	x0 = np.clip(np.minimum(x_start, x_end), 0, dw1).astype(np.intp)
+	x1 = np.clip(np.maximum(x_start, x_end), 0, dw1).astype(np.intp)
+	y0 = np.clip(np.minimum(y_start, y_end), 0, dh1).astype(np.intp)
+	y1 = np.clip(np.maximum(y_start, y_end), 0, dh1).astype(np.intp)
+
+	return x0, x1, y0, y1
+
+
+
+
+
+# The min and max inside N (non-empty) ROIs. The part of the image covering
+# them is cut into cells along every edge of every ROI and the min and max of
+# each cell found with reduceat, so the image is only read once. Each ROI is
+# then a block of cells. The rows of cells of every ROI are laid end to end
+# (with a padding column so a row can't run into the next) and reduced with
+# reduceat again, then the rows of each ROI.
+def roi_extremes(arr1, x0, x1, y0, y1):
+
+	xs = np.unique(np.concatenate([x0, x1]))
+	ys = np.unique(np.concatenate([y0, y1]))
+	arr_box = np.asarray(arr1[ys[0]:ys[-1], xs[0]:xs[-1]])
+
+	(ix0, ix1) = (np.searchsorted(xs, x0), np.searchsorted(xs, x1))
+	(iy0, iy1) = (np.searchsorted(ys, y0), np.searchsorted(ys, y1))
+	n_rows = iy1 - iy0
+	roi_starts = np.cumsum(n_rows) - n_rows
+	# The cell row of each row of each ROI, and where it starts and ends in
+	# the (padded) cells
+	roi_rows = np.repeat(iy0 - roi_starts, n_rows) + np.arange(n_rows.sum())
+	starts = roi_rows*len(xs) + np.repeat(ix0, n_rows)
+	ends = roi_rows*len(xs) + np.repeat(ix1, n_rows)
+	segments = np.stack([starts, ends], axis=1).ravel()
+
+	extremes = []
+	for ufunc in (np.minimum, np.maximum):
+		cells = ufunc.reduceat(ufunc.reduceat(arr_box, xs[:-1] - xs[0],
+			axis=1), ys[:-1] - ys[0], axis=0)
+		cells = np.pad(cells, ((0, 0), (0, 1)), mode='edge')
+		row_extremes = ufunc.reduceat(cells.ravel(), segments)[::2]
+		extremes.append(ufunc.reduceat(row_extremes, roi_starts))
+
+	return extremes[0], extremes[1]
+
+
+
+
+
+# Work out the statistics inside N ROIs at once. The corners are arrays (or
+# single numbers). Returns a dictionary of arrays with the 'mean', 'std',
+# 'min', 'max', 'integral' (sum of the pixel values) and number of 'pixels' in
+# each ROI. Empty ROIs (e.g. completely off the image) get NaN.
+def create_roi_stats(dict_image, x_start, x_end, y_start, y_end):
+
+	arr1 = dict_image['image'][0]
+	(sat, sat2) = get_sat(dict_image)
+	(x0, x1, y0, y1) = roi_bounds(arr1.shape, x_start, x_end, y_start, y_end)
+
+	def roi_sums(sat):
+		return (sat[y1, x1] - sat[y0, x1] - sat[y1, x0] + sat[y0, x0]).astype(
+			np.float64)
+
+	pixels = (x1 - x0)*(y1 - y0)
+	integral = roi_sums(sat)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		mean = integral/pixels
+		variance = roi_sums(sat2)/pixels - mean**2
+	std = np.sqrt(np.maximum(variance, 0))
+
+	roi_min = np.full(len(pixels), np.nan)
+	roi_max = np.full(len(pixels), np.nan)
+	full = pixels > 0
+	if full.any():
+		(roi_min[full], roi_max[full]) = roi_extremes(arr1, x0[full], x1[full],
+			y0[full], y1[full])
+
+	return {'mean': mean, 'std': std, 'min': roi_min, 'max': roi_max,
+		'integral': integral, 'pixels': pixels}
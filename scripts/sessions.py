@@ -0,0 +1,320 @@
+################################################################################
+############################## IMPORT LIBRARIES ################################
+
+import os
+import time
+
+import numpy as np
+
+from scripts.image_cache import content_name
+from scripts.profile_metrics import create_prof_metrics, PROF_METRICS
+from scripts.roi_stats import create_roi_stats
+
+################################################################################
+################################################################################
+
+# Saving what's been drawn and worked out in a ColorMapper tab (the profile
+# lines, the zoom box and any other ROIs, plus their results) so it can be
+# loaded back in later, or re-run against a different image without going
+# through the user interface.
+
+# A session is a dictionary of arrays which is saved as a compressed .npz file
+# (so nothing else is needed to read it). It's laid out in columns, one row
+# for each profile ('prof_' columns) and each ROI ('roi_' columns), so lots of
+# sessions can be read in and stuck end to end (see read_sessions) and then
+# worked out all in one go (see evaluate_sessions). A file can hold any number
+# of sessions laid out this way. The samples of all the profiles are one long
+# array with the number of samples in each profile in prof_n_samples. The
+# lines themselves are kept as float64 so that working them out again gives
+# exactly the same samples, the results are float32.
+
+# The image is referred to by a hash of its contents (see content_name in
+# image_cache.py) so it doesn't matter where it's moved to or what it's
+# called.
+
+# Bumped when the layout changes so old files aren't misread
+SESSION_FORMAT = 1
+
+# Where the ColorMapper tab saves sessions (main.py --sessions sets this, see
+# set_session_dir)
+SESSION_DIR = 'sessions'
+
+# The lines/rectangles of the profiles and ROIs
+SESSION_COORDS = ('x_start', 'x_end', 'y_start', 'y_end')
+
+# The statistics kept for each ROI (see roi_stats.py)
+ROI_STATS = ('mean', 'std', 'min', 'max', 'integral', 'pixels')
+
+
+
+
+
+# The hash and file name of the image in a dictionary from create_dict_image
+# (or create_dict_upload). The hash of a file is only worked out when it's
+# first needed.
+def image_reference(dict_image):
+
+	content = dict_image.get('content', [None])[0]
+	filelocation = dict_image.get('file', [None])[0]
+	if content is None and filelocation is not None:
+		content = content_name(filelocation)
+		dict_image['content'] = [content]
+	name = os.path.basename(filelocation) if filelocation is not None else ''
+
+	return content or '', name
+
+
+
+
+
+# The columns for N profiles. Everything is broadcast so single values can be
+# given for settings that are the same for every profile.
+def create_session_profiles(x_start, x_end, y_start, y_end, name=None,
+	width=0, weighting='mean', spacing=0.1):
+
+	(x_start, x_end, y_start, y_end, width, spacing) = np.broadcast_arrays(
+		*(np.atleast_1d(np.asarray(value, dtype=np.float64)) for value in
+		(x_start, x_end, y_start, y_end, width, spacing)))
+	n_profs = len(x_start)
+	if name is None:
+		name = [str(i) for i in range(n_profs)]
+
+	return {'name': np.asarray(name, dtype=str).reshape(n_profs),
+		'x_start': x_start.copy(), 'x_end': x_end.copy(),
+		'y_start': y_start.copy(), 'y_end': y_end.copy(),
+		'width': width.copy(), 'spacing': spacing.copy(),
+		'weighting': np.broadcast_to(np.asarray(weighting, dtype=str),
+		(n_profs,)).copy()}
+
+
+# The columns for N ROIs
+def create_session_rois(x_start, x_end, y_start, y_end, name=None):
+
+	(x_start, x_end, y_start, y_end) = np.broadcast_arrays(
+		*(np.atleast_1d(np.asarray(value, dtype=np.float64)) for value in
+		(x_start, x_end, y_start, y_end)))
+	if name is None:
+		name = [str(i) for i in range(len(x_start))]
+
+	return {'name': np.asarray(name, dtype=str).reshape(len(x_start)),
+		'x_start': x_start.copy(), 'x_end': x_end.copy(),
+		'y_start': y_start.copy(), 'y_end': y_end.copy()}
+
+
+
+
+
+# Work out N profiles (columns as from create_session_profiles) through an
+# image. Profiles with the same width, weighting and spacing are all worked out
+# in a single create_profs call, so the profiles of hundreds of sessions only
+# take a few calls. Returns the number of samples in each profile, all the
+# samples one profile after another and the metrics of each profile (see
+# profile_metrics.py).
+def evaluate_profiles(dict_image, profiles):
+
+	# (The profiles, and so SciPy, are only imported once they're needed so
+	# that main.py can import this module without slowing the start up)
+	from scripts.profiles import create_profs
+
+	arr1 = dict_image['image'][0]
+	n_profs = len(profiles['x_start'])
+	n_samples = np.zeros(n_profs, dtype=np.int64)
+	values = [np.zeros(0)]*n_profs
+	dict_metrics = {metric: np.full(n_profs, np.nan) for metric in PROF_METRICS}
+
+	groups = {}
+	for i, options in enumerate(zip(profiles['width'], profiles['weighting'],
+		profiles['spacing'])):
+		groups.setdefault(options, []).append(i)
+
+	for (width, weighting, spacing), index in groups.items():
+		index = np.array(index)
+		lines = [profiles[coord][index] for coord in SESSION_COORDS]
+		profs, n_samples_group = create_profs(arr1, *lines, spacing=spacing,
+			width=width, weighting=str(weighting))
+		lengths = np.hypot(lines[1] - lines[0], lines[3] - lines[2])
+		for metric, metric_values in create_prof_metrics(profs,
+			n_samples_group, lengths/(n_samples_group - 1)).items():
+			dict_metrics[metric][index] = metric_values
+
+		n_samples[index] = n_samples_group
+		mask = np.arange(profs.shape[1]) < n_samples_group[:, None]
+		for i, values_prof in zip(index, np.split(profs[mask],
+			np.cumsum(n_samples_group)[:-1])):
+			values[i] = values_prof
+
+	return dict({'n_samples': n_samples,
+		'values': np.concatenate([np.zeros(0)] + values)}, **dict_metrics)
+
+
+# Work out the statistics inside N ROIs (columns as from create_session_rois)
+def evaluate_rois(dict_image, rois):
+
+	return create_roi_stats(dict_image, rois['x_start'], rois['x_end'],
+		rois['y_start'], rois['y_end'])
+
+
+
+
+
+# Make a session from an image and the profiles and ROIs drawn on it. The
+# results are worked out here. The session is laid out the same as several
+# put together by read_sessions, just with one of them.
+def create_session(dict_image, profiles, rois, name=''):
+
+	(content, image_name) = image_reference(dict_image)
+	session = {'format': np.array(SESSION_FORMAT),
+		'session': np.array([name]), 'image': np.array([content]),
+		'image_name': np.array([image_name]),
+		'saved': np.array([time.time()])}
+
+	dict_profs = evaluate_profiles(dict_image, profiles)
+	session['prof_session'] = np.zeros(len(profiles['x_start']),
+		dtype=np.int32)
+	for column, values in profiles.items():
+		session['prof_' + column] = values
+	session['prof_n_samples'] = dict_profs['n_samples'].astype(np.int32)
+	session['prof_values'] = dict_profs['values'].astype(np.float32)
+	for metric in PROF_METRICS:
+		session['prof_' + metric] = dict_profs[metric].astype(np.float32)
+
+	dict_stats = evaluate_rois(dict_image, rois)
+	session['roi_session'] = np.zeros(len(rois['x_start']), dtype=np.int32)
+	for column, values in rois.items():
+		session['roi_' + column] = values
+	for stat in ROI_STATS:
+		session['roi_' + stat] = (dict_stats[stat] if stat == 'pixels'
+			else dict_stats[stat].astype(np.float32))
+
+	return session
+
+
+
+
+
+# Save one or more sessions to a file name or file object
+def write_session(file, session):
+
+	if isinstance(file, str):
+		os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+	np.savez_compressed(file, **session)
+
+	return
+
+
+# Read the session(s) in a file name or file object
+def read_session(file):
+
+	with np.load(file, allow_pickle=False) as npz:
+		session = {column: npz[column] for column in npz.files}
+
+	if 'format' not in session or int(session['format']) != SESSION_FORMAT:
+		raise ValueError('Not a session file (or one from a different version)')
+
+	return session
+
+
+# Save sessions in another folder from now on
+def set_session_dir(directory):
+
+	global SESSION_DIR
+
+	SESSION_DIR = directory
+
+	return
+
+
+# Where the ColorMapper tab saves a session of an image
+def session_filelocation(image_name):
+
+	stem = os.path.splitext(image_name)[0] or 'upload'
+
+	return os.path.join(SESSION_DIR, stem + '_' + time.strftime(
+		'%Y%m%d-%H%M%S') + '.npz')
+
+
+
+
+
+# Read lots of session files and put them end to end: one row for each
+# session ('session', 'image', 'image_name' and 'saved') and the 'prof_' and
+# 'roi_' columns of all of them one after another, with which session each
+# row came from in 'prof_session' and 'roi_session'. Sessions without a name
+# are named after their file.
+
+# Reading a file takes about as long whatever's in it (it's mostly reading
+# the header of each column) so hundreds of sessions are much quicker to read
+# back in once they've been saved together into one file (see
+# session_analysis.py --pack).
+def read_sessions(filelocations):
+
+	chunks = []
+	for filelocation in filelocations:
+		chunk = read_session(filelocation)
+		chunk['session'] = np.where(chunk['session'] == '',
+			os.path.splitext(os.path.basename(filelocation))[0],
+			chunk['session'])
+		chunks.append(chunk)
+	if not chunks:
+		raise ValueError('No sessions to read')
+
+	# The row numbers of the sessions go up by the number of sessions before
+	offsets = np.cumsum([0] + [len(chunk['session']) for chunk in chunks])
+	for chunk, offset in zip(chunks, offsets):
+		chunk['prof_session'] = chunk['prof_session'] + offset
+		chunk['roi_session'] = chunk['roi_session'] + offset
+
+	sessions = {'format': np.array(SESSION_FORMAT)}
+	for column in chunks[0]:
+		if column != 'format':
+			sessions[column] = np.concatenate([chunk[column]
+				for chunk in chunks])
+
+	return sessions
+
+
+
+
+
+# Work out every profile and ROI of a session (or sessions put together by
+# read_sessions) again, through a different image. Returns the 'prof_' and
+# 'roi_' results columns in the same layout as the session, plus the RMS
+# difference between each new profile and the saved one (NaN if they don't
+# have the same number of samples).
+def evaluate_sessions(dict_image, sessions):
+
+	profiles = {column: sessions['prof_' + column] for column in ('name',
+		'width', 'weighting', 'spacing') + SESSION_COORDS}
+	rois = {column: sessions['roi_' + column] for column in SESSION_COORDS}
+
+	dict_profs = evaluate_profiles(dict_image, profiles)
+	results = {'prof_n_samples': dict_profs['n_samples'],
+		'prof_values': dict_profs['values']}
+	for metric in PROF_METRICS:
+		results['prof_' + metric] = dict_profs[metric]
+
+	# The saved and new samples line up if each profile has the same number
+	# of samples as before (which it will unless the session was saved with
+	# a different version). The differences are summed for each profile with
+	# a single reduceat.
+	n_saved = sessions['prof_n_samples']
+	n_samples = dict_profs['n_samples']
+	rms = np.full(len(n_samples), np.nan)
+	if np.array_equal(n_samples, n_saved) and len(n_samples):
+		squared = (dict_profs['values'] - sessions['prof_values'])**2
+		rms = np.sqrt(np.add.reduceat(squared, np.cumsum(n_samples)
+			- n_samples)/n_samples)
+	else:
+		(starts, starts_saved) = (np.cumsum(n_samples) - n_samples,
+			np.cumsum(n_saved) - n_saved)
+		for i in np.flatnonzero(n_samples == n_saved):
+			rms[i] = np.sqrt(np.mean((dict_profs['values'][starts[i]:starts[i]
+				+ n_samples[i]] - sessions['prof_values'][starts_saved[i]:
+				starts_saved[i] + n_samples[i]])**2))
+	results['prof_rms'] = rms
+
+	dict_stats = evaluate_rois(dict_image, rois)
+	for stat in ROI_STATS:
+		results['roi_' + stat] = dict_stats[stat]
+
+	return results
@@ -0,0 +1,131 @@
+################################################################################
+############################## IMPORT LIBRARIES ################################
+
+from scipy import ndimage
+import numpy as np
+
+# Shared store for things worked out from an image
+from scripts.image_cache import get_derived, get_shared_dict
+
+################################################################################
+################################################################################
+
+# Find the proton spots in a Logos image and work out the centroid, FWHM in x
+# and y, rotation and integral of each one. Everything is done for all the
+# spots at once (label the image, then sum up the moments of every spot with
+# np.bincount) so it's quick enough to run every time an image is loaded.
+
+# Pixels more than this fraction of the way from the background to the
+# brightest pixel in the image are counted as being part of a spot.
+SPOT_THRESHOLD = 0.25
+
+# Spots smaller than this (in pixels) are ignored as noise
+SPOT_MIN_PIXELS = 5
+
+# Convert a Gaussian sigma to a FWHM
+SIGMA_TO_FWHM = 2*np.sqrt(2*np.log(2))
+
+
+
+
+
+# The size of each spot is worked out from the pixels above half of the spot's
+# own peak. For a Gaussian spot cut off at a fraction f of its peak the second
+# moments are smaller than the true variance by this factor, so dividing by it
+# gives the true sigma.
+def truncated_variance_factor(f):
+
+	u = np.log(1/f)
+
+	return 1 - u*f/(1 - f)
+
+
+
+
+
+# Find all the spots in the image. Returns a dictionary of arrays (one entry
+# per spot) with the centroid ('x', 'y'), 'fwhm_x', 'fwhm_y', 'rotation' (of
+# the long axis from the x axis, in degrees), 'integral' (background
+# subtracted), 'peak' and 'pixels'. The sizes and integral assume the spots are
+# roughly Gaussian.
+def find_spots(arr1, threshold=SPOT_THRESHOLD, min_pixels=SPOT_MIN_PIXELS):
+
+	arr1 = np.asarray(arr1, dtype=np.float32)
+
+	# Estimate the background from a sample of the image (most of it is
+	# background so the median is a good enough guess)
+	background = float(np.median(arr1[::8, ::8]))
+	level = background + threshold*(float(arr1.max()) - background)
+
+	labels, n_spots = ndimage.label(arr1 > level)
+	if n_spots == 0:
+		return {key: np.zeros(0) for key in ('x', 'y', 'fwhm_x', 'fwhm_y',
+			'rotation', 'integral', 'peak', 'pixels')}
+
+	# Every pixel that's part of a spot, which spot it belongs to and its
+	# background subtracted value
+	(ys, xs) = np.nonzero(labels)
+	spot = labels[ys, xs] - 1
+	value = arr1[ys, xs] - background
+
+	pixels = np.bincount(spot, minlength=n_spots)
+	integral = np.bincount(spot, weights=value, minlength=n_spots)
+	peak = np.zeros(n_spots)
+	np.maximum.at(peak, spot, value)
+
+	# Use the pixels above half of each spot's peak (or the threshold if that's
+	# higher) to work out the size and shape.
+	cut = np.maximum(0.5, (level - background)/np.maximum(peak, 1e-12))
+	cut = np.minimum(cut, 0.99)
+	keep = value >= cut[spot]*peak[spot]
+	spot_k = spot[keep]
+	w = value[keep]
+	x = xs[keep].astype(np.float64)
+	y = ys[keep].astype(np.float64)
+
+	sw = np.bincount(spot_k, weights=w, minlength=n_spots)
+	sw[sw == 0] = np.nan
+	cx = np.bincount(spot_k, weights=w*x, minlength=n_spots)/sw
+	cy = np.bincount(spot_k, weights=w*y, minlength=n_spots)/sw
+	dx = x - cx[spot_k]
+	dy = y - cy[spot_k]
+	factor = truncated_variance_factor(cut)
+	cxx = np.bincount(spot_k, weights=w*dx*dx, minlength=n_spots)/sw/factor
+	cyy = np.bincount(spot_k, weights=w*dy*dy, minlength=n_spots)/sw/factor
+	cxy = np.bincount(spot_k, weights=w*dx*dy, minlength=n_spots)/sw/factor
+
+	rotation = np.degrees(0.5*np.arctan2(2*cxy, cxx - cyy))
+
+	# The sum only includes the pixels above the threshold. For a Gaussian spot
+	# cut off at a fraction f of its peak that's (1 - f) of the total so scale
+	# it back up.
+	with np.errstate(divide='ignore', invalid='ignore'):
+		integral = integral/(1 - (level - background)/peak)
+
+	dict_spots = {
+		'x': cx,
+		'y': cy,
+		'fwhm_x': SIGMA_TO_FWHM*np.sqrt(cxx),
+		'fwhm_y': SIGMA_TO_FWHM*np.sqrt(cyy),
+		'rotation': rotation,
+		'integral': integral,
+		'peak': peak,
+		'pixels': pixels,
+		}
+
+	keep_spots = (pixels >= min_pixels) & np.isfinite(cx)
+
+	return {key: column[keep_spots] for key, column in dict_spots.items()}
+
+
+
+
+
+# Spots are only found once per image (with the default settings) and shared
+# (and kept in the disk cache, see image_cache.py).
+def get_spots(dict_image):
+
+	def create(arr1):
+		return get_shared_dict(arr1, 'spots', find_spots)
+
+	return get_derived(dict_image['image'][0], 'spots', create)
@@ -0,0 +1,391 @@
+################################################################################
+############################## IMPORT LIBRARIES ################################
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from scripts.image_data import create_dict_image
+from scripts.image_pyramid import get_pyramid
+from scripts.profiles import prefilter_image
+from scripts.spots import get_spots
+from scripts.metrics import timed, increment
+
+################################################################################
+################################################################################
+
+# Watch a folder for new images from the detectors. New files are picked up
+# with inotify (on Linux) or by checking the folder every so often otherwise,
+# and are only read once they've stopped changing for WATCH_SETTLE_S seconds so
+# half written files aren't read. Each new image is decoded and analysed
+# (pyramid, spots, spline coefficients, plus any extra analysis given) on a
+# pool of worker threads, so it goes straight into the shared image cache, and
+# is then passed to everything that has subscribed (e.g. the ColorMapper tab
+# of each open session). The images are read straight into memory rather than
+# memory-mapped (see image_loader.py) as the detector software may well write
+# the next frame over them.
+
+# With several server workers only one of them watches the folder. It writes
+# each image it's finished with on a new line of an announcement file in the
+# shared directory, which a WatchFollower in each of the other workers reads
+# to pass the image on to its own sessions.
+
+# File types which are picked up
+WATCH_EXTENSIONS = ('.tif', '.tiff', '.bmp', '.raw')
+
+# How long (in seconds) a file's size and modification time have to stay the
+# same before it's read
+WATCH_SETTLE_S = 1.0
+
+# How often (in seconds) the folder is checked when inotify isn't used, and how
+# often files waiting to settle are checked
+WATCH_POLL_S = 0.5
+
+# Number of images analysed at the same time
+WATCH_WORKERS = 2
+
+# How many times to try reading a file which fails (it might still have been
+# being written)
+WATCH_RETRIES = 3
+
+# inotify events (from sys/inotify.h)
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+
+
+
+# Open an inotify watch on a folder. Returns the file descriptor or None if
+# inotify isn't available.
+def open_inotify(directory):
+
+	if not sys.platform.startswith('linux'):
+		return None
+
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		fd = libc.inotify_init1(os.O_CLOEXEC)
+	except (OSError, AttributeError):
+		return None
+	if fd < 0:
+		return None
+
+	wd = libc.inotify_add_watch(fd, os.fsencode(directory),
+		IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+	if wd < 0:
+		os.close(fd)
+		return None
+
+	return fd
+
+
+# Read the names of the files in a block of inotify events
+def read_inotify(fd):
+
+	data = os.read(fd, 64*1024)
+	names = []
+	i = 0
+	while i < len(data):
+		(wd, mask, cookie, length) = INOTIFY_EVENT.unpack_from(data, i)
+		i += INOTIFY_EVENT.size
+		names.append(os.fsdecode(data[i:i + length].rstrip(b'\0')))
+		i += length
+
+	return names
+
+
+
+
+
+class FolderWatcher:
+
+	# analyse, if given, is called (on a worker thread) with the filelocation
+	# and the dictionary of each new image and can do any extra analysis, e.g.
+	# working out profiles and saving them. If announce is given each image
+	# sent to the subscribers is also added to the end of that file (for the
+	# WatchFollowers in other processes).
+	def __init__(self, directory, analyse=None, settle_s=WATCH_SETTLE_S,
+		poll_s=WATCH_POLL_S, workers=WATCH_WORKERS, use_inotify=True,
+		announce=None):
+
+		self.directory = os.path.abspath(directory)
+		self.analyse = analyse
+		self.announce = announce
+		self.settle_s = settle_s
+		self.poll_s = poll_s
+		self.use_inotify = use_inotify
+
+		self.executor = ThreadPoolExecutor(max_workers=workers)
+		self.lock = threading.Lock()
+		self.stopped = threading.Event()
+		self.subscribers = []
+		# Files seen in the folder: filelocation -> (size, mtime)
+		self.seen = {}
+		# Files waiting to settle: filelocation -> [size, mtime, time
+		# unchanged since, tries]
+		self.waiting = {}
+		# Each new file gets the next number so that if images finish out of
+		# order the subscribers are never sent an older one after a newer one
+		self.next_number = 0
+		self.last_sent = -1
+		self.latest = None
+
+	def start(self):
+
+		# Files already there when the watch starts are ignored
+		for filelocation in self.list_images():
+			self.seen[filelocation] = self.stat(filelocation)
+
+		self.fd = open_inotify(self.directory) if self.use_inotify else None
+		threading.Thread(target=self.run_watch, daemon=True).start()
+		threading.Thread(target=self.run_settle, daemon=True).start()
+
+		return self
+
+	def stop(self):
+
+		self.stopped.set()
+		self.executor.shutdown(wait=False)
+
+		return
+
+	# callback is called with the filelocation and dictionary of each new
+	# image, on a worker thread. If it returns False it's unsubscribed.
+	def subscribe(self, callback):
+
+		with self.lock:
+			self.subscribers.append(callback)
+
+		return
+
+	def unsubscribe(self, callback):
+
+		with self.lock:
+			if callback in self.subscribers:
+				self.subscribers.remove(callback)
+
+		return
+
+	# The newest image in the folder (or None if there aren't any)
+	def latest_image(self):
+
+		if self.latest is not None:
+			return self.latest
+		images = self.list_images()
+		if not images:
+			return None
+
+		return max(images, key=os.path.getmtime)
+
+	def list_images(self):
+
+		return [entry.path for entry in os.scandir(self.directory)
+			if entry.is_file() and os.path.splitext(entry.name)[1].lower()
+			in WATCH_EXTENSIONS]
+
+	def stat(self, filelocation):
+
+		try:
+			stat = os.stat(filelocation)
+		except OSError:
+			return None
+
+		return (stat.st_size, stat.st_mtime_ns)
+
+
+
+	############################################################################
+	######################## SPOTTING NEW FILES ################################
+
+	# Note down a new (or changed) file to wait for it to settle
+	def found(self, filelocation):
+
+		if os.path.splitext(filelocation)[1].lower() not in WATCH_EXTENSIONS:
+			return
+		stat = self.stat(filelocation)
+		if stat is None or stat[0] == 0:
+			return
+
+		with self.lock:
+			if self.seen.get(filelocation) == stat:
+				return
+			self.seen[filelocation] = stat
+			if filelocation not in self.waiting:
+				self.waiting[filelocation] = [stat, time.monotonic(), 0]
+
+		return
+
+	def run_watch(self):
+
+		while not self.stopped.is_set():
+			if self.fd is not None:
+				(ready, _, _) = select.select([self.fd], [], [], self.poll_s)
+				if ready:
+					for name in read_inotify(self.fd):
+						self.found(os.path.join(self.directory, name))
+			else:
+				for filelocation in self.list_images():
+					self.found(filelocation)
+				self.stopped.wait(self.poll_s)
+
+		if self.fd is not None:
+			os.close(self.fd)
+
+		return
+
+	# Once a file hasn't changed for settle_s it's sent off to be analysed
+	def run_settle(self):
+
+		while not self.stopped.wait(min(self.poll_s, self.settle_s/4)):
+			now = time.monotonic()
+			ready = []
+			with self.lock:
+				for filelocation, waiting in list(self.waiting.items()):
+					stat = self.stat(filelocation)
+					if stat is None:
+						del self.waiting[filelocation]
+					elif stat != waiting[0]:
+						waiting[0] = stat
+						waiting[1] = now
+					elif now - waiting[1] >= self.settle_s:
+						del self.waiting[filelocation]
+						ready.append((filelocation, waiting[2]))
+			for filelocation, tries in ready:
+				self.submit(filelocation, tries)
+
+		return
+
+
+
+	############################################################################
+	######################## ANALYSING THE FILES ###############################
+
+	def submit(self, filelocation, tries=0):
+
+		with self.lock:
+			number = self.next_number
+			self.next_number += 1
+
+		self.executor.submit(self.process, filelocation, number, tries)
+
+		return
+
+	@timed('watch_process')
+	def process(self, filelocation, number, tries):
+
+		try:
+			dict_image = create_dict_image(filelocation, memory_map=False)
+			get_pyramid(dict_image)
+			get_spots(dict_image)
+			prefilter_image(dict_image['image'][0])
+		except Exception as error:
+			# It might not have finished being written, so try again later
+			if tries + 1 < WATCH_RETRIES:
+				with self.lock:
+					self.waiting[filelocation] = [self.stat(filelocation),
+						time.monotonic(), tries + 1]
+			else:
+				print('\nCould not read ' + filelocation + ': ' + str(error))
+			return
+
+		# The image is still shown if the extra analysis fails
+		if self.analyse is not None:
+			try:
+				self.analyse(filelocation, dict_image)
+			except Exception:
+				print('\nCould not analyse ' + filelocation + ':')
+				traceback.print_exc()
+				increment('watch_analysis_errors')
+		increment('watch_images')
+
+		if self.send(filelocation, dict_image, number) and (
+			self.announce is not None):
+			with open(self.announce, 'a') as f:
+				f.write(filelocation + '\n')
+
+		return
+
+	# Pass an image on to the subscribers, unless something newer has been
+	# sent already. Returns whether it was sent.
+	def send(self, filelocation, dict_image, number):
+
+		with self.lock:
+			if number < self.last_sent:
+				return False
+			self.last_sent = number
+			self.latest = filelocation
+			subscribers = list(self.subscribers)
+
+		for callback in subscribers:
+			if callback(filelocation, dict_image) is False:
+				self.unsubscribe(callback)
+
+		return True
+
+
+
+
+
+# Passes on the images another process's FolderWatcher has announced (see
+# above) to the subscribers in this one, as if it was watching the folder
+# itself. By the time they're announced the images are in the shared
+# directory, so reading them here is cheap.
+class WatchFollower(FolderWatcher):
+
+	def __init__(self, directory, announce, poll_s=WATCH_POLL_S):
+
+		FolderWatcher.__init__(self, directory, poll_s=poll_s, workers=1,
+			use_inotify=False, announce=announce)
+
+	def start(self):
+
+		# Only images announced from now on are passed on
+		try:
+			position = os.path.getsize(self.announce)
+		except OSError:
+			position = 0
+		threading.Thread(target=self.run_follow, args=(position,),
+			daemon=True).start()
+
+		return self
+
+	def run_follow(self, position):
+
+		while not self.stopped.wait(self.poll_s):
+			try:
+				with open(self.announce, 'rb') as f:
+					f.seek(position)
+					lines = f.read()
+			except OSError:
+				continue
+			# (Only whole lines, the last one might still be being written)
+			lines = lines[:lines.rfind(b'\n') + 1]
+			position += len(lines)
+			for filelocation in os.fsdecode(lines).splitlines():
+				self.executor.submit(self.follow, filelocation,
+					self.next_number)
+				self.next_number += 1
+
+		return
+
+	def follow(self, filelocation, number):
+
+		try:
+			dict_image = create_dict_image(filelocation, memory_map=False)
+		except Exception as error:
+			print('\nCould not read ' + filelocation + ': ' + str(error))
+			return
+
+		self.send(filelocation, dict_image, number)
+
+		return
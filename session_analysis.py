@@ -0,0 +1,169 @@
+'''
+
+################################################################################
+######################### SESSION ANALYSIS SCRIPT ##############################
+
+# This script works out the profiles and ROIs of saved sessions (see
+# scripts/sessions.py, they're saved from the ColorMapper tab) again against a
+# new baseline image, without any of the user interface. Every profile of
+# every session is worked out in a handful of calls however many sessions
+# there are.
+
+# Usage:
+#   python session_analysis.py SESSIONS [SESSIONS ...] --baseline IMAGE
+#       --output results.csv
+#       [--dark DARK] [--flat FLAT] [--filter median] [--background local]
+#   python session_analysis.py SESSIONS [SESSIONS ...] --pack sessions.npz
+
+# SESSIONS can be directories (every .npz file in them is used) or glob
+# patterns.
+
+# The results are written to <output>_metrics (one row for each profile in
+# each session, with each metric as saved, against the baseline and the
+# difference, plus the RMS difference between the saved and new profiles) and
+# <output>_rois (the same for the ROI statistics), as CSV or Parquet depending
+# on the extension of the output file.
+
+# --pack saves all the sessions together into one file instead. This is read
+# back in much more quickly than hundreds of separate files.
+
+################################################################################
+################################################################################
+
+'''
+
+
+
+################################################################################
+####################### IMPORT LIBRARIES AND SCRIPTS ###########################
+
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from batch_analysis import write_dataframe
+from scripts.image_data import create_dict_image
+from scripts.profile_metrics import PROF_METRICS
+from scripts.sessions import (read_sessions, write_session,
+    evaluate_sessions, image_reference, ROI_STATS)
+from scripts.preprocessing import (add_preprocessing_arguments,
+    preprocessing_from_args, set_preprocessing)
+
+################################################################################
+
+
+
+
+################################################################################
+############################ READ THE INPUTS ###################################
+
+# Turn the directories/glob patterns into a sorted list of session files.
+def find_sessions(patterns):
+
+    filelocations = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for filename in os.listdir(pattern):
+                if os.path.splitext(filename)[1].lower() == '.npz':
+                    filelocations.append(os.path.join(pattern, filename))
+        else:
+            filelocations.extend(glob.glob(pattern))
+
+    return sorted(set(filelocations))
+
+################################################################################
+
+
+
+
+################################################################################
+########################## COLLECT THE RESULTS #################################
+
+# One row for each profile (or ROI) of every session with each value as it was
+# saved, against the baseline and the difference between them
+def compare_columns(sessions, results, prefix, label, values):
+
+    i_session = sessions[prefix + 'session']
+    df = pd.DataFrame({'session': sessions['session'][i_session],
+        'image': sessions['image_name'][i_session],
+        'same_image': sessions['image'][i_session] == results['image'],
+        label: sessions[prefix + 'name']})
+
+    for value in values:
+        saved = sessions[prefix + value].astype(np.float64)
+        baseline = results[prefix + value].astype(np.float64)
+        df[value] = saved
+        df[value + '_baseline'] = baseline
+        df[value + '_diff'] = baseline - saved
+
+    return df
+
+################################################################################
+
+
+
+
+################################################################################
+######################### DEFINE MAIN FUNCTION #################################
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Work out saved sessions '
+        'again against a new baseline image.')
+    parser.add_argument('sessions', nargs='+',
+        help='directories or glob patterns of session files')
+    parser.add_argument('--baseline',
+        help='image to work the sessions out against')
+    parser.add_argument('--output',
+        help='output file name (.csv or .parquet)')
+    parser.add_argument('--pack',
+        help='save all the sessions into this one file instead')
+    # Dark/flat correction, filtering and background subtraction applied to
+    # the baseline first (see scripts/preprocessing.py)
+    add_preprocessing_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.pack is None and (args.baseline is None or args.output is None):
+        parser.error('--baseline and --output are needed (unless packing)')
+
+    start = time.time()
+
+    filelocations = find_sessions(args.sessions)
+    sessions = read_sessions(filelocations)
+    print('\nRead ' + str(len(sessions['session'])) + ' sessions with '
+        + str(len(sessions['prof_session'])) + ' profiles and '
+        + str(len(sessions['roi_session'])) + ' ROIs in: '
+        + str(time.time() - start) + 'sec')
+
+    if args.pack is not None:
+        write_session(args.pack, sessions)
+        print('\nSaved them all to ' + args.pack)
+        return
+
+    set_preprocessing(preprocessing_from_args(args))
+    dict_image = create_dict_image(args.baseline)
+    results = evaluate_sessions(dict_image, sessions)
+    results['image'] = image_reference(dict_image)[0]
+
+    df_metrics = compare_columns(sessions, results, 'prof_', 'profile',
+        PROF_METRICS)
+    df_metrics['rms'] = results['prof_rms']
+    df_rois = compare_columns(sessions, results, 'roi_', 'roi', ROI_STATS)
+
+    (stem, ext) = os.path.splitext(args.output)
+    write_dataframe(df_metrics, stem + '_metrics' + ext)
+    write_dataframe(df_rois, stem + '_rois' + ext)
+
+    print('\nFinished in: ' + str(time.time() - start) + 'sec')
+
+    return
+
+
+################################################################################
+############################### RUN MAIN #######################################
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+import os
+import sys
+import threading
+
+import pytest
+
+# The tests import the scripts the same way main.py does, from the top of the
+# repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scripts import image_cache
+
+
+# Every test starts with an empty cache so nothing is left over from earlier
+# runs, and without the directory shared between server workers or the disk
+# cache (which would otherwise be the user's own). (It also gets its own lock
+# so a test which deadlocks doesn't hold up the rest.)
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+
+    monkeypatch.setattr(image_cache, 'SHARED_CACHE_DIR', None)
+    monkeypatch.setattr(image_cache, 'DISK_CACHE_DIR', None)
+    image_cache.clear_cache()
+    monkeypatch.setattr(image_cache, '_cache_lock', threading.Lock())
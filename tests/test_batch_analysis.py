@@ -0,0 +1,65 @@
+import json
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+import batch_analysis
+
+
+def write_batch(tmp_path):
+
+    arrs = []
+    for i in range(3):
+        arr0 = np.arange(40*50, dtype=np.uint16).reshape(40, 50) + i
+        Image.fromarray(arr0).save(str(tmp_path / ('image' + str(i)
+            + '.tif')))
+        arrs.append(arr0[::-1])
+    definitions = str(tmp_path / 'definitions.json')
+    with open(definitions, 'w') as f:
+        json.dump({'profiles': [{'name': 'across', 'x_start': 5, 'x_end': 45,
+            'y_start': 20, 'y_end': 20}], 'rois': [{'name': 'centre',
+            'x_start': 10, 'x_end': 30, 'y_start': 5, 'y_end': 25}]}, f)
+
+    return arrs, definitions
+
+
+# Every image gets every profile and ROI, with the ROI statistics the same as
+# numpy's
+def test_batch_analysis(tmp_path):
+
+    arrs, definitions = write_batch(tmp_path)
+    output = str(tmp_path / 'results.csv')
+
+    batch_analysis.main([str(tmp_path), '--definitions', definitions,
+        '--output', output, '--workers', '1', '--spacing', '1'])
+
+    df_prof = pd.read_csv(str(tmp_path / 'results_profiles.csv'))
+    df_roi = pd.read_csv(str(tmp_path / 'results_rois.csv'))
+
+    assert df_prof.groupby('file').size().tolist() == [40]*3
+    np.testing.assert_allclose(df_prof['position'][:40], np.linspace(0, 40,
+        40))
+    assert len(df_roi) == 3
+    for arr1, (_, row) in zip(arrs, df_roi.iterrows()):
+        arr_roi = arr1[5:25, 10:30].astype(np.float64)
+        np.testing.assert_allclose([row['mean'], row['std'], row['min'],
+            row['max'], row['pixels']], [arr_roi.mean(), arr_roi.std(),
+            arr_roi.min(), arr_roi.max(), arr_roi.size])
+
+
+# --cache keeps the profiles in the usual place even if the disk cache has
+# been switched off for the server
+def test_batch_cache_default_dir(tmp_path, monkeypatch):
+
+    arrs, definitions = write_batch(tmp_path)
+    disk_cache = tmp_path / 'cache'
+    monkeypatch.setattr(batch_analysis, 'DISK_CACHE_DIR', None)
+    monkeypatch.setattr(batch_analysis, 'DEFAULT_DISK_CACHE_DIR',
+        str(disk_cache))
+
+    batch_analysis.main([str(tmp_path / '*.tif'), '--definitions',
+        definitions, '--output', str(tmp_path / 'results.csv'), '--workers',
+        '1', '--cache'])
+
+    assert any('_prof' in path.name for path in disk_cache.iterdir())
@@ -0,0 +1,39 @@
+import numpy as np
+from bokeh.palettes import Spectral11
+
+from scripts.colour_mapping import apply_lut, create_lut, create_tile_colouring
+
+
+# The look up of every 16 bit value gives the same colours as working each
+# pixel out
+def test_lut_matches_float():
+
+    arr1 = np.arange(0, 65536, 8, dtype=np.uint16).reshape(-1, 16)
+    lut = create_lut(Spectral11)
+
+    np.testing.assert_array_equal(apply_lut(arr1, 1000, 50000, lut),
+        apply_lut(arr1.astype(np.float32), 1000, 50000, lut))
+
+
+# Values are spread evenly over the palette and clipped to its ends, and NaNs
+# are transparent
+def test_lut_window():
+
+    lut = create_lut(['#000000', '#808080', '#ffffff'])
+    rgba = apply_lut(np.array([[-5, 0, 1.5, 2.5, 10, np.nan]]), 0, 3, lut)
+
+    colours = rgba.view(np.uint8).reshape(6, 4)
+    assert colours[:, 0].tolist() == [0, 0, 128, 255, 255, 0]
+    assert colours[:, 3].tolist() == [255]*5 + [0]
+
+
+def test_tile_colouring():
+
+    arr_tiles = np.arange(256*256, dtype=np.uint16).reshape(256, 256)
+    colour = create_tile_colouring(0, 256*256, Spectral11)
+
+    rgba = colour(arr_tiles)
+
+    assert rgba.shape == arr_tiles.shape and rgba.dtype == np.uint32
+    np.testing.assert_array_equal(rgba, apply_lut(arr_tiles, 0, 256*256,
+        create_lut(Spectral11)))
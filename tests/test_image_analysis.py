@@ -0,0 +1,88 @@
+import base64
+
+import numpy as np
+import pytest
+from bokeh.document import Document
+from PIL import Image
+
+from scripts import image_analysis
+from scripts.image_analysis import ColorMapper
+
+
+class FakeWatcher:
+
+    def __init__(self):
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+
+# The ColorMapper tab shows the Charmander image, which lives on a network
+# drive
+@pytest.fixture(autouse=True)
+def charmander(tmp_path, monkeypatch):
+
+    filelocation = str(tmp_path / 'charmander.png')
+    Image.fromarray(np.zeros((8, 8, 4), dtype=np.uint8)).save(filelocation)
+    monkeypatch.setattr(image_analysis, 'FILE_CHARMANDER', filelocation)
+
+
+# An upload of a different size gets the main plot resized to fit it, and
+# both plots coloured in over its range
+def test_main_plot_follows_image_size(tmp_path):
+
+    filelocation = str(tmp_path / 'image.tif')
+    Image.fromarray(np.zeros((64, 64), dtype=np.uint16)).save(filelocation)
+    upload = str(tmp_path / 'upload.tif')
+    Image.fromarray(np.arange(300*100, dtype=np.uint16).reshape(100,
+        300)).save(upload)
+
+    doc = Document()
+    doc.add_root(ColorMapper(filelocation))
+    file_input = doc.select_one({'name': 'file_input'})
+    with open(upload, 'rb') as f:
+        file_input.value = base64.b64encode(f.read()).decode()
+
+    p_main = doc.select_one({'name': 'p_main'})
+    assert (p_main.x_range.start, p_main.x_range.end) == (0, 300)
+    assert (p_main.y_range.start, p_main.y_range.end) == (0, 100)
+    assert (p_main.plot_width, p_main.plot_height) == (150, 50)
+    color_mapper = p_main.renderers[0].glyph.color_mapper
+    assert (color_mapper.low, color_mapper.high) == (0, 300*100 - 1)
+
+
+# Coloured in on the server, the plots are sent RGBA tiles of just the part
+# they show
+def test_server_render_sends_rgba_tiles(tmp_path):
+
+    filelocation = str(tmp_path / 'image.tif')
+    Image.fromarray(np.arange(1024*1024, dtype=np.uint32).reshape(1024,
+        1024).astype(np.uint16)).save(filelocation)
+
+    doc = Document()
+    doc.add_root(ColorMapper(filelocation, debounce_ms=0, server_render=True))
+
+    p_zoom = doc.select_one({'name': 'p_zoom'})
+    arr_tiles = p_zoom.renderers[0].data_source.data['image'][0]
+    assert arr_tiles.dtype == np.uint32
+    assert arr_tiles.shape[0] < 1024
+
+
+# A session closed before any new image comes in stops watching the folder
+def test_watch_unsubscribed_when_session_closes(tmp_path):
+
+    filelocation = str(tmp_path / 'image.tif')
+    Image.fromarray(np.zeros((64, 64), dtype=np.uint16)).save(filelocation)
+    watcher = FakeWatcher()
+    doc = Document()
+    doc.add_root(ColorMapper(filelocation, watcher=watcher, doc=doc))
+    assert len(watcher.subscribers) == 1
+
+    for callback in doc.session_destroyed_callbacks:
+        callback(None)
+
+    assert watcher.subscribers == []
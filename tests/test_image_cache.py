@@ -0,0 +1,193 @@
+import gc
+import os
+import threading
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+from scripts import image_cache, image_loader
+from scripts.image_cache import get_image, get_derived, clear_cache
+
+
+# Run func on another thread and fail (rather than hang) if it doesn't finish
+def run_with_timeout(func, timeout=10):
+
+    thread = threading.Thread(target=func, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'deadlocked'
+
+
+def write_images(directory, n_images, shape=(64, 64)):
+
+    filelocations = []
+    for i in range(n_images):
+        filelocation = str(directory / ('image' + str(i) + '.tif'))
+        Image.fromarray(np.full(shape, i, dtype=np.uint16)).save(filelocation)
+        filelocations.append(filelocation)
+
+    return filelocations
+
+
+def test_same_array_shared(tmp_path):
+
+    filelocation = write_images(tmp_path, 1)[0]
+    arr1 = get_image(filelocation)
+
+    assert get_image(filelocation) is arr1
+    assert not arr1.flags.writeable
+
+
+# Opening more images than fit keeps the memory actually held by the cache
+# within the cap
+def test_resident_bytes_bounded(tmp_path, monkeypatch):
+
+    filelocations = write_images(tmp_path, 10, (512, 512))
+    # (The whole file is read in, header and all)
+    image_bytes = os.path.getsize(filelocations[0])
+    monkeypatch.setattr(image_cache, 'CACHE_MAX_BYTES', 3*image_bytes)
+    monkeypatch.setattr(image_loader, 'MEMORY_MAP', False)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        for filelocation in filelocations:
+            get_image(filelocation)
+        gc.collect()
+        resident = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    assert image_cache.cache_info()['images'] == 3
+    assert resident <= 3*image_bytes + image_bytes//4
+
+
+# Memory-mapped images don't hold any memory of their own so aren't counted
+# against the cap, only their number is limited
+def test_memory_mapped_images_counted(tmp_path, monkeypatch):
+
+    filelocations = write_images(tmp_path, 10)
+    monkeypatch.setattr(image_loader, 'MEMORY_MAP', True)
+    monkeypatch.setattr(image_cache, 'CACHE_MAX_BYTES', 64*64*2)
+    monkeypatch.setattr(image_cache, 'CACHE_MAX_IMAGES', 4)
+
+    for filelocation in filelocations:
+        assert image_cache.is_file_backed(get_image(filelocation))
+
+    assert image_cache.cache_info()['images'] == 4
+    assert image_cache.cache_info()['bytes'] == 0
+
+
+def test_clear_cache_with_derived(tmp_path):
+
+    def run():
+        arr1 = get_image(write_images(tmp_path, 1)[0])
+        get_derived(arr1, 'test', lambda arr1: arr1.sum())
+        del arr1
+        clear_cache()
+
+    run_with_timeout(run)
+
+
+def test_eviction_with_derived(tmp_path, monkeypatch):
+
+    filelocations = write_images(tmp_path, 5)
+    monkeypatch.setattr(image_loader, 'MEMORY_MAP', False)
+    # Room for two of the images
+    monkeypatch.setattr(image_cache, 'CACHE_MAX_BYTES',
+        2*os.path.getsize(filelocations[0]))
+
+    def run():
+        for filelocation in filelocations:
+            get_derived(get_image(filelocation), 'test',
+                lambda arr1: arr1.sum())
+        assert image_cache.cache_info()['images'] == 2
+
+    run_with_timeout(run)
+
+
+def test_derived_forgotten_with_image(tmp_path):
+
+    arr1 = get_image(write_images(tmp_path, 1)[0])
+    get_derived(arr1, 'test', lambda arr1: arr1.sum())
+    n_derived = len(image_cache._derived)
+    del arr1
+    clear_cache()
+
+    assert len(image_cache._derived) == n_derived - 1
+
+
+# Arrays worked out from a cached image (and from those) are charged to it,
+# but views of something already charged aren't counted twice
+def test_derived_charged_to_image(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(image_loader, 'MEMORY_MAP', False)
+    arr1 = get_image(write_images(tmp_path, 1, (100, 100))[0])
+    image_bytes = image_cache.cache_info()['bytes']
+
+    def create_halves(arr2):
+        arr_half = arr2/2
+        return [arr_half[:50], arr_half[50:]]
+
+    arr2 = get_derived(arr1, 'double', lambda arr1: arr1*2.0)
+    get_derived(arr2, 'halves', create_halves)
+
+    assert image_cache.cache_info()['bytes'] == image_bytes + 2*100*100*8
+
+
+# Filling the cache past its cap with images and what's worked out from them
+# keeps the memory actually held within the cap
+def test_resident_bytes_with_derived_bounded(tmp_path, monkeypatch):
+
+    shape = (512, 512)
+    filelocations = write_images(tmp_path, 10, shape)
+    image_bytes = os.path.getsize(filelocations[0])
+    # Room for two images and their (float32) copies
+    monkeypatch.setattr(image_cache, 'CACHE_MAX_BYTES', 2*(image_bytes
+        + shape[0]*shape[1]*4))
+    monkeypatch.setattr(image_loader, 'MEMORY_MAP', False)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        for filelocation in filelocations:
+            get_derived(get_image(filelocation), 'float',
+                lambda arr1: arr1.astype(np.float32))
+        gc.collect()
+        resident = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    assert image_cache.cache_info()['images'] == 2
+    assert resident <= image_cache.CACHE_MAX_BYTES + image_bytes//4
+
+
+# Things worked out from an image are kept in the disk cache and found again
+# by later runs (here after the in-memory cache is cleared), apart from the
+# big things in DISK_CACHE_SKIP
+def test_disk_cache_reused(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(image_loader, 'MEMORY_MAP', False)
+    disk_cache = str(tmp_path / 'cache')
+    image_cache.set_disk_cache_dir(disk_cache)
+    filelocation = write_images(tmp_path, 1)[0]
+    calls = []
+
+    def create(arr1):
+        calls.append(1)
+        return arr1.astype(np.float32)
+
+    for i in range(2):
+        arr1 = get_image(filelocation)
+        value = image_cache.get_shared(arr1, 'level1', create)
+        image_cache.get_shared(arr1, 'sat', create)
+        clear_cache()
+
+    assert image_cache.is_file_backed(arr1)
+    assert image_cache.is_file_backed(value)
+    # (The sat is worked out every time as it isn't kept)
+    assert len(calls) == 3
+    names = os.listdir(disk_cache)
+    assert any('_level1_' in name for name in names)
+    assert not any('_sat_' in name for name in names)
@@ -0,0 +1,51 @@
+import gc
+import weakref
+
+import numpy as np
+
+from scripts import image_cache
+from scripts.image_cache import get_stack, image_key
+from scripts.image_comparison import create_dict_view
+from scripts.image_pyramid import get_pyramid
+from test_image_cache import write_images
+
+
+def test_views_shared():
+
+    stack = np.stack([np.full((8, 8), i + 1, dtype=np.uint16)
+        for i in range(3)])
+
+    assert create_dict_view(stack, 1)['image'][0] is create_dict_view(stack,
+        1)['image'][0]
+    np.testing.assert_array_equal(create_dict_view(stack, 4)['image'][0], 2)
+    np.testing.assert_array_equal(create_dict_view(stack, 6)['image'][0], 3)
+
+
+# The stack is let go of once nothing is using it or any of its views
+def test_views_do_not_keep_stack():
+
+    stack = np.zeros((3, 512, 512), dtype=np.uint16)
+    for i_view in range(7):
+        get_pyramid(create_dict_view(stack, i_view))
+    stack_ref = weakref.ref(stack)
+    del stack
+    gc.collect()
+
+    assert stack_ref() is None
+
+
+# The differences and ratios worked out from a cached stack count against the
+# cache, the views of the images don't (they're part of the stack)
+def test_views_charged_to_stack(tmp_path):
+
+    filelocations = write_images(tmp_path, 3, (32, 32))
+    stack = get_stack(filelocations)
+    stack_bytes = image_cache.cache_info()['bytes'] - sum(
+        image_cache._cache_costs[image_key(f)] for f in filelocations)
+
+    for i_view in range(7):
+        create_dict_view(stack, i_view)
+
+    assert stack_bytes == stack.nbytes
+    assert image_cache._cache_costs[('stack',) + tuple(image_key(f)
+        for f in filelocations)] == stack.nbytes + 4*32*32*4
@@ -0,0 +1,61 @@
+import numpy as np
+from PIL import Image
+
+from scripts import image_loader
+from scripts.image_cache import is_file_backed
+
+
+# With memory-mapping off (as on Windows) the image is read straight in, so
+# nothing keeps the file open for the detector software to trip over
+def test_load_image_without_memory_map(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(image_loader, 'MEMORY_MAP', False)
+    filelocation = str(tmp_path/'frame.tif')
+    arr0 = np.arange(60*80, dtype=np.uint16).reshape(60, 80)
+    Image.fromarray(arr0).save(filelocation)
+
+    arr1 = image_loader.load_image(filelocation)
+
+    assert np.array_equal(arr1, arr0[::-1])
+    assert not is_file_backed(arr1)
+
+
+def test_load_image_memory_mapped(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(image_loader, 'MEMORY_MAP', True)
+    filelocation = str(tmp_path/'frame.tif')
+    arr0 = np.arange(60*80, dtype=np.uint16).reshape(60, 80)
+    Image.fromarray(arr0).save(filelocation)
+
+    arr1 = image_loader.load_image(filelocation)
+
+    assert np.array_equal(arr1, arr0[::-1])
+    assert is_file_backed(arr1)
+
+
+def test_load_raw_without_memory_map(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(image_loader, 'MEMORY_MAP', False)
+    filelocation = str(tmp_path/'frame.raw')
+    arr0 = np.arange(64*64, dtype='<u2').reshape(64, 64)
+    arr0.tofile(filelocation)
+
+    arr1 = image_loader.load_raw(filelocation)
+
+    assert np.array_equal(arr1, arr0[::-1])
+    assert not is_file_backed(arr1)
+    assert not arr1.flags.writeable
+
+
+# Pixels which don't start on a multiple of their size are copied once so
+# they're aligned
+def test_misaligned_pixels_copied():
+
+    arr0 = np.arange(12, dtype='<f4').reshape(3, 4)
+    buffer = b'\0' + arr0.tobytes()
+    layout = (1, 16, np.dtype('<f4'), (3, 4), False)
+
+    arr1 = image_loader.array_from_layout(buffer, layout)
+
+    assert arr1.flags.aligned
+    assert np.array_equal(arr1, arr0[::-1])
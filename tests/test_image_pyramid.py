@@ -0,0 +1,34 @@
+import gc
+import weakref
+
+import numpy as np
+
+from scripts import image_cache
+from scripts.image_pyramid import get_pyramid
+
+
+def test_pyramid_levels():
+
+    arr1 = np.arange(1000*600, dtype=np.float32).reshape(600, 1000)
+    pyramid = get_pyramid({'image': [arr1]})
+
+    assert pyramid[0] is arr1
+    assert [level.shape for level in pyramid] == [(600, 1000), (300, 500),
+        (150, 250)]
+    # The same levels are handed out every time
+    assert get_pyramid({'image': [arr1]})[1] is pyramid[1]
+
+
+# An image (e.g. an upload) is let go of, along with its pyramid, once
+# nothing else uses it
+def test_pyramid_does_not_keep_image():
+
+    arr1 = np.zeros((1024, 1024), dtype=np.uint16)
+    get_pyramid({'image': [arr1]})
+    n_derived = len(image_cache._derived)
+    arr_ref = weakref.ref(arr1)
+    del arr1
+    gc.collect()
+
+    assert arr_ref() is None
+    assert len(image_cache._derived) == n_derived - 1
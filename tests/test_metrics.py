@@ -0,0 +1,57 @@
+import pytest
+
+from scripts import metrics
+
+
+# Each test records into its own empty metrics
+@pytest.fixture(autouse=True)
+def empty_metrics(monkeypatch):
+
+    monkeypatch.setattr(metrics, '_histograms', {})
+    monkeypatch.setattr(metrics, '_counters', {})
+    monkeypatch.setattr(metrics, '_gauges', {})
+    monkeypatch.setattr(metrics, 'WORKER', None)
+    monkeypatch.setattr(metrics, 'METRICS_DIR', None)
+
+
+def test_single_process_has_no_worker_label():
+
+    metrics.observe('create_prof', 0.003, session='a')
+    metrics.set_gauge('startup_seconds', 1.5)
+
+    text = metrics.prometheus_text()
+
+    assert ('image_analysis_span_seconds_count{span="create_prof",'
+        'session="a"} 1') in text
+    assert 'image_analysis_startup_seconds 1.5' in text
+    assert 'worker=' not in text
+
+
+# With several workers /metrics shows every worker's metrics (whichever one
+# answers), each labelled with the worker it came from
+def test_workers_aggregated(tmp_path):
+
+    metrics.set_worker('0', str(tmp_path))
+    metrics.observe('create_prof', 0.003, session='a')
+    metrics.increment('pushed_bytes:tiles', 100, session='a')
+    metrics.set_gauge('startup_seconds', 1.5)
+    metrics.write_snapshot()
+
+    # Then the same process pretends to be a second worker
+    metrics._histograms.clear()
+    metrics._counters.clear()
+    metrics.set_worker('1', str(tmp_path))
+    metrics.observe('create_prof', 0.2, session='b')
+    metrics.set_gauge('startup_seconds', 2.5)
+
+    text = metrics.prometheus_text()
+
+    assert ('image_analysis_span_seconds_count{span="create_prof",'
+        'session="a",worker="0"} 1') in text
+    assert ('image_analysis_span_seconds_count{span="create_prof",'
+        'session="b",worker="1"} 1') in text
+    assert ('image_analysis_pushed_bytes_total{source="tiles",session="a",'
+        'worker="0"} 100') in text
+    assert 'image_analysis_startup_seconds{worker="0"} 1.5' in text
+    assert 'image_analysis_startup_seconds{worker="1"} 2.5' in text
+    assert text.count('# TYPE image_analysis_startup_seconds gauge') == 1
@@ -0,0 +1,72 @@
+import numpy as np
+from PIL import Image
+from scipy import ndimage
+
+from scripts import preprocessing
+from scripts.preprocessing import (median3, preprocess_image,
+    get_preprocessed)
+
+
+def noisy_image(shape=(150, 170), seed=0):
+
+    rng = np.random.default_rng(seed)
+    (y, x) = np.mgrid[:shape[0], :shape[1]]
+    arr1 = 100 + 20*np.sin(x/15.0) + rng.normal(0, 5, shape)
+
+    return arr1.astype(np.uint16)
+
+
+# Splitting the image into tiles (with the halo) gives exactly what filtering
+# the whole image at once does
+def test_tiled_matches_whole_image(monkeypatch):
+
+    arr1 = noisy_image()
+    for settings in ({'filter': 'median'},
+        {'filter': 'median', 'filter_size': 5},
+        {'filter': 'gaussian', 'filter_size': 1.5},
+        {'filter': 'median', 'background': 'local', 'background_size': 8}):
+        monkeypatch.setattr(preprocessing, 'PREPROCESS_TILE', 1000)
+        whole = preprocess_image(arr1, settings)
+        monkeypatch.setattr(preprocessing, 'PREPROCESS_TILE', 32)
+        tiled = preprocess_image(arr1, settings)
+
+        assert np.array_equal(tiled, whole), settings
+
+
+# The min/max network gives the same 3 x 3 median as SciPy
+def test_median3_matches_scipy():
+
+    arr1 = noisy_image().astype(np.float32)
+
+    assert np.array_equal(median3(arr1), ndimage.median_filter(arr1, size=3))
+
+
+# The dark frame is subtracted and the flat evened out, keeping the mean
+def test_dark_flat_correction(tmp_path):
+
+    (y, x) = np.mgrid[:64, :80]
+    dark = np.full((64, 80), 10, dtype=np.uint16)
+    response = 1 + x/80.0
+    flat = (dark + 1000*response).astype(np.uint16)
+    arr1 = (dark + 500*response).astype(np.uint16)
+    Image.fromarray(dark[::-1]).save(str(tmp_path/'dark.tif'))
+    Image.fromarray(flat[::-1]).save(str(tmp_path/'flat.tif'))
+
+    arr_pre = preprocess_image(arr1, {'dark': str(tmp_path/'dark.tif'),
+        'flat': str(tmp_path/'flat.tif')})
+
+    signal = np.asarray(flat, dtype=np.float32) - dark
+    assert np.allclose(arr_pre, 500*signal.mean()/1000, rtol=1e-2)
+
+
+# With no preprocessing the image itself is used, otherwise the corrected image
+# is only worked out once
+def test_preprocessed_once():
+
+    arr1 = noisy_image()
+    arr1.setflags(write=False)
+
+    assert get_preprocessed(arr1) is arr1
+    arr_pre = get_preprocessed(arr1, {'filter': 'median'})
+    assert arr_pre is get_preprocessed(arr1, {'filter': 'median'})
+    assert not arr_pre.flags.writeable
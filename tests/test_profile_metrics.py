@@ -0,0 +1,46 @@
+import numpy as np
+
+from scripts.profile_metrics import create_prof_metrics
+
+
+# A flat top with straight 10 pixel edges, from 30 to 40 and 60 to 70 (the
+# edges are straight so the linear interpolation between samples is exact)
+def trapezoid(x):
+
+    return np.clip(np.minimum(x - 30, 70 - x)/10, 0, 1)
+
+
+def test_trapezoid_metrics():
+
+    x = np.arange(0, 100.5, 0.5)
+
+    dict_metrics = create_prof_metrics(trapezoid(x), len(x), step=0.5)
+
+    np.testing.assert_allclose(dict_metrics['fwhm'], 30)
+    np.testing.assert_allclose(dict_metrics['centre'], 50)
+    np.testing.assert_allclose(dict_metrics['penumbra_left'], 6)
+    np.testing.assert_allclose(dict_metrics['penumbra_right'], 6)
+    # (The central 80% of the FWHM, 38 to 62, reaches 2 pixels down each edge
+    # to 0.8)
+    np.testing.assert_allclose(dict_metrics['flatness'], 100*0.2/1.8)
+    np.testing.assert_allclose(dict_metrics['symmetry'], 0, atol=1e-12)
+
+
+# A Gaussian's FWHM is 2 sqrt(2 ln 2) sigma. Several profiles of different
+# lengths (padded with NaN) are done at once, and an empty one gives NaN.
+def test_gaussian_fwhm():
+
+    sigmas = np.array([3.0, 5.0, 8.0])
+    n_samples = np.array([401, 501, 601, 10])
+    profs = np.full((4, 601), np.nan)
+    for i, sigma in enumerate(sigmas):
+        x = np.arange(n_samples[i])*0.1
+        profs[i, :n_samples[i]] = np.exp(-0.5*((x - x[-1]/2)/sigma)**2)
+
+    dict_metrics = create_prof_metrics(profs, n_samples, step=0.1)
+
+    np.testing.assert_allclose(dict_metrics['fwhm'][:3],
+        2*np.sqrt(2*np.log(2))*sigmas, rtol=1e-3)
+    np.testing.assert_allclose(dict_metrics['peak_position'][:3],
+        (n_samples[:3] - 1)*0.1/2, atol=1e-6)
+    assert np.isnan([values[3] for values in dict_metrics.values()]).all()
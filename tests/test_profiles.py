@@ -0,0 +1,141 @@
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+from scripts.profile_metrics import create_prof_metrics
+from scripts.profiles import (create_prof_coords, create_profs,
+    create_prof_offsets, create_stack_profs, decimate_prof)
+
+
+# The samples of each line are the same as np.linspace along it
+def test_prof_coords_match_linspace():
+
+    n_samples, x_sample, y_sample = create_prof_coords([0, 10], [10, 10],
+        [0, 0], [0, 5], spacing=0.5)
+
+    assert list(n_samples) == [20, 10]
+    np.testing.assert_allclose(x_sample[:20], np.linspace(0, 10, 20))
+    np.testing.assert_allclose(y_sample[20:], np.linspace(0, 5, 10))
+
+
+# Profiles of several lines at once are the same as interpolating each line on
+# its own
+def test_profs_match_single_lines():
+
+    rng = np.random.default_rng(0)
+    arr1 = rng.random((64, 80)).astype(np.float32)
+    x_start, x_end = [5, 60, 10.5], [70, 20, 10.5]
+    y_start, y_end = [5, 50, 3], [40, 10, 60]
+
+    profs, n_samples = create_profs(arr1, x_start, x_end, y_start, y_end,
+        normalise=False)
+
+    for i in range(3):
+        n = n_samples[i]
+        coords = np.vstack((np.linspace(y_start[i], y_end[i], n),
+            np.linspace(x_start[i], x_end[i], n)))
+        expected = map_coordinates(arr1.astype(np.float64), coords, order=3,
+            mode='constant')
+        np.testing.assert_allclose(profs[i, :n], expected, atol=1e-4)
+        assert np.isnan(profs[i, n:]).all()
+
+
+# Along a linear ramp the profile is exactly the ramp, normalised to 100 at
+# its max
+def test_profile_of_ramp():
+
+    arr1 = np.tile(np.arange(100, dtype=np.uint16), (50, 1))
+
+    profs, n_samples = create_profs(arr1, 20, 80, 25, 25, order=1, spacing=1)
+
+    np.testing.assert_allclose(profs[0, :n_samples[0]],
+        np.linspace(20, 80, n_samples[0])*100/80)
+
+
+# A wide profile across a parabola (in y) is the average of the parabola over
+# the offsets, for a line in any direction. A width of 0 is the line itself.
+def test_wide_profile_averages_across_width():
+
+    (y_grid, x_grid) = np.mgrid[0:64, 0:64].astype(np.float64)
+    offsets = create_prof_offsets(6)
+
+    # Along the line y = 32
+    profs, n_samples = create_profs((y_grid - 32)**2, 20, 44, 32, 32,
+        normalise=False, width=6)
+    np.testing.assert_allclose(profs[0, :n_samples[0]], np.mean(offsets**2),
+        atol=1e-3)
+
+    # Along a diagonal, of an image which is a parabola across it
+    arr1 = ((x_grid - y_grid)/np.sqrt(2))**2
+    profs, n_samples = create_profs(arr1, 20, 44, 20, 44, normalise=False,
+        width=6)
+    np.testing.assert_allclose(profs[0, :n_samples[0]], np.mean(offsets**2),
+        atol=1e-3)
+
+    profs, n_samples = create_profs(arr1, 20, 44, 20, 44, normalise=False,
+        width=0)
+    np.testing.assert_allclose(profs[0, :n_samples[0]], 0, atol=1e-3)
+
+
+# The comparison tab's wide profiles through a stack are the same as each
+# image's on its own
+def test_wide_stack_profiles_match_single_images():
+
+    rng = np.random.default_rng(1)
+    stack = rng.random((3, 40, 50)).astype(np.float32)
+
+    profs, n_samples = create_stack_profs(stack, 10, 40, 5, 30, width=4,
+        weighting='gaussian')
+
+    for i_image in range(3):
+        prof, n_sample = create_profs(stack[i_image], 10, 40, 5, 30, width=4,
+            weighting='gaussian')
+        np.testing.assert_allclose(profs[i_image, 0, :n_samples[0]],
+            prof[0, :n_sample[0]], atol=1e-4)
+
+
+# A long profile is cut down to at most two points per bucket, in order,
+# without losing its peaks and dips
+def test_decimated_profile_keeps_extremes():
+
+    rng = np.random.default_rng(2)
+    x = np.arange(100000)*0.1
+    z = rng.random(len(x))
+    z[31234] = 5
+    z[77777] = -5
+
+    x_plot, z_plot = decimate_prof(x, z, x[0], x[-1], 400)
+
+    assert len(z_plot) <= 800
+    assert (np.diff(x_plot) >= 0).all()
+    assert z_plot.max() == 5 and z_plot.min() == -5
+    np.testing.assert_array_equal(z[np.round(x_plot/0.1).astype(int)], z_plot)
+
+
+# Only the part in view (and a sample either side) is kept, at full
+# resolution if it's short enough
+def test_decimated_profile_in_view():
+
+    x = np.arange(1000)*0.5
+    z = np.sin(x)
+
+    x_plot, z_plot = decimate_prof(x, z, 100.2, 110.2, 400)
+
+    np.testing.assert_array_equal(x_plot, x[200:222])
+    np.testing.assert_array_equal(z_plot, z[200:222])
+
+
+# Sampling once per pixel (the default) is plenty for the FWHM of a spot
+def test_fwhm_at_one_sample_per_pixel():
+
+    (y_grid, x_grid) = np.mgrid[0:200, 0:200]
+    arr1 = 1000*np.exp(-((x_grid - 100.3)**2 + (y_grid - 99.6)**2)/(2*6**2))
+
+    fwhms = []
+    for spacing in (1, 0.1):
+        profs, n_samples = create_profs(arr1, 20, 180, 99.6, 99.6,
+            spacing=spacing)
+        step = 160/(n_samples[0] - 1)
+        fwhms.append(create_prof_metrics(profs, n_samples, step)['fwhm'][0])
+
+    np.testing.assert_allclose(fwhms[0], fwhms[1], rtol=2e-3)
+    np.testing.assert_allclose(fwhms[1], 2*np.sqrt(2*np.log(2))*6, rtol=2e-3)
@@ -0,0 +1,90 @@
+import numpy as np
+
+from scripts import roi_stats
+from scripts.image_cache import clear_cache
+from scripts.image_data import create_dict_image
+from scripts.roi_stats import create_roi_stats, create_sat
+from test_image_cache import run_with_timeout, write_images
+
+
+def random_rois(rng, shape, n_rois):
+
+    (dh1, dw1) = shape
+    xs = rng.uniform(-10, dw1 + 10, (2, n_rois))
+    ys = rng.uniform(-10, dh1 + 10, (2, n_rois))
+
+    return xs[0], xs[1], ys[0], ys[1]
+
+
+def check_against_numpy(arr1, rois, stats):
+
+    for i, (x_start, x_end, y_start, y_end) in enumerate(zip(*rois)):
+        x0, x1 = sorted(np.clip(np.rint([x_start, x_end]), 0, arr1.shape[1]))
+        y0, y1 = sorted(np.clip(np.rint([y_start, y_end]), 0, arr1.shape[0]))
+        arr_roi = arr1[int(y0):int(y1), int(x0):int(x1)].astype(np.float64)
+        assert stats['pixels'][i] == arr_roi.size
+        if not arr_roi.size:
+            assert np.isnan(stats['mean'][i]) and np.isnan(stats['min'][i])
+            continue
+        assert np.isclose(stats['mean'][i], arr_roi.mean())
+        assert np.isclose(stats['std'][i], arr_roi.std(), rtol=1e-6)
+        assert stats['min'][i] == arr_roi.min()
+        assert stats['max'][i] == arr_roi.max()
+        assert np.isclose(stats['integral'][i], arr_roi.sum())
+
+
+# Lots of ROIs at once (some overlapping, some off the edge) give the same
+# statistics as numpy does one at a time
+def test_roi_stats_match_numpy():
+
+    rng = np.random.default_rng(0)
+    arr1 = rng.integers(0, 2**16, (120, 150)).astype(np.uint16)
+    rois = random_rois(rng, arr1.shape, 100)
+
+    check_against_numpy(arr1, rois, create_roi_stats({'image': [arr1]},
+        *rois))
+
+
+# The squares of a 32 bit image don't fit in an int64 so they're summed as
+# floats
+def test_roi_stats_32_bit():
+
+    rng = np.random.default_rng(1)
+    arr1 = rng.integers(2**31, 2**32, (60, 80), dtype=np.uint64).astype(
+        np.uint32)
+    rois = random_rois(rng, arr1.shape, 30)
+
+    assert create_sat(arr1, 2).dtype == np.float64
+    check_against_numpy(arr1, rois, create_roi_stats({'image': [arr1]},
+        *rois))
+
+
+# The summed-area tables are only worked out once some statistics are asked
+# for, and only once per image
+def test_sat_created_lazily(tmp_path, monkeypatch):
+
+    calls = []
+    monkeypatch.setattr(roi_stats, 'create_sat', lambda arr1, power=1:
+        calls.append(power) or create_sat(arr1, power))
+    dict_image = create_dict_image(write_images(tmp_path, 1)[0])
+
+    assert calls == []
+
+    create_roi_stats(dict_image, 0, 10, 0, 10)
+    create_roi_stats(dict_image, 5, 20, 5, 20)
+
+    assert sorted(calls) == [1, 2]
+
+
+# Letting go of images whose tables have been worked out (here by clearing
+# the cache) mustn't deadlock on them
+def test_clear_cache_after_roi_stats(tmp_path):
+
+    def run():
+        for filelocation in write_images(tmp_path, 2):
+            dict_image = create_dict_image(filelocation)
+            create_roi_stats(dict_image, 0, 10, 0, 10)
+        del dict_image
+        clear_cache()
+
+    run_with_timeout(run)
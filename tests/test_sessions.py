@@ -0,0 +1,74 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from scripts import sessions
+from scripts.image_cache import content_name
+from scripts.image_data import create_dict_image
+from scripts.sessions import (create_session, create_session_profiles,
+    create_session_rois, evaluate_sessions, read_sessions, write_session,
+    session_filelocation, set_session_dir)
+
+
+def save_image(filelocation, offset=0):
+
+    (y, x) = np.mgrid[:80, :120]
+    arr0 = (1000 + 10*x + 5*y + offset).astype(np.uint16)
+    Image.fromarray(arr0).save(filelocation)
+
+    return
+
+
+# A saved session reads back in as it was, and working it out again through
+# the same image gives the same results
+def test_session_round_trip(tmp_path):
+
+    save_image(str(tmp_path/'image.tif'))
+    dict_image = create_dict_image(str(tmp_path/'image.tif'))
+    profiles = create_session_profiles([10, 20], [100, 30], [40, 5], [40, 70],
+        width=[0, 4])
+    rois = create_session_rois([5, 50], [25, 110], [5, 10], [30, 70])
+
+    session = create_session(dict_image, profiles, rois, name='one')
+    write_session(str(tmp_path/'one.npz'), session)
+    saved = read_sessions([str(tmp_path/'one.npz')])
+
+    assert saved['session'][0] == 'one'
+    assert saved['image'][0] == content_name(str(tmp_path/'image.tif'))
+    for column in ('x_start', 'x_end', 'y_start', 'y_end', 'width'):
+        assert np.array_equal(saved['prof_' + column], profiles[column])
+    for column in ('x_start', 'x_end', 'y_start', 'y_end'):
+        assert np.array_equal(saved['roi_' + column], rois[column])
+
+    results = evaluate_sessions(dict_image, saved)
+
+    assert np.array_equal(results['prof_n_samples'], saved['prof_n_samples'])
+    assert np.allclose(results['prof_rms'], 0, atol=1e-3)
+    assert np.allclose(results['roi_mean'], saved['roi_mean'])
+
+
+# Against a different image the ROIs move by the difference (the profiles are
+# normalised, so they only change shape)
+def test_session_against_new_image(tmp_path):
+
+    save_image(str(tmp_path/'image.tif'))
+    save_image(str(tmp_path/'baseline.tif'), offset=50)
+    profiles = create_session_profiles(10, 100, 40, 40)
+    rois = create_session_rois(5, 25, 5, 30)
+    saved = create_session(create_dict_image(str(tmp_path/'image.tif')),
+        profiles, rois)
+
+    results = evaluate_sessions(create_dict_image(str(tmp_path/'baseline.tif')),
+        saved)
+
+    assert results['prof_rms'][0] > 0.1
+    assert np.allclose(results['roi_mean'] - saved['roi_mean'], 50)
+
+
+def test_set_session_dir(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(sessions, 'SESSION_DIR', 'sessions')
+    set_session_dir(str(tmp_path))
+
+    assert os.path.dirname(session_filelocation('image.tif')) == str(tmp_path)
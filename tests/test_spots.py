@@ -0,0 +1,40 @@
+import numpy as np
+
+from scripts.spots import find_spots
+
+
+def gaussian_image(spots, shape=(200, 300), background=100):
+
+    (y, x) = np.mgrid[:shape[0], :shape[1]]
+    arr1 = np.full(shape, float(background))
+    for (x0, y0, fwhm_x, fwhm_y, peak) in spots:
+        sigma_x = fwhm_x/(2*np.sqrt(2*np.log(2)))
+        sigma_y = fwhm_y/(2*np.sqrt(2*np.log(2)))
+        arr1 += peak*np.exp(-(x - x0)**2/(2*sigma_x**2)
+            - (y - y0)**2/(2*sigma_y**2))
+
+    return arr1.astype(np.uint16)
+
+
+# Gaussian spots come out with their centroid, FWHM and peak
+def test_gaussian_spots():
+
+    spots = [(60.3, 50.7, 12, 8, 1000), (220.5, 140.2, 10, 10, 800)]
+
+    dict_spots = find_spots(gaussian_image(spots))
+
+    assert len(dict_spots['x']) == 2
+    order = np.argsort(dict_spots['x'])
+    for i, (x0, y0, fwhm_x, fwhm_y, peak) in zip(order, spots):
+        assert abs(dict_spots['x'][i] - x0) < 0.1
+        assert abs(dict_spots['y'][i] - y0) < 0.1
+        assert abs(dict_spots['fwhm_x'][i] - fwhm_x) < 0.05*fwhm_x
+        assert abs(dict_spots['fwhm_y'][i] - fwhm_y) < 0.05*fwhm_y
+        assert abs(dict_spots['peak'][i] - peak) < 0.02*peak
+
+
+def test_flat_image_has_no_spots():
+
+    dict_spots = find_spots(np.full((64, 64), 100, dtype=np.uint16))
+
+    assert len(dict_spots['x']) == 0
@@ -0,0 +1,90 @@
+import threading
+
+import numpy as np
+from PIL import Image
+
+from scripts import image_loader
+from scripts.image_cache import is_file_backed
+from scripts.watch_folder import FolderWatcher, WatchFollower
+
+
+def write_image(filelocation, value=0):
+
+    Image.fromarray(np.full((32, 32), value, dtype=np.uint16)).save(
+        filelocation)
+
+    return filelocation
+
+
+# Collects what a watcher sends on, so a test can wait for it
+class Subscriber:
+
+    def __init__(self):
+        self.received = []
+        self.event = threading.Event()
+
+    def __call__(self, filelocation, dict_image):
+        self.received.append((filelocation, dict_image))
+        self.event.set()
+
+
+# A new image is picked up once it's settled and sent to the subscribers
+def test_new_image_sent(tmp_path):
+
+    subscriber = Subscriber()
+    watcher = FolderWatcher(str(tmp_path), settle_s=0.1, poll_s=0.05,
+        use_inotify=False).start()
+    watcher.subscribe(subscriber)
+    try:
+        filelocation = write_image(str(tmp_path / 'new.tif'), 7)
+        assert subscriber.event.wait(10)
+    finally:
+        watcher.stop()
+
+    assert subscriber.received[0][0] == filelocation
+    assert (subscriber.received[0][1]['image'][0] == 7).all()
+    assert watcher.latest_image() == filelocation
+
+
+# The detectors' images are read into memory even where others would be
+# memory-mapped, and if the extra analysis fails the image is still sent on
+# (and announced to the other workers)
+def test_failed_analysis_still_sent(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(image_loader, 'MEMORY_MAP', True)
+    filelocation = write_image(str(tmp_path / 'new.tif'))
+    announce = str(tmp_path / 'watched.txt')
+
+    def analyse(filelocation, dict_image):
+        raise RuntimeError('broken definitions')
+
+    subscriber = Subscriber()
+    watcher = FolderWatcher(str(tmp_path), analyse=analyse, announce=announce)
+    watcher.subscribe(subscriber)
+    watcher.process(filelocation, 0, 0)
+
+    assert [received[0] for received in subscriber.received] == [filelocation]
+    assert not is_file_backed(subscriber.received[0][1]['image'][0])
+    with open(announce) as f:
+        assert f.read() == filelocation + '\n'
+
+
+# The other workers pass on the images announced by the one watching
+def test_follower_sends_announced_images(tmp_path):
+
+    announce = str(tmp_path / 'watched.txt')
+    with open(announce, 'w') as f:
+        f.write(write_image(str(tmp_path / 'old.tif')) + '\n')
+
+    subscriber = Subscriber()
+    follower = WatchFollower(str(tmp_path), announce, poll_s=0.05).start()
+    follower.subscribe(subscriber)
+    try:
+        filelocation = write_image(str(tmp_path / 'new.tif'), 3)
+        with open(announce, 'a') as f:
+            f.write(filelocation + '\n')
+        assert subscriber.event.wait(10)
+    finally:
+        follower.stop()
+
+    assert [received[0] for received in subscriber.received] == [filelocation]